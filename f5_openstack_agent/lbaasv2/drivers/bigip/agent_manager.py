@@ -16,9 +16,14 @@
 #
 
 import datetime
+import hashlib
+import json
+import os
 import sys
+import time
 import uuid
 
+import eventlet
 from oslo_config import cfg
 from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
@@ -36,7 +41,11 @@ except ImportError:
 
 from f5_openstack_agent.lbaasv2.drivers.bigip import constants_v2
 from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
+from f5_openstack_agent.lbaasv2.drivers.bigip.lbaas_builder import \
+    ServiceDiff
 from f5_openstack_agent.lbaasv2.drivers.bigip import plugin_rpc
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    ResourceType
 
 LOG = logging.getLogger(__name__)
 
@@ -98,6 +107,16 @@ OPTS = [
         default=300,
         help=('Number of seconds between service refresh checks')
     ),
+    cfg.IntOpt(
+        'service_resync_slice',
+        default=0,
+        help=('Re-validate the cached loadbalancers a slice at a time on '
+              'every periodic task run instead of emptying the service '
+              'cache every service_resync_interval. This is the smallest '
+              'number of loadbalancers per run; more are taken if needed '
+              'to cover all of them within service_resync_interval. '
+              '0 empties the cache.')
+    ),
     cfg.StrOpt(
         'environment_prefix',
         default='Project',
@@ -118,6 +137,33 @@ OPTS = [
         default={},
         help=('Metrics to measure capacity and their limits')
     ),
+    cfg.IntOpt(
+        'f5_validation_workers',
+        default=1,
+        help=('Number of loadbalancers validated concurrently when the agent '
+              'resyncs its services. Tenants take turns, so one tenant with '
+              'many loadbalancers does not hold up the others.')
+    ),
+    cfg.IntOpt(
+        'f5_rpc_stats_log_interval',
+        default=300,
+        help=('Seconds between log summaries of the plugin RPC methods '
+              'the agent spent the most time in. 0 disables the summary.')
+    ),
+    cfg.IntOpt(
+        'f5_service_page_size',
+        default=100,
+        help=('Number of loadbalancer service definitions to request from '
+              'the plugin in one call when many are needed at once')
+    ),
+    cfg.StrOpt(
+        'f5_service_cache_file',
+        default=None,
+        help=('File in which the fingerprint of the last validated service '
+              'definition of each loadbalancer is kept, so a restarted '
+              'agent skips loadbalancers which did not change. Entries '
+              'older than service_resync_interval are validated again.')
+    ),
     cfg.IntOpt(
         'f5_pending_services_timeout',
         default=60,
@@ -141,6 +187,8 @@ class LogicalServiceCache(object):
     class Service(object):  # XXX maybe promote/use this class elsewhere?
         """Inner classes used to hold values for weakref lookups."""
 
+        __slots__ = ('port_id', 'loadbalancer_id', 'tenant_id', 'agent_host')
+
         def __init__(self, port_id, loadbalancer_id, tenant_id, agent_host):
             self.port_id = port_id
             self.loadbalancer_id = loadbalancer_id
@@ -148,26 +196,72 @@ class LogicalServiceCache(object):
             self.agent_host = agent_host
 
         def __eq__(self, other):
-            return self.__dict__ == other.__dict__
+            return isinstance(other, self.__class__) and \
+                self._values() == other._values()
+
+        def __ne__(self, other):
+            return not self == other
 
         def __hash__(self):
-            return hash(
-                (self.port_id,
-                 self.loadbalancer_id,
-                 self.tenant_id,
-                 self.agent_host)
-            )
+            return hash(self._values())
+
+        def _values(self):
+            return (self.port_id,
+                    self.loadbalancer_id,
+                    self.tenant_id,
+                    self.agent_host)
 
     def __init__(self):
         """Initialize Service cache object."""
         LOG.debug("Initializing LogicalServiceCache")
         self.services = {}
+        # loadbalancer ids by tenant_id and agent_host, and the
+        # loadbalancer id of each vip_port_id
+        self.tenant_index = {}
+        self.host_index = {}
+        self.port_index = {}
+        # {loadbalancer_id: {'fingerprint': digest, 'validated': time}}
+        # of the validated services, kept in path when it is set
+        self.records = {}
+        self.path = None
+        self.dirty = False
 
     @property
     def size(self):
         """Return the number of services cached."""
         return len(self.services)
 
+    def clear(self):
+        """Remove all services, and their validation records."""
+        self.services = {}
+        self.tenant_index = {}
+        self.host_index = {}
+        self.port_index = {}
+        # the bigips may have lost what was validated, e.g. on a resync
+        # or after backend integrity failed
+        if self.records:
+            self.records = {}
+            self.dirty = True
+
+    def _index(self, s):
+        self.tenant_index.setdefault(s.tenant_id, set()).add(
+            s.loadbalancer_id)
+        self.host_index.setdefault(s.agent_host, set()).add(
+            s.loadbalancer_id)
+        if s.port_id:
+            self.port_index[s.port_id] = s.loadbalancer_id
+
+    def _unindex(self, s):
+        for index, key in ((self.tenant_index, s.tenant_id),
+                           (self.host_index, s.agent_host)):
+            lb_ids = index.get(key)
+            if lb_ids is not None:
+                lb_ids.discard(s.loadbalancer_id)
+                if not lb_ids:
+                    del index[key]
+        if self.port_index.get(s.port_id) == s.loadbalancer_id:
+            del self.port_index[s.port_id]
+
     def put(self, service, agent_host):
         """Add a service to the cache."""
         port_id = service['loadbalancer'].get('vip_port_id', None)
@@ -178,9 +272,14 @@ class LogicalServiceCache(object):
             self.services[loadbalancer_id] = s
         else:
             s = self.services[loadbalancer_id]
+            if (s.tenant_id, s.port_id, s.agent_host) == \
+                    (tenant_id, port_id, agent_host):
+                return
+            self._unindex(s)
             s.tenant_id = tenant_id
             s.port_id = port_id
             s.agent_host = agent_host
+        self._index(s)
 
     def remove(self, service):
         """Remove a service from the cache."""
@@ -188,35 +287,118 @@ class LogicalServiceCache(object):
             loadbalancer_id = service['loadbalancer']['id']
         else:
             loadbalancer_id = service.loadbalancer_id
-        if loadbalancer_id in self.services:
-            del(self.services[loadbalancer_id])
+        self.remove_by_loadbalancer_id(loadbalancer_id)
 
     def remove_by_loadbalancer_id(self, loadbalancer_id):
         """Remove service by providing the loadbalancer id."""
         if loadbalancer_id in self.services:
-            del(self.services[loadbalancer_id])
+            self._unindex(self.services.pop(loadbalancer_id))
+        self.forget(loadbalancer_id)
 
     def get_by_loadbalancer_id(self, loadbalancer_id):
         """Retreive service by providing the loadbalancer id."""
         return self.services.get(loadbalancer_id, None)
 
+    def get_by_tenant_id(self, tenant_id):
+        """Return the services of a tenant."""
+        return [self.services[lb_id]
+                for lb_id in self.tenant_index.get(tenant_id, ())]
+
+    def get_by_agent_host(self, agent_host):
+        """Return the services bound to an agent host."""
+        return [self.services[lb_id]
+                for lb_id in self.host_index.get(agent_host, ())]
+
+    def get_by_port_id(self, port_id):
+        """Return the service of a vip port, or None."""
+        lb_id = self.port_index.get(port_id)
+        return self.services.get(lb_id) if lb_id else None
+
     def get_loadbalancer_ids(self):
         """Return a list of cached loadbalancer ids."""
         return self.services.keys()
 
     def get_tenant_ids(self):
         """Return a list of tenant ids in the service cache."""
-        tenant_ids = {}
-        for service in self.services:
-            tenant_ids[service.tenant_id] = 1
-        return tenant_ids.keys()
+        return self.tenant_index.keys()
 
     def get_agent_hosts(self):
         """Return a list of agent ids stored in the service cache."""
-        agent_hosts = {}
-        for service in self.services:
-            agent_hosts[service.agent_host] = 1
-        return agent_hosts.keys()
+        return self.host_index.keys()
+
+    @staticmethod
+    def get_fingerprint(service):
+        """Return a digest of the device relevant parts of a service."""
+        return hashlib.md5(json.dumps(
+            sorted(ServiceDiff.get_fingerprint(service).items()))).hexdigest()
+
+    @staticmethod
+    def _checksum(records):
+        return hashlib.sha256(json.dumps(records, sort_keys=True)).hexdigest()
+
+    def load(self, path):
+        """Read the validation records kept in path.
+
+        A file which can not be read or fails its checksum is discarded,
+        which only costs the validation of every loadbalancer.
+        """
+        self.path = path
+        self.records = {}
+        self.dirty = False
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as cache_file:
+                content = json.load(cache_file)
+            records = content['records']
+            if content['checksum'] != self._checksum(records):
+                raise ValueError('checksum mismatch')
+            self.records = records
+            LOG.debug('loaded %d service records from %s'
+                      % (len(records), path))
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            LOG.warning('discarding service cache file %s: %s'
+                        % (path, str(e)))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def save(self):
+        """Write the validation records to path if they changed."""
+        if not self.path or not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'checksum': self._checksum(self.records),
+                           'records': self.records}, cache_file)
+            os.rename(tmp_path, self.path)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            LOG.error('unable to write service cache file %s: %s'
+                      % (self.path, str(e)))
+
+    def record(self, loadbalancer_id, fingerprint, validated=None):
+        """Note a service as validated with the given fingerprint."""
+        if not self.path:
+            return
+        self.records[loadbalancer_id] = {
+            'fingerprint': fingerprint,
+            'validated': validated if validated is not None else time.time()}
+        self.dirty = True
+
+    def forget(self, loadbalancer_id):
+        """Drop the validation record of a loadbalancer."""
+        if self.records.pop(loadbalancer_id, None):
+            self.dirty = True
+
+    def is_unchanged(self, loadbalancer_id, fingerprint, max_age):
+        """Whether a service was validated with fingerprint recently."""
+        record = self.records.get(loadbalancer_id)
+        if not record or record['fingerprint'] != fingerprint:
+            return False
+        return time.time() - record['validated'] < max_age
 
 
 class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
@@ -241,6 +423,8 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
 
         # Create the cache of provisioned services
         self.cache = LogicalServiceCache()
+        if conf.f5_service_cache_file:
+            self.cache.load(conf.f5_service_cache_file)
         self.last_resync = datetime.datetime.now()
         self.needs_resync = False
         self.plugin_rpc = None
@@ -249,10 +433,24 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         self.state_rpc = None
         self.pending_services = {}
 
+        self.last_stats_collection = datetime.datetime.now()
+        self.last_rpc_stats_log = datetime.datetime.now()
         self.service_resync_interval = conf.service_resync_interval
         LOG.debug('setting service resync intervl to %d seconds' %
                   self.service_resync_interval)
 
+        # rolling resync: the last loadbalancer id validated, in id order,
+        # when each cached loadbalancer was last validated, and when the
+        # validation of a loadbalancer last failed
+        self.resync_cursor = None
+        self.resync_cycle_start = datetime.datetime.now()
+        self.last_validated = {}
+        self.validation_failures = {}
+        self.resync_stats = {'cycles': 0, 'validated': 0, 'failed': 0,
+                             'last_cycle_seconds': 0}
+        self.validation_progress = {'validated': 0, 'failed': 0, 'total': 0,
+                                    'started': None}
+
         # Load the driver.
         self._load_driver(conf)
 
@@ -367,6 +565,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             self.conf.environment_group_number,
             self.agent_host
         )
+        self.plugin_rpc.service_page_size = self.conf.f5_service_page_size
 
         #
         # Setting up outbound communcations with the neutron agent extension
@@ -426,7 +625,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         try:
             if force_resync:
                 self.needs_resync = True
-                self.cache.services = {}
+                self.cache.clear()
                 self.lbdriver.flush_cache()
             # use the admin_state_up to notify the
             # controller if all backend devices
@@ -436,7 +635,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             if self.lbdriver:
                 if not self.lbdriver.backend_integrity():
                     self.needs_resync = True
-                    self.cache.services = {}
+                    self.cache.clear()
                     self.lbdriver.flush_cache()
                     self.plugin_rpc.set_agent_admin_state(False)
                     self.admin_state_up = False
@@ -451,6 +650,14 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                 self.agent_state['configurations'].update(
                     self.lbdriver.get_agent_configurations()
                 )
+            if self.conf.service_resync_slice:
+                self.agent_state['configurations']['service_resync'] = \
+                    self.get_resync_stats()
+            self.agent_state['configurations']['service_validation'] = \
+                self.get_validation_progress()
+            if self.plugin_rpc:
+                self.agent_state['configurations']['plugin_rpc'] = \
+                    self.plugin_rpc.get_rpc_stats()
 
             # add the capacity score, used by the scheduler
             # for horizontal scaling of an environment, from
@@ -520,18 +727,59 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
 
         active_loadbalancers = \
             self.plugin_rpc.get_active_loadbalancers(host=self.agent_host)
-        for loadbalancer in active_loadbalancers:
-            if self.agent_host == loadbalancer['agent_host']:
-                try:
-                    lb_id = loadbalancer['lb_id']
-                    LOG.debug(
-                        'getting operating status for loadbalancer %s.', lb_id)
-                    svc = self.plugin_rpc.get_service_by_loadbalancer_id(
-                        lb_id)
-                    self.lbdriver.update_operating_status(svc)
-
-                except Exception as e:
-                    LOG.exception('Error updating status %s.', e.message)
+        lb_ids = [loadbalancer['lb_id']
+                  for loadbalancer in active_loadbalancers
+                  if self.agent_host == loadbalancer['agent_host']]
+        LOG.debug('getting operating status for loadbalancers %s.', lb_ids)
+        try:
+            services = [svc for svc in
+                        self.plugin_rpc.get_services_by_loadbalancer_ids(
+                            lb_ids).values() if svc]
+        except Exception as e:
+            LOG.exception('Error updating status %s.', e.message)
+            return
+
+        # the member status of all loadbalancers is read from the devices
+        # and sent to the plugin in bulk
+        try:
+            self.lbdriver.update_operating_statuses(services)
+        except Exception as e:
+            LOG.exception('Error updating status %s.', e.message)
+
+    @periodic_task.periodic_task(spacing=PERIODIC_TASK_INTERVAL)
+    def collect_loadbalancer_stats(self, context):
+        """Send the stats of all known loadbalancers to the controller."""
+        interval = self.conf.f5_stats_collection_interval
+        if not interval or not self.plugin_rpc:
+            return
+
+        now = datetime.datetime.now()
+        if (now - self.last_stats_collection).seconds < interval:
+            return
+        self.last_stats_collection = now
+
+        loadbalancer_ids = self.cache.get_loadbalancer_ids()
+        if loadbalancer_ids:
+            try:
+                self.lbdriver.collect_loadbalancer_stats(loadbalancer_ids)
+            except Exception as e:
+                LOG.exception('Error collecting stats %s.', e.message)
+
+    @periodic_task.periodic_task(spacing=PERIODIC_TASK_INTERVAL)
+    def log_rpc_stats(self, context):
+        """Log the plugin RPC methods the agent spent the most time in."""
+        interval = self.conf.f5_rpc_stats_log_interval
+        if not interval or not self.plugin_rpc:
+            return
+
+        now = datetime.datetime.now()
+        if (now - self.last_rpc_stats_log).seconds < interval:
+            return
+        self.last_rpc_stats_log = now
+
+        summary = self.plugin_rpc.get_rpc_summary()
+        if summary:
+            LOG.info("plugin RPC summary:\n    %s" % '\n    '.join(summary))
 
     # setup a period task to decide if it is time empty the local service
     # cache and resync service definitions form the controller
@@ -548,11 +796,16 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                 LOG.debug(
                     'forcing resync of services on resync timer (%d seconds).'
                     % self.service_resync_interval)
-                self.cache.services = {}
+                # a rolling resync keeps the cache, the resync then only
+                # picks up loadbalancers missing from it
+                if not self.conf.service_resync_slice:
+                    self.cache.clear()
+                    self.lbdriver.flush_cache()
                 self.last_resync = now
-                self.lbdriver.flush_cache()
                 LOG.debug("periodic_sync: service_resync_interval expired: %s"
                           % str(self.needs_resync))
+        if self.conf.service_resync_slice:
+            self.rolling_resync(now)
         # resync if we need to
         if self.needs_resync:
             LOG.debug("resync required at: %s" % now)
@@ -567,6 +820,80 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             if self.clean_orphaned_objects_and_save_device_config():
                 self.needs_resync = True
 
+    def rolling_resync(self, now):
+        """Re-validate the next slice of cached loadbalancers.
+
+        The loadbalancers are walked in id order from a cursor, so all of
+        them are validated once per cycle however the cache changes in
+        between. Loadbalancers whose validation failed are retried ahead
+        of the slice, and only successful validations count as validated.
+        The driver caches are flushed whenever a cycle completes.
+        """
+        if not self.lbdriver.backend_integrity():
+            return
+
+        lb_ids = sorted(self.cache.get_loadbalancer_ids())
+        for validated in (self.last_validated, self.validation_failures):
+            for lb_id in list(validated):
+                if lb_id not in self.cache.services:
+                    del validated[lb_id]
+        if not lb_ids:
+            return
+
+        ticks = max(self.service_resync_interval //
+                    max(self.conf.periodic_interval, 1), 1)
+        size = max(self.conf.service_resync_slice,
+                   -(-len(lb_ids) // ticks))
+        remaining = [lb_id for lb_id in lb_ids
+                     if self.resync_cursor is None or
+                     lb_id > self.resync_cursor]
+        batch = remaining[:size]
+        retry = sorted(self.validation_failures)[:size]
+        lb_ids_to_validate = \
+            retry + [lb_id for lb_id in batch if lb_id not in retry]
+        failed = self._run_validations(
+            lb_ids_to_validate, self._get_services(lb_ids_to_validate))
+        for lb_id in lb_ids_to_validate:
+            if lb_id in failed:
+                self.resync_stats['failed'] += 1
+            else:
+                self.last_validated[lb_id] = now
+                self.resync_stats['validated'] += 1
+        if batch:
+            self.resync_cursor = batch[-1]
+
+        if len(remaining) <= size:
+            cycle = now - self.resync_cycle_start
+            LOG.debug('rolling resync validated %d loadbalancers in %d '
+                      'seconds' % (len(lb_ids), cycle.total_seconds()))
+            self.resync_stats['cycles'] += 1
+            self.resync_stats['last_cycle_seconds'] = \
+                int(cycle.total_seconds())
+            self.resync_cursor = None
+            self.resync_cycle_start = now
+            self.lbdriver.flush_cache()
+
+    def get_resync_stats(self):
+        """Return the coverage and lag of the rolling resync.
+
+        coverage is the share of cached loadbalancers validated in the
+        current cycle, lag the seconds since the least recently validated
+        loadbalancer was validated.
+        """
+        now = datetime.datetime.now()
+        lb_ids = self.cache.get_loadbalancer_ids()
+        validated = [self.last_validated.get(lb_id, self.resync_cycle_start)
+                     for lb_id in lb_ids]
+        covered = [lb_id for lb_id in lb_ids if lb_id in self.last_validated
+                   and self.last_validated[lb_id] >= self.resync_cycle_start]
+        oldest = min(validated or [now])
+        stats = dict(self.resync_stats)
+        stats['loadbalancers'] = len(lb_ids)
+        stats['coverage'] = \
+            round(float(len(covered)) / len(lb_ids), 3) if lb_ids else 1.0
+        stats['lag'] = int((now - oldest).total_seconds())
+        return stats
+
     def tunnel_sync(self):
         """Call into driver to advertise device tunnel endpoints."""
         LOG.debug("manager:tunnel_sync: calling driver tunnel_sync")
@@ -595,6 +922,13 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
 
             LOG.debug("plugin produced the list of active loadbalancer ids: %s"
                       % list(active_loadbalancer_ids))
+
+            # the cache is not emptied by a rolling resync, forget
+            # loadbalancers which are not bound to this agent anymore
+            if self.conf.service_resync_slice:
+                for lb_id in list(known_services):
+                    if lb_id not in all_loadbalancer_ids:
+                        self.cache.remove_by_loadbalancer_id(lb_id)
             LOG.debug("currently known loadbalancer ids before sync are: %s"
                       % list(known_services))
 
@@ -602,7 +936,9 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             # agent is bound, that does not exist in our service cache.
             self._validate_services(all_loadbalancer_ids)
 
-            resync = self._refresh_pending_services()
+            # loadbalancers which stay pending are refreshed from the
+            # pending queue, not by resyncing
+            self._refresh_pending_services()
 
             # Get a list of any cached service we now know after
             # refreshing services
@@ -625,9 +961,34 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                 known_services.add(lb_id)
         return all_services, known_services
 
+    def _track_pending(self, service, pending):
+        """Queue or dequeue a loadbalancer after handling a request for it."""
+        lb_id = service.get('loadbalancer', {}).get('id')
+        if not lb_id:
+            return
+        if pending:
+            self.pending_services.setdefault(lb_id, datetime.datetime.now())
+        else:
+            self.pending_services.pop(lb_id, None)
+
+    # refresh the loadbalancers this agent left pending between resyncs,
+    # the resync reconciles the queue with the plugin
+    @periodic_task.periodic_task(spacing=PERIODIC_TASK_INTERVAL)
+    def refresh_pending_services(self, context):
+        """Refresh the loadbalancers in the pending queue."""
+        if not self.pending_services or self.needs_resync:
+            return
+        if not self.lbdriver.backend_integrity():
+            return
+        self._process_pending_services(list(self.pending_services))
+
     def _refresh_pending_services(self):
+        """Reconcile the pending queue with the plugin and refresh it.
+
+        Loadbalancers the plugin reports pending are queued, queued ones
+        it does not report anymore are dropped.
+        """
         now = datetime.datetime.now()
-        resync = False
         # This produces a list of loadbalancers with pending tasks to
         # be performed.
         pending_loadbalancers, pending_lb_ids = \
@@ -637,13 +998,27 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             "plugin produced the list of pending loadbalancer ids: %s"
             % list(pending_lb_ids))
 
-        for lb_id in list(pending_lb_ids):
-            lb_pending = self.refresh_service(lb_id)
-            if lb_pending:
-                if lb_id not in self.pending_services:
-                    self.pending_services[lb_id] = now
+        for lb_id in list(self.pending_services):
+            if lb_id not in pending_lb_ids:
+                del self.pending_services[lb_id]
+        for lb_id in pending_lb_ids:
+            self.pending_services.setdefault(lb_id, now)
+        return self._process_pending_services(pending_lb_ids)
+
+    def _process_pending_services(self, lb_ids):
+        """Refresh queued loadbalancers, the closest to time out first.
 
-                time_added = self.pending_services[lb_id]
+        Loadbalancers which are still pending after
+        f5_pending_services_timeout are timed out and dequeued. Returns
+        whether any loadbalancers remain pending.
+        """
+        now = datetime.datetime.now()
+        lb_ids = sorted(lb_ids, key=self.pending_services.get)
+        services = self._get_services(lb_ids)
+        for lb_id in lb_ids:
+            lb_pending = self.refresh_service(lb_id, services.get(lb_id))
+            if lb_pending:
+                time_added = self.pending_services.setdefault(lb_id, now)
                 has_expired = bool((now - time_added).seconds >
                                    self.conf.f5_pending_services_timeout)
 
@@ -652,49 +1027,134 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                     self.service_timeout(lb_id)
 
             if not lb_pending:
-                try:
-                    del self.pending_services[lb_id]
-                except KeyError as e:
-                    LOG.error("LB not found in pending services: {0}".format(
-                        e.message))
-
-        # If there are services in the pending cache resync
-        if self.pending_services:
-            resync = True
-        return resync
+                self.pending_services.pop(lb_id, None)
+
+        return bool(self.pending_services)
 
     def _get_remote_loadbalancers(self, plugin_rpc_attr, host=None):
         loadbalancers = getattr(self.plugin_rpc, plugin_rpc_attr)(host=host)
         lb_ids = [lb['lb_id'] for lb in loadbalancers]
         return tuple(loadbalancers), set(lb_ids)
 
+    def _get_services(self, lb_ids):
+        # the service definitions of many loadbalancers in bulk, a failed
+        # request leaves each loadbalancer to fetch its own
+        if not lb_ids:
+            return {}
+        try:
+            return self.plugin_rpc.get_services_by_loadbalancer_ids(lb_ids)
+        except Exception as exc:
+            LOG.error("Unable to get services: %s" % exc.message)
+            return {}
+
     def _validate_services(self, lb_ids):
+        lb_ids = [lb_id for lb_id in lb_ids
+                  if not self.cache.get_by_loadbalancer_id(lb_id)]
+        self._run_validations(lb_ids, self._get_services(lb_ids))
+
+    def _run_validations(self, lb_ids, services):
+        """Validate loadbalancers on f5_validation_workers greenthreads.
+
+        The loadbalancers of the tenants take turns, and the progress is
+        kept in validation_progress for the agent state reports. Failed
+        validations are kept in validation_failures until a validation
+        of the loadbalancer succeeds. Returns the failed loadbalancer ids.
+        """
+        failed = set()
+        if not lb_ids:
+            return failed
+        progress = {'validated': 0, 'failed': 0, 'total': len(lb_ids),
+                    'started': datetime.datetime.now()}
+        self.validation_progress = progress
+
+        def validate(lb_id):
+            if self.validate_service(lb_id, services.get(lb_id)):
+                self.validation_failures.pop(lb_id, None)
+                progress['validated'] += 1
+            else:
+                self.validation_failures[lb_id] = datetime.datetime.now()
+                failed.add(lb_id)
+                progress['failed'] += 1
+
+        pool = eventlet.GreenPool(max(self.conf.f5_validation_workers, 1))
+        for lb_id in self._tenant_round_robin(lb_ids, services):
+            pool.spawn_n(validate, lb_id)
+        pool.waitall()
+        self.cache.save()
+        return failed
+
+    @staticmethod
+    def _tenant_round_robin(lb_ids, services):
+        # one loadbalancer of every tenant in turn, in the given order
+        tenants = []
+        tenant_lb_ids = {}
         for lb_id in lb_ids:
-            if not self.cache.get_by_loadbalancer_id(lb_id):
-                self.validate_service(lb_id)
+            service = services.get(lb_id) or {}
+            tenant_id = service.get('loadbalancer', {}).get('tenant_id')
+            if tenant_id not in tenant_lb_ids:
+                tenants.append(tenant_id)
+                tenant_lb_ids[tenant_id] = []
+            tenant_lb_ids[tenant_id].append(lb_id)
+
+        ordered = []
+        while len(ordered) < len(lb_ids):
+            for tenant_id in tenants:
+                if tenant_lb_ids[tenant_id]:
+                    ordered.append(tenant_lb_ids[tenant_id].pop(0))
+        return ordered
+
+    def get_validation_progress(self):
+        """Return the progress of the last service validation run."""
+        progress = self.validation_progress
+        validated, failed, total = \
+            progress['validated'], progress['failed'], progress['total']
+        report = {'validated': validated, 'failed': failed, 'total': total,
+                  'eta': 0}
+        done = validated + failed
+        if progress['started'] and 0 < done < total:
+            elapsed = (datetime.datetime.now() -
+                       progress['started']).total_seconds()
+            report['eta'] = int(elapsed / done * (total - done))
+        return report
 
     @log_helpers.log_method_call
-    def validate_service(self, lb_id):
+    def validate_service(self, lb_id, service=None):
 
         try:
-            service = self.plugin_rpc.get_service_by_loadbalancer_id(
-                lb_id
-            )
+            if service is None:
+                service = self.plugin_rpc.get_service_by_loadbalancer_id(
+                    lb_id
+                )
             self.cache.put(service, self.agent_host)
-            if not self.lbdriver.service_exists(service) or \
-                    self.has_provisioning_status_of_error(service):
+            # provisioning statuses are not part of the fingerprint, so
+            # services with an object in error are always validated
+            has_error = self.has_provisioning_status_of_error(service)
+            fingerprint = None
+            if self.cache.path and not has_error:
+                fingerprint = self.cache.get_fingerprint(service)
+                if service['loadbalancer'].get('provisioning_status') == \
+                        constants_v2.F5_ACTIVE and self.cache.is_unchanged(
+                            lb_id, fingerprint, self.service_resync_interval):
+                    LOG.debug("Service definition for '{}' is unchanged"
+                              " since it was validated.".format(lb_id))
+                    return True
+            if has_error or not self.lbdriver.service_exists(service):
                 LOG.info("active loadbalancer '{}' is not on BIG-IP"
                          " or has error state...syncing".format(lb_id))
                 self.lbdriver.sync(service)
             else:
                 LOG.debug("Found service definition for '{}', state is ACTIVE"
                           " move on.".format(lb_id))
+            if fingerprint:
+                self.cache.record(lb_id, fingerprint)
+            return True
         except f5_ex.InvalidNetworkType as exc:
             LOG.warning(exc.msg)
         except f5_ex.F5NeutronException as exc:
             LOG.error("NeutronException: %s" % exc.msg)
         except Exception as exc:
             LOG.exception("Service validation error: %s" % exc.message)
+        return False
 
     @staticmethod
     def has_provisioning_status_of_error(service):
@@ -735,21 +1195,24 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         return error_status
 
     @log_helpers.log_method_call
-    def refresh_service(self, lb_id):
+    def refresh_service(self, lb_id, service=None):
+        """Sync a loadbalancer, returns whether it is still pending."""
+        pending = False
         try:
-            service = self.plugin_rpc.get_service_by_loadbalancer_id(
-                lb_id
-            )
+            if service is None:
+                service = self.plugin_rpc.get_service_by_loadbalancer_id(
+                    lb_id
+                )
             self.cache.put(service, self.agent_host)
-            if self.lbdriver.sync(service):
-                self.needs_resync = True
+            pending = bool(self.lbdriver.sync(service))
         except f5_ex.F5NeutronException as exc:
             LOG.error("NeutronException: %s" % exc.msg)
         except Exception as e:
             LOG.error("Exception: %s" % e.message)
             self.needs_resync = True
+            pending = True
 
-        return self.needs_resync
+        return pending
 
     @log_helpers.log_method_call
     def service_timeout(self, lb_id):
@@ -792,35 +1255,43 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                 # We will first try to find any orphaned pools
                 # and remove them.
 
+                # Read the objects of all tenant partitions of all
+                # BIG-IPs once, every purge step below works from it
+                inventory = self.lbdriver.get_device_inventory()
+
                 # Ask BIG-IP for all deployed loadbalancers (virtual addresses)
                 lbs = self.lbdriver.get_all_deployed_loadbalancers(
-                    purge_orphaned_folders=True)
+                    purge_orphaned_folders=True, inventory=inventory)
                 if lbs:
-                    self.purge_orphaned_loadbalancers(lbs)
+                    self.purge_orphaned_loadbalancers(lbs, inventory)
 
                 # Ask the BIG-IP for all deployed listeners to make
                 # sure we are not orphaning listeners which have
                 # valid loadbalancers in a OK state
-                listeners = self.lbdriver.get_all_deployed_listeners()
+                listeners = self.lbdriver.get_all_deployed_listeners(
+                    inventory=inventory)
                 if listeners:
-                    self.purge_orphaned_listeners(listeners)
+                    self.purge_orphaned_listeners(listeners, inventory)
 
-                policies = self.lbdriver.get_all_deployed_l7_policys()
+                policies = self.lbdriver.get_all_deployed_l7_policys(
+                    inventory=inventory)
                 if policies:
-                    self.purge_orphaned_l7_policys(policies)
+                    self.purge_orphaned_l7_policys(policies, inventory)
 
                 # Ask the BIG-IP for all deployed pools not associated
                 # to a virtual server
-                pools = self.lbdriver.get_all_deployed_pools()
+                pools = self.lbdriver.get_all_deployed_pools(
+                    inventory=inventory)
                 if pools:
-                    self.purge_orphaned_pools(pools)
+                    self.purge_orphaned_pools(pools, inventory)
                     self.purge_orphaned_nodes(pools)
 
                 # Ask the BIG-IP for all deployed monitors not associated
                 # to a pool
-                monitors = self.lbdriver.get_all_deployed_health_monitors()
+                monitors = self.lbdriver.get_all_deployed_health_monitors(
+                    inventory=inventory)
                 if monitors:
-                    self.purge_orphaned_health_monitors(monitors)
+                    self.purge_orphaned_health_monitors(monitors, inventory)
 
             else:
                 LOG.debug('the global agent is %s' % (global_agent['host']))
@@ -834,7 +1305,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         return cleaned
 
     @log_helpers.log_method_call
-    def purge_orphaned_loadbalancers(self, lbs):
+    def purge_orphaned_loadbalancers(self, lbs, inventory=None):
         """Gets 'unknown' loadbalancers from Neutron and purges them
 
         Provisioning status of 'unknown' on loadbalancers means that the object
@@ -858,16 +1329,19 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                     tenant_id=lbs[lbid]['tenant_id'],
                     loadbalancer_id=lbid,
                     hostnames=lbs[lbid]['hostnames'])
+                if inventory:
+                    inventory.discard(ResourceType.virtual_address,
+                                      lbs[lbid]['tenant_id'], lbid)
                 lbs_removed = True
         if lbs_removed:
             # If we have removed load balancers, then scrub
             # for tenant folders we can delete because they
             # no longer contain loadbalancers.
             self.lbdriver.get_all_deployed_loadbalancers(
-                purge_orphaned_folders=True)
+                purge_orphaned_folders=True, inventory=inventory)
 
     @log_helpers.log_method_call
-    def purge_orphaned_listeners(self, listeners):
+    def purge_orphaned_listeners(self, listeners, inventory=None):
         """Deletes the hanging listeners from the deleted loadbalancers"""
         listener_status = self.plugin_rpc.validate_listeners_state(
             list(listeners.keys()))
@@ -883,13 +1357,17 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                     tenant_id=listeners[listenerid]['tenant_id'],
                     listener_id=listenerid,
                     hostnames=listeners[listenerid]['hostnames'])
+                if inventory:
+                    inventory.discard(ResourceType.virtual,
+                                      listeners[listenerid]['tenant_id'],
+                                      listenerid)
 
     @log_helpers.log_method_call
-    def purge_orphaned_l7_policys(self, policies):
+    def purge_orphaned_l7_policys(self, policies, inventory=None):
         """Deletes hanging l7_policies from the deleted listeners"""
         policies_used = set()
         listeners = self.lbdriver.get_all_deployed_listeners(
-            expand_subcollections=True)
+            expand_subcollections=True, inventory=inventory)
         for li_id in listeners:
             policy = listeners[li_id]['l7_policy']
             if policy:
@@ -943,7 +1421,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         self.lbdriver.purge_orphaned_nodes(tenant_members)
 
     @log_helpers.log_method_call
-    def purge_orphaned_pools(self, pools):
+    def purge_orphaned_pools(self, pools, inventory=None):
         """Deletes hanging pools from the deleted listeners"""
         # Ask Neutron for the status of all deployed pools
         pools_status = self.plugin_rpc.validate_pools_state(
@@ -959,13 +1437,16 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                     tenant_id=pools[poolid]['tenant_id'],
                     pool_id=poolid,
                     hostnames=pools[poolid]['hostnames'])
+                if inventory:
+                    inventory.discard(ResourceType.pool,
+                                      pools[poolid]['tenant_id'], poolid)
 
     @log_helpers.log_method_call
-    def purge_orphaned_health_monitors(self, monitors):
+    def purge_orphaned_health_monitors(self, monitors, inventory=None):
         """Deletes hanging Health Monitors from the deleted Pools"""
         # ask Neutron for for the status of all deployed monitors...
         monitors_used = set()
-        pools = self.lbdriver.get_all_deployed_pools()
+        pools = self.lbdriver.get_all_deployed_pools(inventory=inventory)
         LOG.debug("pools found: {}".format(pools))
         for pool_id in pools:
             monitorid = pools.get(pool_id).get('monitors', 'None')
@@ -993,8 +1474,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                 self.lbdriver.create_loadbalancer(loadbalancer,
                                                   service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
 
         except f5_ex.F5NeutronException as exc:
             LOG.error("f5_ex.NeutronException: %s" % exc.msg)
@@ -1010,8 +1490,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                 old_loadbalancer,
                 loadbalancer, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("f5_ex.F5NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1049,8 +1528,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.create_listener(listener, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("f5_ex.F5NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1063,8 +1541,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.update_listener(old_listener, listener, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("f5_ex.F5NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1077,8 +1554,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.delete_listener(listener, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("delete_listener: NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1090,8 +1566,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         try:
             service_pending = self.lbdriver.create_pool(pool, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1104,8 +1579,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.update_pool(old_pool, pool, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1117,8 +1591,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         try:
             service_pending = self.lbdriver.delete_pool(pool, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("delete_pool: NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1131,8 +1604,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.create_member(member, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("create_member: NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1145,8 +1617,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.update_member(old_member, member, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("update_member: NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1158,8 +1629,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
         try:
             service_pending = self.lbdriver.delete_member(member, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("delete_member: NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1172,8 +1642,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.create_health_monitor(health_monitor, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("create_pool_health_monitor: NeutronException: %s"
                       % exc.msg)
@@ -1191,8 +1660,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
                                                     health_monitor,
                                                     service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("update_health_monitor: NeutronException: %s" % exc.msg)
         except Exception as exc:
@@ -1205,8 +1673,7 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):  # b --> B
             service_pending = \
                 self.lbdriver.delete_health_monitor(health_monitor, service)
             self.cache.put(service, self.agent_host)
-            if service_pending:
-                self.needs_resync = True
+            self._track_pending(service, service_pending)
         except f5_ex.F5NeutronException as exc:
             LOG.error("delete_health_monitor: NeutronException: %s" % exc.msg)
         except Exception as exc:
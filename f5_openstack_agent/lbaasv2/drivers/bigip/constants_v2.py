@@ -35,6 +35,7 @@ AGENT_BINARY_NAME = 'f5-oslbaasv2-agent'
 
 DEFAULT_PARTITION = 'Common'
 DEFAULT_ROUTE_DOMAIN_ID = 0
+MAX_ROUTE_DOMAIN_ID = 65534
 
 # RPC channel names
 TOPIC_PROCESS_ON_HOST_V2 = 'f5-lbaasv2-process-on-controller'
@@ -30,6 +30,15 @@ class F5AgentException(Exception):
     pass
 
 
+class StatusUpdatesFailed(F5AgentException):
+    """Some of the statuses sent one RPC per object could not be sent."""
+
+    def __init__(self, statuses):
+        super(StatusUpdatesFailed, self).__init__(
+            "Unable to send %d statuses" % len(statuses))
+        self.statuses = statuses
+
+
 class UnreadableCert(F5AgentException):
     pass
 
@@ -58,6 +67,10 @@ class BigIPClusterSyncFailure(F5AgentException):
     pass
 
 
+class BigIPDeviceTimeout(F5AgentException):
+    pass
+
+
 class BigIPClusterPeerAddFailure(F5AgentException):
     pass
 
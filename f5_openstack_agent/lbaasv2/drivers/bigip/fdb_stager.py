@@ -0,0 +1,181 @@
+# coding=utf-8
+# Copyright (c) 2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+
+from eventlet import semaphore
+from oslo_log import log as logging
+from oslo_service import loopingcall
+
+LOG = logging.getLogger(__name__)
+
+FLOOD_MAC_ADDRESS = '00:00:00:00:00:00'
+
+
+class FdbStager(object):
+    """Merge l2population fdb updates before they reach the BIG-IPs.
+
+    Added and removed fdb entries are staged per network and mac address.
+    A newer entry for a mac address replaces the staged one, as applying
+    both in order would leave the same records as applying the newer one.
+    The exception is an add on another vtep than a staged remove: BIG-IPs
+    skip the entries of their own vtep, so the remove is kept for them.
+    Every interval seconds the staged entries are applied in bulk, the
+    removed ones with remove_fdb and then the added ones with add_fdb.
+    Entries which could not be applied are staged again, unless a newer
+    entry for the mac address was staged meanwhile, up to max_retries
+    times.
+
+    The fdb structure is the one of the l2population RPCs:
+        {'<network_id>':
+            {'segment_id': <int>,
+             'network_type': '<network type>',
+             'ports': {'<vtep>': [['<mac_address>', '<ip_address>']]}}}
+    """
+
+    def __init__(self, add_fdb, remove_fdb, interval=1.0, max_retries=5):
+        self.add_fdb = add_fdb
+        self.remove_fdb = remove_fdb
+        self.interval = interval
+        self.max_retries = max_retries
+        # (network_id, mac_address, added): (network, vtep, ip_address)
+        self.queue = collections.OrderedDict()
+        # (network_id, mac_address, added): times it failed to be applied
+        self.retries = {}
+        self.stats = {'staged': 0, 'merged': 0, 'cancelled': 0,
+                      'applied': 0, 'flushes': 0, 'errors': 0,
+                      'retried': 0, 'dropped': 0}
+        self.lock = semaphore.Semaphore()
+        self.timer = None
+
+    def start(self):
+        if not self.timer:
+            self.timer = loopingcall.FixedIntervalLoopingCall(self.flush)
+            self.timer.start(interval=self.interval)
+
+    def stop(self):
+        if self.timer:
+            self.timer.stop()
+            self.timer = None
+        self.flush()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['pending'] = len(self.queue)
+        return stats
+
+    def add(self, fdb):
+        self._stage(fdb, True)
+
+    def remove(self, fdb):
+        self._stage(fdb, False)
+
+    def _stage(self, fdb, added):
+        for network_id, net_fdb in fdb.items():
+            network = {'segment_id': net_fdb['segment_id'],
+                       'network_type': net_fdb['network_type']}
+            for vtep, entries in net_fdb['ports'].items():
+                for entry in entries:
+                    mac_address = entry[0]
+                    if mac_address == FLOOD_MAC_ADDRESS:
+                        # tunnels on the BIG-IPs get no flooding records
+                        continue
+                    key = (network_id, mac_address, added)
+                    self.retries.pop(key, None)
+                    self._merge(self.queue, key, (network, vtep, entry[1]))
+                    self.stats['staged'] += 1
+
+    def _merge(self, queue, key, value):
+        # Stage an entry in queue, replacing the staged entries it makes
+        # redundant
+        network_id, mac_address, added = key
+        if queue.pop(key, None):
+            self.stats['merged'] += 1
+        other = (network_id, mac_address, not added)
+        # a remove cancels a staged add, but an add only cancels a staged
+        # remove on its own vtep
+        if other in queue and (not added or queue[other][1] == value[1]):
+            del queue[other]
+            self.retries.pop(other, None)
+            self.stats['cancelled'] += 1
+        queue[key] = value
+
+    @staticmethod
+    def _get_fdb(entries):
+        fdb = dict()
+        for (network_id, mac_address, _), (network, vtep, ip_address) in \
+                entries:
+            net_fdb = fdb.setdefault(network_id, dict(network, ports={}))
+            net_fdb['ports'].setdefault(vtep, []).append(
+                [mac_address, ip_address])
+        return fdb
+
+    def flush(self):
+        """Apply all staged fdb entries."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.queue:
+            return
+        queue, self.queue = self.queue, collections.OrderedDict()
+        removed = [item for item in queue.items() if not item[0][2]]
+        added = [item for item in queue.items() if item[0][2]]
+        self.stats['flushes'] += 1
+        failed = []
+        for entries, apply_fdb in ((removed, self.remove_fdb),
+                                   (added, self.add_fdb)):
+            if not entries:
+                continue
+            if failed:
+                # records are removed by mac address, so a remove retried
+                # after an add of the same mac address would undo it
+                failed.extend(entries)
+                continue
+            try:
+                apply_fdb(self._get_fdb(entries))
+            except Exception as exc:
+                LOG.error("Unable to apply %d fdb entries, they are "
+                          "retried: %s" % (len(entries), exc.message))
+                self.stats['errors'] += 1
+                failed.extend(entries)
+                continue
+            self.stats['applied'] += len(entries)
+            for key, _ in entries:
+                self.retries.pop(key, None)
+        if failed:
+            self._requeue(failed)
+
+    def _requeue(self, failed):
+        # Stage failed entries again ahead of the ones staged since, which
+        # are merged into them as if they had been staged afterwards
+        requeued = collections.OrderedDict()
+        for key, value in failed:
+            if key in self.queue:
+                continue
+            retries = self.retries.get(key, 0) + 1
+            if retries > self.max_retries:
+                LOG.error("Dropping the fdb entry of %s in network %s after "
+                          "%d retries" % (key[1], key[0], self.max_retries))
+                self.retries.pop(key, None)
+                self.stats['dropped'] += 1
+                continue
+            self.retries[key] = retries
+            requeued[key] = value
+        self.stats['retried'] += len(requeued)
+        for key, value in self.queue.items():
+            self._merge(requeued, key, value)
+        self.queue = requeued
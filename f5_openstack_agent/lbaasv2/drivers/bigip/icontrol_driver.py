@@ -21,7 +21,6 @@ import logging as std_logging
 import os
 import urllib
 
-from eventlet import greenthread
 from time import strftime
 from time import time
 
@@ -39,6 +38,7 @@ from f5_openstack_agent.lbaasv2.drivers.bigip import constants_v2 as f5const
 from f5_openstack_agent.lbaasv2.drivers.bigip.esd_filehandler import \
     EsdTagProcessor
 from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5ex
+from f5_openstack_agent.lbaasv2.drivers.bigip.fdb_stager import FdbStager
 from f5_openstack_agent.lbaasv2.drivers.bigip.lbaas_builder import \
     LBaaSBuilder
 from f5_openstack_agent.lbaasv2.drivers.bigip.lbaas_driver import \
@@ -51,11 +51,16 @@ from f5_openstack_agent.lbaasv2.drivers.bigip.service_adapter import \
     ServiceModelAdapter
 from f5_openstack_agent.lbaasv2.drivers.bigip import ssl_profile
 from f5_openstack_agent.lbaasv2.drivers.bigip import stat_helper
+from f5_openstack_agent.lbaasv2.drivers.bigip.status_publisher import \
+    StatusPublisher
 from f5_openstack_agent.lbaasv2.drivers.bigip.system_helper import \
     SystemHelper
 from f5_openstack_agent.lbaasv2.drivers.bigip.tenants import \
     BigipTenantManager
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import DeviceFanOut
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import RequestLocal
 from f5_openstack_agent.lbaasv2.drivers.bigip.utils import serialized
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import ServiceQueue
 from f5_openstack_agent.lbaasv2.drivers.bigip.virtual_address import \
     VirtualAddress
 
@@ -65,6 +70,12 @@ LOG = logging.getLogger(__name__)
 NS_PREFIX = 'qlbaas-'
 __VERSION__ = '0.1.1'
 
+# virtual server stats summed into loadbalancer stats
+LOADBALANCER_STAT_KEYS = ['clientside.bitsIn',
+                          'clientside.bitsOut',
+                          'clientside.curConns',
+                          'clientside.totConns']
+
 # configuration objects specific to iControl driver
 # XXX see /etc/neutron/services/f5/f5-openstack-agent.ini
 OPTS = [  # XXX maybe we should make this a dictionary
@@ -302,6 +313,95 @@ OPTS = [  # XXX maybe we should make this a dictionary
         'report_esd_names_in_agent',
         default=False,
         help='whether or not to add valid esd names during report.'
+    ),
+    cfg.IntOpt(
+        'f5_service_queue_workers',
+        default=8,
+        help='Maximum number of service requests provisioned on the '
+        'BIG-IPs concurrently.'
+    ),
+    cfg.StrOpt(
+        'f5_service_queue_scope',
+        default='loadbalancer',
+        choices=['loadbalancer', 'tenant', 'global'],
+        help='Serialize service requests per loadbalancer, per tenant or '
+        'through a single global queue.'
+    ),
+    cfg.BoolOpt(
+        'f5_service_queue_coalesce',
+        default=True,
+        help='Merge queued requests of the same kind for a loadbalancer '
+        'into a single run with the newest service definition.'
+    ),
+    cfg.BoolOpt(
+        'f5_resource_snapshot_cache',
+        default=False,
+        help='Answer BIG-IP object existence checks and loads from '
+        'per-partition collection snapshots refreshed on every resync.'
+    ),
+    cfg.BoolOpt(
+        'f5_incremental_assure',
+        default=True,
+        help='Only assert the objects of a loadbalancer which changed '
+        'since its service definition was last applied. Resyncs always '
+        'assert every object.'
+    ),
+    cfg.IntOpt(
+        'f5_device_timeout',
+        default=300,
+        help='Seconds each BIG-IP is given to complete its part of an '
+        'operation run on all devices concurrently. 0 waits for ever.'
+    ),
+    cfg.BoolOpt(
+        'f5_rest_transactions',
+        default=False,
+        help='Apply the LTM changes of each loadbalancer in one iControl '
+        'REST transaction per device. If a transaction cannot be '
+        'committed the changes are sent again as individual requests.'
+    ),
+    cfg.IntOpt(
+        'f5_stats_collection_interval',
+        default=0,
+        help='Seconds between collections of the stats of all '
+        'loadbalancers of this agent. Each collection reads the virtual '
+        'server stats of every BIG-IP in bulk and sends them to the '
+        'plugin in one batch. 0 disables the collection.'
+    ),
+    cfg.IntOpt(
+        'f5_orphaned_folder_age',
+        default=300,
+        help='Seconds a tenant folder without virtual addresses must stay '
+        'empty before the global agent purges it as orphaned. Protects '
+        'folders of loadbalancers which are being created.'
+    ),
+    cfg.FloatOpt(
+        'f5_status_publish_interval',
+        default=0,
+        help='Seconds between the batches in which object statuses are '
+        'sent to the plugin. Requests then return without waiting for '
+        'the status RPCs, and only the newest queued status of an object '
+        'is sent. 0 sends every status as soon as it is known.'
+    ),
+    cfg.IntOpt(
+        'f5_status_batch_size',
+        default=100,
+        help='Number of queued object statuses which are sent to the '
+        'plugin without waiting for f5_status_publish_interval.'
+    ),
+    cfg.IntOpt(
+        'f5_route_domain_cache_refresh_interval',
+        default=600,
+        help='Seconds between background refreshes of the route domain '
+        'cache from the route domains, vlans, tunnels and selfips of the '
+        'BIG-IPs. The cache is always filled once at startup. 0 disables '
+        'the refresh.'
+    ),
+    cfg.FloatOpt(
+        'f5_fdb_stage_interval',
+        default=0,
+        help='Seconds during which l2population fdb updates are staged '
+        'and merged per network and mac address before being applied to '
+        'the BIG-IPs in bulk. 0 applies each update as it is received.'
     )
 ]
 
@@ -331,6 +431,9 @@ class iControlDriver(LBaaSBaseDriver):
         tuple([f5const.F5_PENDING_CREATE,
                f5const.F5_PENDING_UPDATE])
 
+    # set per request, requests for different loadbalancers run concurrently
+    do_service_update = RequestLocal(True)
+
     def __init__(self, conf, registerOpts=True):
         # The registerOpts parameter allows a test to
         # turn off config option handling so that it can
@@ -382,6 +485,13 @@ class iControlDriver(LBaaSBaseDriver):
         # server helpers
         self.stat_helper = stat_helper.StatHelper()
         self.network_helper = network_helper.NetworkHelper()
+        # (hostname, folder): time a folder was first seen empty
+        self.empty_folders = {}
+        self.stats_collection = {'cycles': 0, 'errors': 0,
+                                 'loadbalancers': 0, 'last_duration': 0,
+                                 'max_duration': 0}
+        self.status_publisher = None
+        self.fdb_stager = None
 
         # f5-sdk helpers
         self.vs_manager = resource_helper.BigIPResourceHelper(
@@ -391,6 +501,15 @@ class iControlDriver(LBaaSBaseDriver):
 
         try:
 
+            # per loadbalancer serialization of service requests
+            self.service_queue = ServiceQueue(
+                self.conf.f5_service_queue_workers,
+                self.conf.f5_service_queue_scope,
+                self.conf.f5_service_queue_coalesce)
+            # operations on all BIG-IPs, f5_device_timeout seconds each
+            self.device_fan_out = DeviceFanOut(
+                timeout=self.conf.f5_device_timeout)
+
             # debug logging of service requests recieved by driver
             if self.conf.trace_service_requests:
                 path = '/var/log/neutron/service/'
@@ -427,6 +546,11 @@ class iControlDriver(LBaaSBaseDriver):
                     self.conf.f5_common_external_networks
                 f5const.FDB_POPULATE_STATIC_ARP = \
                     self.conf.f5_populate_static_arp
+                if self.conf.f5_fdb_stage_interval > 0:
+                    self.fdb_stager = FdbStager(
+                        self._fdb_add, self._fdb_remove,
+                        self.conf.f5_fdb_stage_interval)
+                    self.fdb_stager.start()
 
             # parse the icontrol_hostname setting
             self._init_bigip_hostnames()
@@ -491,7 +615,8 @@ class iControlDriver(LBaaSBaseDriver):
         self.tenant_manager = BigipTenantManager(self.conf, self)
         self.cluster_manager = ClusterManager()
         self.system_helper = SystemHelper()
-        self.lbaas_builder = LBaaSBuilder(self.conf, self)
+        self.lbaas_builder = LBaaSBuilder(
+            self.conf, self, device_fan_out=self.device_fan_out)
 
         if self.conf.f5_global_routed_mode:
             self.network_builder = None
@@ -759,6 +884,9 @@ class iControlDriver(LBaaSBaseDriver):
             bigip.assured_networks = {}
             bigip.assured_tenant_snat_subnets = {}
             bigip.assured_gateway_subnets = []
+            bigip.resource_snapshot = None
+            if self.conf.f5_resource_snapshot_cache:
+                bigip.resource_snapshot = resource_helper.ResourceSnapshot()
 
             if self.conf.f5_ha_type != 'standalone':
                 self.cluster_manager.disable_auto_sync(
@@ -995,6 +1123,23 @@ class iControlDriver(LBaaSBaseDriver):
                 bigip.hostname]['status_message'] = bigip.status_message
             self.agent_configurations['operational'] = \
                 self.operational
+        self.agent_configurations['service_queue'] = \
+            self.service_queue.get_summary()
+        if self.lbaas_builder:
+            self.agent_configurations['service_assure'] = \
+                self.lbaas_builder.get_stats()
+        if self.conf.f5_stats_collection_interval:
+            self.agent_configurations['stats_collection'] = \
+                dict(self.stats_collection)
+        if self.status_publisher:
+            self.agent_configurations['status_publisher'] = \
+                self.status_publisher.get_stats()
+        if self.fdb_stager:
+            self.agent_configurations['fdb_stager'] = \
+                self.fdb_stager.get_stats()
+        if self.network_builder:
+            self.agent_configurations['route_domain_cache'] = \
+                self.network_builder.rd_cache.get_stats()
         LOG.debug('agent configurations are: %s' % self.agent_configurations)
         return dict(self.agent_configurations)
 
@@ -1058,6 +1203,19 @@ class iControlDriver(LBaaSBaseDriver):
     def set_plugin_rpc(self, plugin_rpc):
         # Provide Plugin RPC access
         self.plugin_rpc = plugin_rpc
+        if self.status_publisher:
+            self.status_publisher.stop()
+            self.status_publisher = None
+        if self.conf.f5_status_publish_interval > 0:
+            self.status_publisher = StatusPublisher(
+                plugin_rpc, self.conf.f5_status_publish_interval,
+                self.conf.f5_status_batch_size)
+            self.status_publisher.start()
+
+    @property
+    def status_rpc(self):
+        # object status updates are batched when a publisher is running
+        return getattr(self, 'status_publisher', None) or self.plugin_rpc
 
     def set_tunnel_rpc(self, tunnel_rpc):
         # Provide FDB Connector with ML2 RPC access
@@ -1082,21 +1240,54 @@ class iControlDriver(LBaaSBaseDriver):
             bigip.assured_networks = {}
             bigip.assured_tenant_snat_subnets = {}
             bigip.assured_gateway_subnets = []
+            if getattr(bigip, 'resource_snapshot', None):
+                LOG.debug('flushing resource snapshots of %s: %s'
+                          % (bigip.hostname,
+                             bigip.resource_snapshot.get_stats()))
+                bigip.resource_snapshot.invalidate()
+        if self.lbaas_builder:
+            LOG.debug('flushing service fingerprints: %s'
+                      % self.lbaas_builder.get_stats())
+            self.lbaas_builder.flush_fingerprints()
+
+    @is_operational
+    def get_device_inventory(self):
+        """Read the objects of all tenant partitions of all BIG-IPs."""
+        return resource_helper.DeviceInventory(
+            self.service_adapter.prefix,
+            self.device_fan_out).collect(self.get_all_bigips())
+
+    def _get_deployed_folders(self, bigip, inventory=None):
+        if inventory:
+            return inventory.get_folders(bigip)
+        return self.system_helper.get_folders(bigip)
+
+    def _get_deployed_resources(self, bigip, resource_type, folder,
+                                inventory=None, expand_subcollections=False):
+        if inventory:
+            return inventory.get_resources(bigip, resource_type, folder)
+        return resource_helper.BigIPResourceHelper(
+            resource_type).get_resources(bigip, folder, expand_subcollections)
 
     @serialized('get_all_deployed_loadbalancers')
     @is_operational
-    def get_all_deployed_loadbalancers(self, purge_orphaned_folders=False):
+    def get_all_deployed_loadbalancers(self, purge_orphaned_folders=False,
+                                       inventory=None):
         LOG.debug('getting all deployed loadbalancers on BIG-IPs')
         deployed_lb_dict = {}
+        now = time()
         for bigip in self.get_all_bigips():
-            folders = self.system_helper.get_folders(bigip)
+            folders = self._get_deployed_folders(bigip, inventory)
+            self._forget_empty_folders(bigip, folders)
             for folder in folders:
                 tenant_id = folder[len(self.service_adapter.prefix):]
                 if str(folder).startswith(self.service_adapter.prefix):
                     resource = resource_helper.BigIPResourceHelper(
                         resource_helper.ResourceType.virtual_address)
-                    deployed_lbs = resource.get_resources(bigip, folder)
+                    deployed_lbs = self._get_deployed_resources(
+                        bigip, resource.resource_type, folder, inventory)
                     if deployed_lbs:
+                        self.empty_folders.pop((bigip.hostname, folder), None)
                         for lb in deployed_lbs:
                             lb_id = lb.name[len(self.service_adapter.prefix):]
                             if lb_id in deployed_lb_dict:
@@ -1108,46 +1299,66 @@ class iControlDriver(LBaaSBaseDriver):
                                     'tenant_id': tenant_id,
                                     'hostnames': [bigip.hostname]
                                 }
-                    else:
-                        # delay to assure we are not in the tenant creation
-                        # process before a virtual address is created.
-                        greenthread.sleep(10)
-                        deployed_lbs = resource.get_resources(bigip, folder)
-                        if deployed_lbs:
-                            for lb in deployed_lbs:
-                                lb_id = lb.name[
-                                    len(self.service_adapter.prefix):]
-                                deployed_lb_dict[lb_id] = \
-                                    {'id': lb_id, 'tenant_id': tenant_id}
-                        else:
-                            # Orphaned folder!
-                            if purge_orphaned_folders:
-                                try:
-                                    self.system_helper.purge_folder_contents(
-                                        bigip, folder)
-                                    self.system_helper.purge_folder(
-                                        bigip, folder)
-                                    LOG.error('orphaned folder %s on %s' %
-                                              (folder, bigip.hostname))
-                                except Exception as exc:
-                                    LOG.error('error purging folder %s: %s' %
-                                              (folder, str(exc)))
+                        continue
+
+                    # a folder is only orphaned once it stayed empty for
+                    # a while, loadbalancers being created have folders
+                    # without a virtual address
+                    first_seen = self.empty_folders.setdefault(
+                        (bigip.hostname, folder), now)
+                    empty_for = now - first_seen
+                    if empty_for < self.conf.f5_orphaned_folder_age:
+                        LOG.debug('folder %s on %s is empty for %d seconds'
+                                  % (folder, bigip.hostname, empty_for))
+                        continue
+
+                    # Orphaned folder!
+                    if purge_orphaned_folders:
+                        # the inventory may predate a loadbalancer created
+                        # in the folder since, read the folder again
+                        if inventory and self._get_deployed_resources(
+                                bigip, resource.resource_type, folder):
+                            self.empty_folders.pop(
+                                (bigip.hostname, folder), None)
+                            LOG.debug('folder %s on %s is no longer empty'
+                                      % (folder, bigip.hostname))
+                            continue
+                        try:
+                            self.system_helper.purge_folder_contents(
+                                bigip, folder)
+                            self.system_helper.purge_folder(bigip, folder)
+                            self.empty_folders.pop(
+                                (bigip.hostname, folder), None)
+                            if inventory:
+                                inventory.discard_folder(bigip, folder)
+                            LOG.error('orphaned folder %s on %s' %
+                                      (folder, bigip.hostname))
+                        except Exception as exc:
+                            LOG.error('error purging folder %s: %s' %
+                                      (folder, str(exc)))
         return deployed_lb_dict
 
+    def _forget_empty_folders(self, bigip, folders):
+        # folders deleted since they were seen empty start over if they
+        # are created again
+        for key in list(self.empty_folders):
+            if key[0] == bigip.hostname and key[1] not in folders:
+                del self.empty_folders[key]
+
     @serialized('get_all_deployed_listeners')
     @is_operational
-    def get_all_deployed_listeners(self, expand_subcollections=False):
+    def get_all_deployed_listeners(self, expand_subcollections=False,
+                                   inventory=None):
         LOG.debug('getting all deployed listeners on BIG-IPs')
         deployed_virtual_dict = {}
         for bigip in self.get_all_bigips():
-            folders = self.system_helper.get_folders(bigip)
+            folders = self._get_deployed_folders(bigip, inventory)
             for folder in folders:
                 tenant_id = folder[len(self.service_adapter.prefix):]
                 if str(folder).startswith(self.service_adapter.prefix):
-                    resource = resource_helper.BigIPResourceHelper(
-                        resource_helper.ResourceType.virtual)
-                    deployed_listeners = resource.get_resources(
-                        bigip, folder, expand_subcollections)
+                    deployed_listeners = self._get_deployed_resources(
+                        bigip, resource_helper.ResourceType.virtual, folder,
+                        inventory, expand_subcollections)
                     if deployed_listeners:
                         for virtual in deployed_listeners:
                             virtual_id = \
@@ -1176,8 +1387,9 @@ class iControlDriver(LBaaSBaseDriver):
     def purge_orphaned_nodes(self, tenant_members):
         node_helper = resource_helper.BigIPResourceHelper(
             resource_helper.ResourceType.node)
-        node_dict = dict()
-        for bigip in self.get_all_bigips():
+
+        def purge(bigip):
+            node_dict = dict()
             for tenant_id, members in tenant_members.iteritems():
                 partition = self.service_adapter.prefix + tenant_id
                 nodes = node_helper.get_resources(bigip, partition=partition)
@@ -1198,19 +1410,21 @@ class iControlDriver(LBaaSBaseDriver):
                         if error.response.status_code == 400:
                             LOG.error(error.response)
 
+        self.device_fan_out.map(purge, self.get_all_bigips()).raise_errors()
+
     @serialized('get_all_deployed_pools')
     @is_operational
-    def get_all_deployed_pools(self):
+    def get_all_deployed_pools(self, inventory=None):
         LOG.debug('getting all deployed pools on BIG-IPs')
         deployed_pool_dict = {}
         for bigip in self.get_all_bigips():
-            folders = self.system_helper.get_folders(bigip)
+            folders = self._get_deployed_folders(bigip, inventory)
             for folder in folders:
                 tenant_id = folder[len(self.service_adapter.prefix):]
                 if str(folder).startswith(self.service_adapter.prefix):
-                    resource = resource_helper.BigIPResourceHelper(
-                        resource_helper.ResourceType.pool)
-                    deployed_pools = resource.get_resources(bigip, folder)
+                    deployed_pools = self._get_deployed_resources(
+                        bigip, resource_helper.ResourceType.pool, folder,
+                        inventory)
                     if deployed_pools:
                         for pool in deployed_pools:
                             pool_id = \
@@ -1246,7 +1460,8 @@ class iControlDriver(LBaaSBaseDriver):
                             hostnames=list()):
         node_helper = resource_helper.BigIPResourceHelper(
             resource_helper.ResourceType.node)
-        for bigip in self.get_all_bigips():
+
+        def purge(bigip):
             if bigip.hostname in hostnames:
                 try:
                     pool_name = self.service_adapter.prefix + pool_id
@@ -1256,6 +1471,7 @@ class iControlDriver(LBaaSBaseDriver):
                             bigip, pool_name, partition)
                     members = pool.members_s.get_collection()
                     pool.delete()
+                    self.system_helper.invalidate_snapshot(bigip, partition)
                     for member in members:
                         node_name = member.address
                         try:
@@ -1276,9 +1492,11 @@ class iControlDriver(LBaaSBaseDriver):
                 except Exception as exc:
                     LOG.exception('Exception purging pool %s' % str(exc))
 
+        self.device_fan_out.map(purge, self.get_all_bigips()).raise_errors()
+
     @serialized('get_all_deployed_monitors')
     @is_operational
-    def get_all_deployed_health_monitors(self):
+    def get_all_deployed_health_monitors(self, inventory=None):
         """Retrieve a list of all Health Monitors deployed"""
         LOG.debug('getting all deployed monitors on BIG-IP\'s')
         monitor_types = ['http_monitor', 'https_monitor', 'tcp_monitor',
@@ -1286,17 +1504,16 @@ class iControlDriver(LBaaSBaseDriver):
         deployed_monitor_dict = {}
         adapter_prefix = self.service_adapter.prefix
         for bigip in self.get_all_bigips():
-            folders = self.system_helper.get_folders(bigip)
+            folders = self._get_deployed_folders(bigip, inventory)
             for folder in folders:
                 tenant_id = folder[len(adapter_prefix):]
                 if str(folder).startswith(adapter_prefix):
                     resources = map(
-                        lambda x: resource_helper.BigIPResourceHelper(
-                            getattr(resource_helper.ResourceType, x)),
+                        lambda x: getattr(resource_helper.ResourceType, x),
                         monitor_types)
                     for resource in resources:
-                        deployed_monitors = resource.get_resources(
-                            bigip, folder)
+                        deployed_monitors = self._get_deployed_resources(
+                            bigip, resource, folder, inventory)
                         if deployed_monitors:
                             for monitor in deployed_monitors:
                                 monitor_id = monitor.name[len(adapter_prefix):]
@@ -1323,7 +1540,8 @@ class iControlDriver(LBaaSBaseDriver):
                 resource_helper.ResourceType.https_monitor,
                 resource_helper.ResourceType.ping_monitor,
                 resource_helper.ResourceType.tcp_monitor]]
-        for bigip in self.get_all_bigips():
+
+        def purge(bigip):
             if bigip.hostname in hostnames:
                 try:
                     monitor_name = self.service_adapter.prefix + monitor_id
@@ -1338,6 +1556,7 @@ class iControlDriver(LBaaSBaseDriver):
                             if err.response.status_code == 404:
                                 continue
                     monitor.delete()
+                    self.system_helper.invalidate_snapshot(bigip, partition)
                 except TypeError as err:
                     if 'NoneType' in err:
                         LOG.exception("Could not find monitor {}".format(
@@ -1345,9 +1564,11 @@ class iControlDriver(LBaaSBaseDriver):
                 except Exception as exc:
                     LOG.exception('Exception purging monitor %s' % str(exc))
 
+        self.device_fan_out.map(purge, self.get_all_bigips()).raise_errors()
+
     @serialized('get_all_deployed_l7_policys')
     @is_operational
-    def get_all_deployed_l7_policys(self):
+    def get_all_deployed_l7_policys(self, inventory=None):
         """Retrieve a dict of all l7policies deployed
 
         The dict returned will have the following format:
@@ -1362,14 +1583,13 @@ class iControlDriver(LBaaSBaseDriver):
         LOG.debug('getting all deployed l7_policys on BIG-IP\'s')
         deployed_l7_policys_dict = {}
         for bigip in self.get_all_bigips():
-            folders = self.system_helper.get_folders(bigip)
+            folders = self._get_deployed_folders(bigip, inventory)
             for folder in folders:
                 tenant_id = folder[len(self.service_adapter.prefix):]
                 if str(folder).startswith(self.service_adapter.prefix):
-                    resource = resource_helper.BigIPResourceHelper(
-                        resource_helper.ResourceType.l7policy)
-                    deployed_l7_policys = resource.get_resources(
-                        bigip, folder)
+                    deployed_l7_policys = self._get_deployed_resources(
+                        bigip, resource_helper.ResourceType.l7policy, folder,
+                        inventory)
                     if deployed_l7_policys:
                         for l7_policy in deployed_l7_policys:
                             l7_policy_id = l7_policy.name
@@ -1393,16 +1613,16 @@ class iControlDriver(LBaaSBaseDriver):
     def purge_orphaned_l7_policy(self, tenant_id=None, l7_policy_id=None,
                                  hostnames=list(), listener_id=None):
         """Purge all l7_policys that exist on the BIG-IP but not in Neutron"""
-        for bigip in self.get_all_bigips():
+        if listener_id and self.service_adapter.prefix not in listener_id:
+            listener_id = self.service_adapter.prefix + listener_id
+
+        def purge(bigip):
             if bigip.hostname in hostnames:
                 error = None
                 try:
                     l7_policy_name = l7_policy_id
                     partition = self.service_adapter.prefix + tenant_id
                     if listener_id and partition:
-                        if self.service_adapter.prefix not in listener_id:
-                            listener_id = \
-                                self.service_adapter.prefix + listener_id
                         li_resource = resource_helper.BigIPResourceHelper(
                             resource_helper.ResourceType.virtual).load(
                                 bigip, listener_id, partition)
@@ -1411,6 +1631,7 @@ class iControlDriver(LBaaSBaseDriver):
                         resource_helper.ResourceType.l7policy).load(
                             bigip, l7_policy_name, partition)
                     l7_policy.delete()
+                    self.system_helper.invalidate_snapshot(bigip, partition)
                 except HTTPError as err:
                     if err.response.status_code == 404:
                         LOG.debug('l7_policy %s not on BIG-IP %s.'
@@ -1426,12 +1647,14 @@ class iControlDriver(LBaaSBaseDriver):
                     LOG.exception('Exception: purge_orphaned_l7_policy({}) '
                                   '"{}"'.format(kwargs, exc))
 
+        self.device_fan_out.map(purge, self.get_all_bigips()).raise_errors()
+
     @serialized('purge_orphaned_loadbalancer')
     @is_operational
     @log_helpers.log_method_call
     def purge_orphaned_loadbalancer(self, tenant_id=None,
                                     loadbalancer_id=None, hostnames=list()):
-        for bigip in self.get_all_bigips():
+        def purge(bigip):
             if bigip.hostname in hostnames:
                 try:
                     va_name = self.service_adapter.prefix + loadbalancer_id
@@ -1456,6 +1679,7 @@ class iControlDriver(LBaaSBaseDriver):
                                 pool.delete()
                             else:
                                 vs.delete()
+                    self.system_helper.invalidate_snapshot(bigip, partition)
                     resource_helper.BigIPResourceHelper(
                         resource_helper.ResourceType.virtual_address).delete(
                             bigip, va_name, partition)
@@ -1467,12 +1691,14 @@ class iControlDriver(LBaaSBaseDriver):
                     LOG.exception('Exception purging loadbalancer %s'
                                   % str(exc))
 
+        self.device_fan_out.map(purge, self.get_all_bigips()).raise_errors()
+
     @serialized('purge_orphaned_listener')
     @is_operational
     @log_helpers.log_method_call
     def purge_orphaned_listener(
             self, tenant_id=None, listener_id=None, hostnames=[]):
-        for bigip in self.get_all_bigips():
+        def purge(bigip):
             if bigip.hostname in hostnames:
                 try:
                     listener_name = self.service_adapter.prefix + listener_id
@@ -1481,6 +1707,7 @@ class iControlDriver(LBaaSBaseDriver):
                         resource_helper.ResourceType.virtual).load(
                             bigip, listener_name, partition)
                     listener.delete()
+                    self.system_helper.invalidate_snapshot(bigip, partition)
                 except HTTPError as err:
                     if err.response.status_code == 404:
                         LOG.debug('listener %s not on BIG-IP %s.'
@@ -1488,6 +1715,8 @@ class iControlDriver(LBaaSBaseDriver):
                 except Exception as exc:
                     LOG.exception('Exception purging listener %s' % str(exc))
 
+        self.device_fan_out.map(purge, self.get_all_bigips()).raise_errors()
+
     @serialized('create_loadbalancer')
     @is_operational
     def create_loadbalancer(self, loadbalancer, service):
@@ -1750,25 +1979,13 @@ class iControlDriver(LBaaSBaseDriver):
     @is_operational
     def get_stats(self, service):
         lb_stats = {}
-        stats = ['clientside.bitsIn',
-                 'clientside.bitsOut',
-                 'clientside.curConns',
-                 'clientside.totConns']
         loadbalancer = service['loadbalancer']
 
         try:
             # sum virtual server stats for all BIG-IPs
-            vs_stats = self.lbaas_builder.get_listener_stats(service, stats)
-
-            # convert to bytes
-            lb_stats[f5const.F5_STATS_IN_BYTES] = \
-                vs_stats['clientside.bitsIn']/8
-            lb_stats[f5const.F5_STATS_OUT_BYTES] = \
-                vs_stats['clientside.bitsOut']/8
-            lb_stats[f5const.F5_STATS_ACTIVE_CONNECTIONS] = \
-                vs_stats['clientside.curConns']
-            lb_stats[f5const.F5_STATS_TOTAL_CONNECTIONS] = \
-                vs_stats['clientside.totConns']
+            vs_stats = self.lbaas_builder.get_listener_stats(
+                service, LOADBALANCER_STAT_KEYS)
+            lb_stats = self._loadbalancer_stats(vs_stats)
 
             # update Neutron
             self.plugin_rpc.update_loadbalancer_stats(
@@ -1779,20 +1996,72 @@ class iControlDriver(LBaaSBaseDriver):
         finally:
             return lb_stats
 
+    @is_operational
+    def collect_loadbalancer_stats(self, loadbalancer_ids):
+        """Send the stats of many loadbalancers to Neutron in one batch."""
+        start = time()
+        all_stats = {}
+        try:
+            vs_stats = self.lbaas_builder.get_loadbalancer_stats(
+                loadbalancer_ids, LOADBALANCER_STAT_KEYS)
+            for lb_id, stats in vs_stats.items():
+                all_stats[lb_id] = self._loadbalancer_stats(stats)
+
+            # update Neutron
+            if all_stats:
+                self.plugin_rpc.update_loadbalancers_stats(all_stats)
+        except Exception as e:
+            self.stats_collection['errors'] += 1
+            LOG.error("Error collecting loadbalancer stats: %s", e.message)
+
+        duration = time() - start
+        self.stats_collection['cycles'] += 1
+        self.stats_collection['loadbalancers'] = len(all_stats)
+        self.stats_collection['last_duration'] = round(duration, 3)
+        self.stats_collection['max_duration'] = max(
+            self.stats_collection['max_duration'], round(duration, 3))
+        LOG.debug("collected stats of %d loadbalancers in %.3f seconds",
+                  len(all_stats), duration)
+        return all_stats
+
+    @staticmethod
+    def _loadbalancer_stats(vs_stats):
+        # convert to bytes
+        return {
+            f5const.F5_STATS_IN_BYTES: vs_stats['clientside.bitsIn']/8,
+            f5const.F5_STATS_OUT_BYTES: vs_stats['clientside.bitsOut']/8,
+            f5const.F5_STATS_ACTIVE_CONNECTIONS:
+                vs_stats['clientside.curConns'],
+            f5const.F5_STATS_TOTAL_CONNECTIONS:
+                vs_stats['clientside.totConns']
+        }
+
     def fdb_add(self, fdb):
         # Add (L2toL3) forwarding database entries
-        for bigip in self.get_all_bigips():
-            self.network_builder.add_bigip_fdb(bigip, fdb)
+        if self.fdb_stager:
+            self.fdb_stager.add(fdb)
+        else:
+            self._fdb_add(fdb)
+
+    def _fdb_add(self, fdb):
+        self.device_fan_out.map(self.network_builder.add_bigip_fdb,
+                                self.get_all_bigips(), fdb).raise_errors()
 
     def fdb_remove(self, fdb):
         # Remove (L2toL3) forwarding database entries
-        for bigip in self.get_all_bigips():
-            self.network_builder.remove_bigip_fdb(bigip, fdb)
+        if self.fdb_stager:
+            self.fdb_stager.remove(fdb)
+        else:
+            self._fdb_remove(fdb)
+
+    def _fdb_remove(self, fdb):
+        self.device_fan_out.map(self.network_builder.remove_bigip_fdb,
+                                self.get_all_bigips(), fdb).raise_errors()
 
     def fdb_update(self, fdb):
         # Update (L2toL3) forwarding database entries
-        for bigip in self.get_all_bigips():
-            self.network_builder.update_bigip_fdb(bigip, fdb)
+        self.device_fan_out.map(self.network_builder.update_bigip_fdb,
+                                self.get_all_bigips(), fdb).raise_errors()
 
     def tunnel_update(self, **kwargs):
         # Tunnel Update from Neutron Core RPC
@@ -1844,11 +2113,14 @@ class iControlDriver(LBaaSBaseDriver):
     @is_operational
     def backup_configuration(self):
         # Save Configuration on Devices
-        for bigip in self.get_all_bigips():
+        def save_config(bigip):
             LOG.debug('_backup_configuration: saving device %s.'
                       % bigip.hostname)
             self.cluster_manager.save_config(bigip)
 
+        self.device_fan_out.map(
+            save_config, self.get_all_bigips()).raise_errors()
+
     def _get_monitor_endpoint(self, bigip, service):
         monitor_type = self.service_adapter.get_monitor_type(service)
         if not monitor_type:
@@ -1964,7 +2236,7 @@ class iControlDriver(LBaaSBaseDriver):
             self.network_builder._annotate_service_route_domains(service)
 
         # Foreach bigip in the cluster:
-        for bigip in self.get_config_bigips():
+        def exists(bigip):
             # Does the tenant folder exist?
             if not self.system_helper.folder_exists(bigip, folder_name):
                 LOG.error("Folder %s does not exists on bigip: %s" %
@@ -2051,7 +2323,11 @@ class iControlDriver(LBaaSBaseDriver):
                               (monitor['name'], folder_name, bigip.hostname))
                     return False
 
-        return True
+            return True
+
+        result = self.device_fan_out.map(exists, self.get_config_bigips())
+        result.raise_errors()
+        return all(result.values())
 
     def get_loadbalancers_in_tenant(self, tenant_id):
         loadbalancers = self.plugin_rpc.get_all_loadbalancers()
@@ -2214,17 +2490,17 @@ class iControlDriver(LBaaSBaseDriver):
                         member['provisioning_status'] = f5const.F5_ACTIVE
                         operating_status = f5const.F5_ONLINE
 
-                    self.plugin_rpc.update_member_status(
+                    self.status_rpc.update_member_status(
                         member['id'],
                         member['provisioning_status'],
                         operating_status
                     )
                 elif provisioning_status == f5const.F5_PENDING_DELETE:
                     if not member.get('parent_pool_deleted', False):
-                        self.plugin_rpc.member_destroyed(
+                        self.status_rpc.member_destroyed(
                             member['id'])
                 elif provisioning_status == f5const.F5_ERROR:
-                    self.plugin_rpc.update_member_status(
+                    self.status_rpc.update_member_status(
                         member['id'],
                         f5const.F5_ERROR,
                         f5const.F5_OFFLINE)
@@ -2235,7 +2511,7 @@ class iControlDriver(LBaaSBaseDriver):
             if 'provisioning_status' in health_monitor:
                 provisioning_status = health_monitor['provisioning_status']
                 if provisioning_status in self.positive_plugin_const_state:
-                    self.plugin_rpc.update_health_monitor_status(
+                    self.status_rpc.update_health_monitor_status(
                         health_monitor['id'],
                         f5const.F5_ACTIVE,
                         f5const.F5_ONLINE
@@ -2243,10 +2519,10 @@ class iControlDriver(LBaaSBaseDriver):
                     health_monitor['provisioning_status'] = \
                         f5const.F5_ACTIVE
                 elif provisioning_status == f5const.F5_PENDING_DELETE:
-                    self.plugin_rpc.health_monitor_destroyed(
+                    self.status_rpc.health_monitor_destroyed(
                         health_monitor['id'])
                 elif provisioning_status == f5const.F5_ERROR:
-                    self.plugin_rpc.update_health_monitor_status(
+                    self.status_rpc.update_health_monitor_status(
                         health_monitor['id'])
 
     @log_helpers.log_method_call
@@ -2256,17 +2532,17 @@ class iControlDriver(LBaaSBaseDriver):
             if 'provisioning_status' in pool:
                 provisioning_status = pool['provisioning_status']
                 if provisioning_status in self.positive_plugin_const_state:
-                    self.plugin_rpc.update_pool_status(
+                    self.status_rpc.update_pool_status(
                         pool['id'],
                         f5const.F5_ACTIVE,
                         f5const.F5_ONLINE
                     )
                     pool['provisioning_status'] = f5const.F5_ACTIVE
                 elif provisioning_status == f5const.F5_PENDING_DELETE:
-                    self.plugin_rpc.pool_destroyed(
+                    self.status_rpc.pool_destroyed(
                         pool['id'])
                 elif provisioning_status == f5const.F5_ERROR:
-                    self.plugin_rpc.update_pool_status(pool['id'])
+                    self.status_rpc.update_pool_status(pool['id'])
 
     @log_helpers.log_method_call
     def _update_listener_status(self, service):
@@ -2276,7 +2552,7 @@ class iControlDriver(LBaaSBaseDriver):
             if 'provisioning_status' in listener:
                 provisioning_status = listener['provisioning_status']
                 if provisioning_status in self.positive_plugin_const_state:
-                    self.plugin_rpc.update_listener_status(
+                    self.status_rpc.update_listener_status(
                         listener['id'],
                         f5const.F5_ACTIVE,
                         listener['operating_status']
@@ -2284,10 +2560,10 @@ class iControlDriver(LBaaSBaseDriver):
                     listener['provisioning_status'] = \
                         f5const.F5_ACTIVE
                 elif provisioning_status == f5const.F5_PENDING_DELETE:
-                    self.plugin_rpc.listener_destroyed(
+                    self.status_rpc.listener_destroyed(
                         listener['id'])
                 elif provisioning_status == f5const.F5_ERROR:
-                    self.plugin_rpc.update_listener_status(
+                    self.status_rpc.update_listener_status(
                         listener['id'],
                         provisioning_status,
                         f5const.F5_OFFLINE)
@@ -2299,17 +2575,17 @@ class iControlDriver(LBaaSBaseDriver):
             if 'provisioning_status' in l7rule:
                 provisioning_status = l7rule['provisioning_status']
                 if provisioning_status in self.positive_plugin_const_state:
-                    self.plugin_rpc.update_l7rule_status(
+                    self.status_rpc.update_l7rule_status(
                         l7rule['id'],
                         l7rule['policy_id'],
                         f5const.F5_ACTIVE,
                         f5const.F5_ONLINE
                     )
                 elif provisioning_status == f5const.F5_PENDING_DELETE:
-                    self.plugin_rpc.l7rule_destroyed(
+                    self.status_rpc.l7rule_destroyed(
                         l7rule['id'])
                 elif provisioning_status == f5const.F5_ERROR:
-                    self.plugin_rpc.update_l7rule_status(
+                    self.status_rpc.update_l7rule_status(
                         l7rule['id'], l7rule['policy_id'])
 
     @log_helpers.log_method_call
@@ -2320,17 +2596,17 @@ class iControlDriver(LBaaSBaseDriver):
             if 'provisioning_status' in l7policy:
                 provisioning_status = l7policy['provisioning_status']
                 if provisioning_status in self.positive_plugin_const_state:
-                    self.plugin_rpc.update_l7policy_status(
+                    self.status_rpc.update_l7policy_status(
                         l7policy['id'],
                         f5const.F5_ACTIVE,
                         f5const.F5_ONLINE
                     )
                 elif provisioning_status == f5const.F5_PENDING_DELETE:
                     LOG.debug("calling l7policy_destroyed")
-                    self.plugin_rpc.l7policy_destroyed(
+                    self.status_rpc.l7policy_destroyed(
                         l7policy['id'])
                 elif provisioning_status == f5const.F5_ERROR:
-                    self.plugin_rpc.update_l7policy_status(l7policy['id'])
+                    self.status_rpc.update_l7policy_status(l7policy['id'])
 
     @log_helpers.log_method_call
     def _update_loadbalancer_status(self, service, timed_out=False):
@@ -2354,16 +2630,16 @@ class iControlDriver(LBaaSBaseDriver):
                 loadbalancer['provisioning_status'] = \
                     f5const.F5_ACTIVE
 
-            self.plugin_rpc.update_loadbalancer_status(
+            self.status_rpc.update_loadbalancer_status(
                 loadbalancer['id'],
                 loadbalancer['provisioning_status'],
                 operating_status)
 
         elif provisioning_status == f5const.F5_PENDING_DELETE:
-            self.plugin_rpc.loadbalancer_destroyed(
+            self.status_rpc.loadbalancer_destroyed(
                 loadbalancer['id'])
         elif provisioning_status == f5const.F5_ERROR:
-            self.plugin_rpc.update_loadbalancer_status(
+            self.status_rpc.update_loadbalancer_status(
                 loadbalancer['id'],
                 provisioning_status,
                 f5const.F5_OFFLINE)
@@ -2374,27 +2650,49 @@ class iControlDriver(LBaaSBaseDriver):
 
     @is_operational
     def update_operating_status(self, service):
-        if 'members' in service:
-            if self.network_builder:
-                # append route domain to member address
+        self.update_operating_statuses([service])
+
+    @is_operational
+    def update_operating_statuses(self, services):
+        """Update the member operating status of services in Neutron.
+
+        Only members whose status differs from the one in their service
+        definition are sent, all in one RPC.
+        """
+        services = [service for service in services
+                    if service.get('members')]
+        if self.network_builder:
+            # append route domain to member address
+            annotated = list()
+            for service in services:
                 try:
                     self.network_builder._annotate_service_route_domains(
                         service)
                 except f5ex.InvalidNetworkType as exc:
                     LOG.warning(exc.msg)
-                    return
-
-            # get currrent member status
-            self.lbaas_builder.update_operating_status(service)
+                    continue
+                annotated.append(service)
+            services = annotated
+        if not services:
+            return
 
-            # udpate Neutron
-            for member in service['members']:
-                if member['provisioning_status'] == f5const.F5_ACTIVE:
-                    operating_status = member.get('operating_status', None)
-                    self.plugin_rpc.update_member_status(
-                        member['id'],
-                        provisioning_status=None,
-                        operating_status=operating_status)
+        members = [member for service in services
+                   for member in service['members']
+                   if member['provisioning_status'] == f5const.F5_ACTIVE]
+        previous = dict((member['id'], member.get('operating_status'))
+                        for member in members)
+
+        # get currrent member status
+        self.lbaas_builder.update_operating_statuses(services)
+
+        # udpate Neutron
+        changed = [{'id': member['id'],
+                    'provisioning_status': None,
+                    'operating_status': member.get('operating_status')}
+                   for member in members
+                   if member.get('operating_status') != previous[member['id']]]
+        if changed:
+            self.plugin_rpc.update_members_status(changed)
 
     def get_active_bigip(self):
         bigips = self.get_all_bigips()
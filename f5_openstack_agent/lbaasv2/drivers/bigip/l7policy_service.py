@@ -24,6 +24,7 @@ from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper \
     import BigIPResourceHelper
 from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper \
     import ResourceType
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import DeviceFanOut
 
 
 LOG = logging.getLogger(__name__)
@@ -32,18 +33,18 @@ LOG = logging.getLogger(__name__)
 class L7PolicyService(object):
     """Handles requests to create, update, delete L7 policies on BIG-IPs."""
 
-    def __init__(self, conf):
+    def __init__(self, conf, device_fan_out=None):
         self.conf = conf
+        self.device_fan_out = device_fan_out or DeviceFanOut()
         self.policy_helper = BigIPResourceHelper(ResourceType.l7policy)
 
     def create_l7policy(self, f5_l7policy, bigips):
         LOG.debug("L7PolicyService: create_l7policy")
 
-        error = None
-        for bigip in bigips:
+        def create(bigip):
+            error = None
             try:
                 self.policy_helper.create(bigip, f5_l7policy)
-                error = None
             except HTTPError as err:
                 status_code = err.response.status_code
                 if status_code == 409:
@@ -60,14 +61,15 @@ class L7PolicyService(object):
             if error:
                 LOG.error("L7 policy creation error: %s" %
                           error.message)
+            return error
 
-        return error
+        return self.device_fan_out.map(create, bigips).get_error()
 
     def delete_l7policy(self, f5_l7policy, bigips):
         LOG.debug("L7PolicyService:delete_l7policy")
 
-        error = False
-        for bigip in bigips:
+        def delete(bigip):
+            error = False
             try:
                 self.policy_helper.delete(
                     bigip, f5_l7policy['name'], f5_l7policy['partition'])
@@ -89,8 +91,9 @@ class L7PolicyService(object):
             if error:
                 LOG.error("L7 Policy deletion error: %s",
                           error.message)
+            return error
 
-        return error
+        return self.device_fan_out.map(delete, bigips).get_error() or False
 
     def build_policy(self, l7policy, lbaas_service):
         # build data structure for service adapter input
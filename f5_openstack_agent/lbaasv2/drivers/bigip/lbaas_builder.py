@@ -14,6 +14,10 @@
 # limitations under the License.
 #
 
+import copy
+import hashlib
+import json
+
 from time import time
 
 from oslo_log import log as logging
@@ -24,12 +28,140 @@ from f5_openstack_agent.lbaasv2.drivers.bigip.lbaas_service import \
     LbaasServiceObject
 from f5_openstack_agent.lbaasv2.drivers.bigip import listener_service
 from f5_openstack_agent.lbaasv2.drivers.bigip import pool_service
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    transaction_scope
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import DeviceFanOut
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import RequestLocal
 from f5_openstack_agent.lbaasv2.drivers.bigip import virtual_address
 from requests import HTTPError
 
 LOG = logging.getLogger(__name__)
 
 
+class ServiceDiff(object):
+    """Objects of a service tree that changed since it was last applied.
+
+    Every object the builder asserts is reduced to a digest of its own
+    definition and of the definitions the BIG-IP object is built from,
+    keyed by (kind, id). L7 policies are keyed by their listener id, as
+    they are asserted as one BIG-IP policy per listener.
+
+    applied is the fingerprint recorded after the previous pass for the
+    loadbalancer, or None to assert every object.
+    """
+
+    # attributes which change without the device configuration changing
+    volatile_keys = frozenset(['provisioning_status', 'operating_status',
+                               'created_at', 'updated_at', 'missing',
+                               'parent_pool_deleted', 'f5_policy'])
+
+    def __init__(self, service, applied=None, salt=None):
+        self.fingerprint = self.get_fingerprint(service, salt)
+        self.applied = applied
+        self.confirmed = set()
+        self.failed = set()
+        self.skipped = 0
+
+    @classmethod
+    def digest(cls, obj, *depends):
+        definition = dict((key, value) for key, value in obj.items()
+                          if key not in cls.volatile_keys)
+        return hashlib.md5(json.dumps([definition, depends], sort_keys=True,
+                                      default=str)).hexdigest()
+
+    @classmethod
+    def get_fingerprint(cls, service, salt=None):
+        """Return {(kind, id): digest} for the objects of a service."""
+        fingerprint = dict()
+        loadbalancer = service.get('loadbalancer', None)
+        if not loadbalancer or loadbalancer.get('provisioning_status') == \
+                constants_v2.F5_PENDING_DELETE:
+            return fingerprint
+
+        def present(objects):
+            return [obj for obj in objects
+                    if obj.get('provisioning_status') !=
+                    constants_v2.F5_PENDING_DELETE]
+
+        lb_digest = cls.digest(loadbalancer, salt)
+        fingerprint[('loadbalancer', loadbalancer['id'])] = lb_digest
+
+        for monitor in present(service.get('healthmonitors', list())):
+            fingerprint[('healthmonitor', monitor['id'])] = \
+                cls.digest(monitor, salt)
+
+        pool_members = dict()
+        for member in present(service.get('members', list())):
+            member_digest = cls.digest(member, salt)
+            fingerprint[('member', member['id'])] = member_digest
+            pool_members.setdefault(member.get('pool_id'), list()).append(
+                member_digest)
+
+        # BIG-IP pools carry their member list, listeners only refer to
+        # the settings of their default pool
+        pool_digests = dict()
+        for pool in present(service.get('pools', list())):
+            pool_digests[pool['id']] = cls.digest(pool, salt)
+            fingerprint[('pool', pool['id'])] = cls.digest(
+                pool, salt, sorted(pool_members.get(pool['id'], list())))
+
+        policies = present(service.get('l7policies', list()))
+        rules = present(service.get('l7policy_rules', list()))
+        listener_policies = dict()
+        for listener_id in set(p.get('listener_id') for p in policies):
+            policy_ids = set(p['id'] for p in policies
+                             if p.get('listener_id') == listener_id)
+            listener_policies[listener_id] = cls.digest(
+                dict(), salt,
+                sorted(cls.digest(p) for p in policies
+                       if p['id'] in policy_ids),
+                sorted(cls.digest(r) for r in rules
+                       if r.get('policy_id') in policy_ids))
+            fingerprint[('l7policy', listener_id)] = \
+                listener_policies[listener_id]
+
+        for listener in present(service.get('listeners', list())):
+            fingerprint[('listener', listener['id'])] = cls.digest(
+                listener, lb_digest,
+                pool_digests.get(listener.get('default_pool_id')),
+                listener_policies.get(listener['id']))
+
+        return fingerprint
+
+    def is_changed(self, key):
+        """Return whether the object has to be asserted on the devices."""
+        digest = self.fingerprint.get(key)
+        if self.applied is None or digest is None or \
+                self.applied.get(key) != digest:
+            return True
+        self.confirmed.add(key)
+        self.skipped += 1
+        return False
+
+    def confirm(self, key, error=None):
+        """Record the outcome of asserting an object."""
+        if error:
+            self.failed.add(key)
+        else:
+            self.confirmed.add(key)
+
+    def get_applied(self):
+        """Return the fingerprint of the configuration now on the devices.
+
+        Objects which were not asserted in this pass keep their previous
+        digest, so that they are asserted once their status asks for it.
+        """
+        applied = dict((key, digest)
+                       for key, digest in (self.applied or dict()).items()
+                       if key in self.fingerprint)
+        for key in self.confirmed:
+            if key in self.fingerprint:
+                applied[key] = self.fingerprint[key]
+        for key in self.failed:
+            applied.pop(key, None)
+        return applied
+
+
 class LBaaSBuilder(object):
     # F5 LBaaS Driver using iControl for BIG-IP to
     # create objects (vips, pools) - not using an iApp.
@@ -42,26 +174,47 @@ class LBaaSBuilder(object):
     normal_status = set([constants_v2.F5_PENDING_CREATE,
                          constants_v2.F5_PENDING_UPDATE])
 
-    def __init__(self, conf, driver, l2_service=None):
+    # requests for different loadbalancers share this builder concurrently
+    to_sync = RequestLocal(False)
+    const_status = RequestLocal(normal_status)
+    diff = RequestLocal(None)
+
+    def __init__(self, conf, driver, l2_service=None, device_fan_out=None):
         self.conf = conf
         self.driver = driver
         self.l2_service = l2_service
         self.service_adapter = driver.service_adapter
+        self.device_fan_out = device_fan_out or DeviceFanOut()
         self.listener_builder = listener_service.ListenerServiceBuilder(
             self.service_adapter,
             driver.cert_manager,
-            conf.f5_parent_ssl_profile)
+            conf.f5_parent_ssl_profile,
+            self.device_fan_out)
         self.pool_builder = pool_service.PoolServiceBuilder(
-            self.service_adapter
+            self.service_adapter,
+            self.device_fan_out
         )
-        self.l7service = l7policy_service.L7PolicyService(conf)
+        self.l7service = l7policy_service.L7PolicyService(
+            conf, self.device_fan_out)
         self.esd = None
-
-        # pzhang LBaaSBuilder is not a singleton, no race condition
-        self.to_sync = False
+        # fingerprints of the last applied service tree by loadbalancer id
+        self.fingerprints = dict()
+        self.stats = {'full': 0, 'incremental': 0, 'skipped': 0,
+                      'transactions': 0, 'transaction_fallbacks': 0}
 
     def init_esd(self, esd):
         self.esd = esd
+        # listeners have to pick up changed ESD definitions
+        self.flush_fingerprints()
+
+    def flush_fingerprints(self):
+        """Assert every object of the next service request again."""
+        self.fingerprints.clear()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['loadbalancers'] = len(self.fingerprints)
+        return stats
 
     def is_esd(self, esd):
         return self.esd.is_esd(esd)
@@ -76,6 +229,138 @@ class LBaaSBuilder(object):
         else:
             self.const_status = self.normal_status
 
+        loadbalancer = service.get('loadbalancer', dict())
+        diff = self._get_service_diff(service)
+        self.diff = diff
+        try:
+            if self.conf.f5_rest_transactions:
+                self._assure_service_in_transactions(service,
+                                                     all_subnet_hints)
+            else:
+                self._assure_service_objects(service, all_subnet_hints)
+        except Exception:
+            # the devices may be half way through the change set
+            self.fingerprints.pop(loadbalancer.get('id'), None)
+            raise
+        else:
+            self._record_service_diff(service, self.diff)
+        finally:
+            self.diff = None
+
+        LOG.debug("    _assure_service took %.5f secs" %
+                  (time() - start_time))
+        # pzhang(NOTE): post_service_networking use this
+        return all_subnet_hints
+
+    def _get_service_diff(self, service):
+        """Compare a service with the tree last applied for it.
+
+        Resyncs, and requests for loadbalancers without a recorded tree,
+        assert every object.
+        """
+        lb_id = service.get('loadbalancer', dict()).get('id')
+        applied = None
+        if self.conf.f5_incremental_assure and not self.to_sync:
+            applied = self.fingerprints.get(lb_id, None)
+        salt = sorted(bigip.hostname
+                      for bigip in self.driver.get_config_bigips())
+        diff = ServiceDiff(service, applied, salt)
+        if applied is None:
+            self.stats['full'] += 1
+        else:
+            self.stats['incremental'] += 1
+        return diff
+
+    def _record_service_diff(self, service, diff):
+        lb_id = service.get('loadbalancer', dict()).get('id')
+        applied = diff.get_applied()
+        if applied:
+            self.fingerprints[lb_id] = applied
+        else:
+            self.fingerprints.pop(lb_id, None)
+        self.stats['skipped'] += diff.skipped
+        if diff.skipped:
+            LOG.debug("skipped %d unchanged objects of loadbalancer %s"
+                      % (diff.skipped, lb_id))
+
+    def _is_changed(self, kind, obj_id):
+        diff = self.diff
+        return diff is None or diff.is_changed((kind, obj_id))
+
+    def _confirm(self, kind, obj_id, error=None):
+        diff = self.diff
+        if diff is not None:
+            diff.confirm((kind, obj_id), error)
+
+    def _assure_service_in_transactions(self, service, all_subnet_hints):
+        """Assure a service with one REST transaction per BIG-IP.
+
+        The LTM changes of the pass are queued and committed together at
+        the end. Members are reconciled after the commit, as that reads
+        the pools back from the devices. If a transaction cannot be
+        committed the pass is repeated with individual requests.
+        """
+        bigips = self.driver.get_config_bigips()
+        saved = self._save_service_state(service)
+        saved_hints = copy.deepcopy(all_subnet_hints)
+        saved_diff = copy.deepcopy(self.diff)
+
+        transactions = transaction_scope.begin(bigips, self.device_fan_out)
+        try:
+            self._assure_service_objects(service, all_subnet_hints,
+                                         members=False)
+        except Exception:
+            for transaction in transactions.values():
+                transaction.discard()
+            raise
+        finally:
+            transaction_scope.end()
+
+        result = self.device_fan_out.map(
+            lambda bigip: transactions[bigip.hostname].commit(),
+            [bigip for bigip in bigips if bigip.hostname in transactions])
+        self.stats['transactions'] += len(result.results)
+        if not result.errors:
+            self._assure_members(service, all_subnet_hints)
+            return
+
+        for hostname, err in result.errors.items():
+            LOG.warning("REST transaction for loadbalancer %s failed on "
+                        "%s, sending the changes individually: %s",
+                        service['loadbalancer'].get('id'), hostname,
+                        str(err))
+        self.stats['transaction_fallbacks'] += 1
+        self._restore_service_state(saved)
+        all_subnet_hints.clear()
+        all_subnet_hints.update(saved_hints)
+        self.diff = saved_diff
+        self._assure_service_objects(service, all_subnet_hints)
+
+    @staticmethod
+    def _save_service_state(service):
+        """Return the attributes a pass changes on the service objects."""
+        saved = list()
+        for objects in service.values():
+            if isinstance(objects, dict):
+                objects = [objects]
+            if not isinstance(objects, list):
+                continue
+            for obj in objects:
+                if isinstance(obj, dict):
+                    saved.append((obj, dict(
+                        (key, obj[key]) for key in ServiceDiff.volatile_keys
+                        if key in obj)))
+        return saved
+
+    @staticmethod
+    def _restore_service_state(saved):
+        for obj, values in saved:
+            for key in ServiceDiff.volatile_keys:
+                obj.pop(key, None)
+            obj.update(values)
+
+    def _assure_service_objects(self, service, all_subnet_hints,
+                                members=True):
         LOG.debug("assuring loadbalancers")
 
         self._assure_loadbalancer_created(service, all_subnet_hints)
@@ -88,9 +373,10 @@ class LBaaSBuilder(object):
 
         self._assure_pools_created(service)
 
-        LOG.debug("assuring pool members")
+        if members:
+            LOG.debug("assuring pool members")
 
-        self._assure_members(service, all_subnet_hints)
+            self._assure_members(service, all_subnet_hints)
 
         LOG.debug("assuring l7 policies")
 
@@ -120,11 +406,6 @@ class LBaaSBuilder(object):
 
         self._assure_loadbalancer_deleted(service)
 
-        LOG.debug("    _assure_service took %.5f secs" %
-                  (time() - start_time))
-        # pzhang(NOTE): post_service_networking use this
-        return all_subnet_hints
-
     @staticmethod
     def _set_status_as_active(svc_obj, force=False):
         # If forced, then set to ACTIVE else hold ERROR
@@ -157,17 +438,18 @@ class LBaaSBuilder(object):
         loadbalancer = service["loadbalancer"]
 
         # if self._is_not_pending_delete(loadbalancer):
-        if loadbalancer["provisioning_status"] in self.const_status:
+        if loadbalancer["provisioning_status"] in self.const_status and \
+                self._is_changed('loadbalancer', loadbalancer['id']):
 
             vip_address = virtual_address.VirtualAddress(
                 self.service_adapter,
                 loadbalancer)
-            for bigip in bigips:
-                try:
-                    vip_address.assure(bigip)
-                except Exception as error:
-                    LOG.error(str(error))
-                    self._set_status_as_error(loadbalancer)
+            result = self.device_fan_out.map(vip_address.assure, bigips)
+            for err in result.errors.values():
+                LOG.error(str(err))
+                self._set_status_as_error(loadbalancer)
+            self._confirm('loadbalancer', loadbalancer['id'],
+                          result.get_error())
 
             # pzhang (NOTE): do not set this balancer ACTIVE,
             #                before we really update loadbalancer
@@ -212,8 +494,10 @@ class LBaaSBuilder(object):
                        "networks": networks}
 
                 # create_listener() will do an update if VS exists
-                error = self.listener_builder.create_listener(
-                    svc, bigips)
+                if self._is_changed('listener', listener['id']):
+                    error = self.listener_builder.create_listener(
+                        svc, bigips)
+                    self._confirm('listener', listener['id'], error)
 
                 # pzhang(NOTE): we set target listener ONLINE here
                 if error:
@@ -244,7 +528,10 @@ class LBaaSBuilder(object):
                 svc['members'] = self._get_pool_members(service, pool['id'])
                 svc['healthmonitors'] = monitors
 
-                error = self.pool_builder.create_pool(svc, bigips)
+                error = None
+                if self._is_changed('pool', pool['id']):
+                    error = self.pool_builder.create_pool(svc, bigips)
+                    self._confirm('pool', pool['id'], error)
                 if error:
                     pool['provisioning_status'] = constants_v2.F5_ERROR
                     loadbalancer['provisioning_status'] = constants_v2.F5_ERROR
@@ -269,9 +556,12 @@ class LBaaSBuilder(object):
             svc = {"loadbalancer": loadbalancer,
                    "healthmonitor": monitor}
             if monitor['provisioning_status'] in \
-                    self.const_status:
-                if self.pool_builder.create_healthmonitor(svc, bigips):
+                    self.const_status and \
+                    self._is_changed('healthmonitor', monitor['id']):
+                error = self.pool_builder.create_healthmonitor(svc, bigips)
+                if error:
                     monitor['provisioning_status'] = constants_v2.F5_ERROR
+                self._confirm('healthmonitor', monitor['id'], error)
 
     def _assure_monitors_deleted(self, service):
         monitors = service.get("healthmonitors", [])
@@ -323,11 +613,16 @@ class LBaaSBuilder(object):
         # Assure members by pool
         for pool_id, pool_members in pool_to_member_map.iteritems():
             pool = self.get_pool_by_id(service, pool_id)
+            changed_members = [member for member in pool_members
+                               if self._is_changed('member', member['id'])]
             svc = {"loadbalancer": loadbalancer,
-                   "members": pool_members,
+                   "members": changed_members,
                    "pool": pool}
 
-            self.pool_builder.assure_pool_members(svc, bigips)
+            if changed_members:
+                self.pool_builder.assure_pool_members(svc, bigips)
+            for member in changed_members:
+                self._confirm('member', member['id'], member.get('missing'))
 
             pool_deleted = self._is_pending_delete(pool)
             for member in pool_members:
@@ -361,8 +656,8 @@ class LBaaSBuilder(object):
             self.service_adapter,
             loadbalancer)
 
-        for bigip in bigips:
-            vip_address.assure(bigip, delete=True)
+        self.device_fan_out.map(vip_address.assure, bigips,
+                                delete=True).raise_errors()
 
     def _assure_pools_deleted(self, service):
         if 'pools' not in service:
@@ -473,9 +768,11 @@ class LBaaSBuilder(object):
 
         for listener_id, policy in listener_policy_map.items():
             error = False
-            if policy['f5_policy'].get('rules', list()):
+            if policy['f5_policy'].get('rules', list()) and \
+                    self._is_changed('l7policy', listener_id):
                 error = self.l7service.create_l7policy(
                     policy['f5_policy'], bigips)
+                self._confirm('l7policy', listener_id, error)
 
             for p in service['l7policies']:
                 if error:
@@ -568,23 +865,71 @@ class LBaaSBuilder(object):
 
         return collected_stats
 
+    def get_loadbalancer_stats(self, loadbalancer_ids, stats):
+        """Get statistics for many loadbalancers at once.
+
+        The virtual server stats of each BIG-IP are read in bulk and
+        summed per loadbalancer for all BIG-IPs. Loadbalancers without
+        virtual servers get 0 values.
+
+        :param loadbalancer_ids: ids of the loadbalancers to get stats for.
+        :param stats: array of strings that define which stats to get.
+        :return: dict of loadbalancer id to the sum of the given stats.
+        """
+        collected_stats = {}
+        for lb_id in loadbalancer_ids:
+            collected_stats[lb_id] = dict((stat, 0) for stat in stats)
+
+        result = self.device_fan_out.map(
+            self.listener_builder.get_loadbalancer_stats,
+            self.driver.get_config_bigips(), stats)
+        for device_stats in result.values():
+            for lb_id, lb_stats in device_stats.items():
+                if lb_id not in collected_stats:
+                    continue
+                for stat in stats:
+                    collected_stats[lb_id][stat] += lb_stats[stat]
+
+        # log errors but continue on
+        for hostname, error in result.errors.items():
+            LOG.error("Error getting virtual server stats from %s: %s",
+                      hostname, error.message)
+
+        return collected_stats
+
     def update_operating_status(self, service):
+        self.update_operating_statuses([service])
+
+    def update_operating_statuses(self, services):
+        """Set the operating status of the active members of services.
+
+        The members of all pools of a tenant are read from the active
+        BIG-IP with one request, and mapped back to the service members.
+        """
         bigip = self.driver.get_active_bigip()
-        loadbalancer = service["loadbalancer"]
-        status_keys = ['status.availabilityState',
-                       'status.enabledState']
+        partitions = set(
+            self.service_adapter.get_folder_name(
+                service['loadbalancer']['tenant_id'])
+            for service in services)
+        states = self.pool_builder.get_member_states(bigip, partitions)
 
-        members = service["members"]
-        for member in members:
-            if member['provisioning_status'] == constants_v2.F5_ACTIVE:
-                pool = self.get_pool_by_id(service, member["pool_id"])
-                svc = {"loadbalancer": loadbalancer,
-                       "member": member,
-                       "pool": pool}
-                status = self.pool_builder.get_member_status(
-                    svc, bigip, status_keys)
+        for service in services:
+            loadbalancer = service["loadbalancer"]
+            for member in service.get("members", list()):
+                if member['provisioning_status'] != constants_v2.F5_ACTIVE:
+                    continue
+                pool = self.service_adapter.init_pool_name(
+                    loadbalancer,
+                    self.get_pool_by_id(service, member["pool_id"]))
+                bigip_member = self.service_adapter.get_member(
+                    {"loadbalancer": loadbalancer, "member": member})
+                key = (pool["partition"], pool["name"], bigip_member["name"])
+                if key not in states:
+                    LOG.debug("Unable to get member status. Member %s does "
+                              "not exist.", bigip_member["name"])
+                    continue
                 member['operating_status'] = self.convert_operating_status(
-                    status)
+                    states[key])
 
     @staticmethod
     def convert_operating_status(status):
@@ -13,6 +13,8 @@
 # limitations under the License.
 #
 
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import ServiceQueue
+
 
 class LBaaSBaseDriver(object):
     """Abstract base LBaaS Driver class for interfacing with Agent Manager."""
@@ -25,7 +27,7 @@ class LBaaSBaseDriver(object):
         self.agent_id = None
         self.plugin_rpc = None  # XXX overridden in the only known subclass
         self.connected = False  # XXX overridden in the only known subclass
-        self.service_queue = []
+        self.service_queue = ServiceQueue()
         self.agent_configurations = {}  # XXX overridden in subclass
 
     def set_context(self, context):
@@ -67,6 +69,10 @@ class LBaaSBaseDriver(object):
         """Update pool member operational status from devices to controller."""
         raise NotImplementedError()
 
+    def update_operating_statuses(self, services):
+        """Update the member operational status of many services at once."""
+        raise NotImplementedError()
+
     def recover_errored_devices(self):
         """Trigger attempt to reconnect any errored devices."""
         raise NotImplementedError()
@@ -75,7 +81,16 @@ class LBaaSBaseDriver(object):
         """Get Stats for a loadbalancer Service."""
         raise NotImplementedError()
 
-    def get_all_deployed_loadbalancers(self, purge_orphaned_folders=True):
+    def collect_loadbalancer_stats(self, loadbalancer_ids):
+        """Get Stats for many loadbalancers at once."""
+        raise NotImplementedError()
+
+    def get_device_inventory(self):
+        """Get the objects of all tenant partitions on devices."""
+        raise NotImplementedError()
+
+    def get_all_deployed_loadbalancers(self, purge_orphaned_folders=True,
+                                       inventory=None):
         """Get all Loadbalancers defined on devices."""
         raise NotImplementedError()
 
@@ -135,7 +150,7 @@ class LBaaSBaseDriver(object):
         """LBaaS Delete Health Monitor."""
         raise NotImplementedError()
 
-    def get_all_deployed_health_monitors(self):
+    def get_all_deployed_health_monitors(self, inventory=None):
         """Get listing of all deployed Health Monitors"""
         raise NotImplementedError()
 
@@ -144,7 +159,7 @@ class LBaaSBaseDriver(object):
         """LBaaS Purge Health Monitor."""
         raise NotImplementedError()
 
-    def get_all_deployed_l7_policys(self):
+    def get_all_deployed_l7_policys(self, inventory=None):
         """Get listing of all deployed Health Monitors"""
         raise NotImplementedError()
 
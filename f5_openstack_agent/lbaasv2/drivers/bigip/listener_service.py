@@ -14,10 +14,13 @@
 # limitations under the License.
 #
 
+import copy
+
 from oslo_log import log as logging
 
 from f5_openstack_agent.lbaasv2.drivers.bigip import resource_helper
 from f5_openstack_agent.lbaasv2.drivers.bigip import ssl_profile
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import DeviceFanOut
 from requests import HTTPError
 
 from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
@@ -33,11 +36,15 @@ class ListenerServiceBuilder(object):
     defined in service object to a BIG-IP virtual server.
     """
 
-    def __init__(self, service_adapter, cert_manager, parent_ssl_profile=None):
+    def __init__(self, service_adapter, cert_manager, parent_ssl_profile=None,
+                 device_fan_out=None):
         self.cert_manager = cert_manager
+        self.device_fan_out = device_fan_out or DeviceFanOut()
         self.parent_ssl_profile = parent_ssl_profile
         self.vs_helper = resource_helper.BigIPResourceHelper(
             resource_helper.ResourceType.virtual)
+        self.rule_helper = resource_helper.BigIPResourceHelper(
+            resource_helper.ResourceType.rule)
         self.service_adapter = service_adapter
         LOG.debug("ListenerServiceBuilder: using parent_ssl_profile %s ",
                   parent_ssl_profile)
@@ -63,9 +70,9 @@ class ListenerServiceBuilder(object):
             tls['partition'] = vip['partition']
 
         persist = listener.get("session_persistence", None)
-        error = None
-        for bigip in bigips:
 
+        def create(bigip, vip):
+            error = None
             self.service_adapter.get_vlan(vip, bigip, network_id)
 
             if tls:
@@ -104,7 +111,12 @@ class ListenerServiceBuilder(object):
                 except HTTPError as err:
                     LOG.exception(err.message)
 
-        return error
+            return error
+
+        # vlans and profiles are device specific
+        return self.device_fan_out.map(
+            lambda bigip: create(bigip, copy.deepcopy(vip)),
+            bigips).get_error()
 
     def get_listener(self, service, bigip):
         u"""Retrieve BIG-IP virtual from a single BIG-IP system.
@@ -134,8 +146,8 @@ class ListenerServiceBuilder(object):
             tls['name'] = vip['name']
             tls['partition'] = vip['partition']
 
-        error = None
-        for bigip in bigips:
+        def delete(bigip):
+            error = None
             try:
                 self.vs_helper.delete(bigip,
                                       name=vip["name"],
@@ -159,7 +171,9 @@ class ListenerServiceBuilder(object):
             except HTTPError as err:
                 LOG.exception(err.message)
 
-        return error
+            return error
+
+        return self.device_fan_out.map(delete, bigips).get_error()
 
     def add_ssl_profile(self, tls, vip, bigip):
 
@@ -302,12 +316,13 @@ class ListenerServiceBuilder(object):
         rule_name = 'app_cookie_' + vip['name']
         rule_def = self._create_app_cookie_persist_rule(cookie_name)
 
-        r = bigip.tm.ltm.rules.rule
-        if not r.exists(name=rule_name, partition=vip["partition"]):
+        if not self.rule_helper.exists(bigip, name=rule_name,
+                                       partition=vip["partition"]):
             try:
-                r.create(name=rule_name,
-                         apiAnonymous=rule_def,
-                         partition=vip["partition"])
+                self.rule_helper.create(bigip, {
+                    'name': rule_name,
+                    'apiAnonymous': rule_def,
+                    'partition': vip["partition"]})
                 LOG.debug("Created rule %s" % rule_name)
             except Exception as err:
                 LOG.error("Failed to create rule %s", rule_name)
@@ -360,11 +375,10 @@ class ListenerServiceBuilder(object):
             obj.delete()
             LOG.debug("Deleted persistence universal %s" % rule_name)
 
-        r = bigip.tm.ltm.rules.rule
-        if r.exists(name=rule_name, partition=vip["partition"]):
-            obj = r.load(name=rule_name, partition=vip["partition"])
-            obj.delete()
-            LOG.debug("Deleted rule %s" % rule_name)
+        # deleting a rule which does not exist is a no-op
+        self.rule_helper.delete(bigip, name=rule_name,
+                                partition=vip["partition"])
+        LOG.debug("Deleted rule %s" % rule_name)
 
     def get_stats(self, service, bigips, stat_keys):
         """Return stat values for a single virtual.
@@ -384,19 +398,92 @@ class ListenerServiceBuilder(object):
 
         virtual = self.service_adapter.get_virtual(service)
         part = virtual["partition"]
-        for bigip in bigips:
-            try:
-                vs_stats = self.vs_helper.get_stats(
-                    bigip,
-                    name=virtual["name"],
-                    partition=part,
-                    stat_keys=stat_keys)
-                for stat_key in stat_keys:
-                    if stat_key in vs_stats:
-                        collected_stats[stat_key] += vs_stats[stat_key]
-
-            except Exception as e:
-                # log error but continue on
-                LOG.error("Error getting virtual server stats: %s", e.message)
+        result = self.device_fan_out.map(
+            self.vs_helper.get_stats, bigips, name=virtual["name"],
+            partition=part, stat_keys=stat_keys)
+        for vs_stats in result.values():
+            for stat_key in stat_keys:
+                if stat_key in vs_stats:
+                    collected_stats[stat_key] += vs_stats[stat_key]
+
+        # log errors but continue on
+        for e in result.errors.values():
+            LOG.error("Error getting virtual server stats: %s", e.message)
+
+        return collected_stats
+
+    def get_loadbalancer_stats(self, bigip, stat_keys):
+        """Return stat values of all virtuals on a BIG-IP by loadbalancer.
+
+        The stats of all virtual servers and the configuration of all
+        virtual addresses are each read with one request. The stats of
+        every virtual are added to the loadbalancer that owns the virtual
+        address of its destination.
+
+        :param bigip: BIG-IP to get the virtual server stats from.
+        :param stat_keys: Array of strings that define which stats to collect.
+        :return: A dict of loadbalancer id to a dict with key/value pairs
+        for each stat defined in input stats.
+        """
+        uri = bigip._meta_data['uri']
+        addresses = bigip.icrs.get(uri + 'ltm/virtual-address').json()
+        loadbalancers = self._virtual_address_index(
+            addresses.get('items', []))
+
+        collected_stats = {}
+        vs_stats = bigip.icrs.get(uri + 'ltm/virtual/stats').json()
+        for entries in _stat_entries(vs_stats):
+            tm_name = entries.get('tmName', {}).get('description', '')
+            destination = entries.get('destination', {}).get('description')
+            if not destination:
+                continue
+            partition = tm_name.split('/')[1] if '/' in tm_name else ''
+            lb_id = loadbalancers.get(
+                (partition, _destination_address(destination)))
+            if not lb_id:
+                continue
+
+            lb_stats = collected_stats.setdefault(
+                lb_id, dict((stat_key, 0) for stat_key in stat_keys))
+            for stat_key in stat_keys:
+                lb_stats[stat_key] += entries.get(
+                    stat_key, {}).get('value', 0)
 
         return collected_stats
+
+    def _virtual_address_index(self, addresses):
+        # a virtual destination names either the virtual address or its
+        # address, so both lead to the loadbalancer id
+        prefix = self.service_adapter.prefix
+        index = {}
+        for address in addresses:
+            name = address.get('name', '')
+            if not name.startswith(prefix):
+                continue
+            partition = address.get('partition', '')
+            lb_id = name[len(prefix):]
+            index[(partition, name)] = lb_id
+            index[(partition, address.get('address'))] = lb_id
+        return index
+
+
+def _stat_entries(stats):
+    # BIG-IP 12.1 and later nest the stats of each object in nestedStats,
+    # 11.6 returns them directly
+    for value in stats.get('entries', {}).values():
+        entries = value.get('nestedStats', {}).get('entries')
+        if entries is None:
+            continue
+        if 'tmName' not in entries:
+            for nested in entries.values():
+                if 'nestedStats' in nested:
+                    entries = nested['nestedStats']['entries']
+        yield entries
+
+
+def _destination_address(destination):
+    # /Project_1/10.0.0.5%2:80 or /Project_1/2001:db8::5%2.80
+    destination = destination.split('/')[-1]
+    if destination.count(':') > 1:
+        return destination.rsplit('.', 1)[0]
+    return destination.rsplit(':', 1)[0]
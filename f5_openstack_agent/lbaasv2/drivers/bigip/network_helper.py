@@ -13,11 +13,13 @@
 # limitations under the License.
 #
 
+import collections
 import constants_v2 as const
 import netaddr
 import os
 import urllib
 
+from eventlet import semaphore
 from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
 from requests.exceptions import HTTPError
@@ -29,6 +31,121 @@ from f5_openstack_agent.lbaasv2.drivers.bigip.utils import get_filter
 LOG = logging.getLogger(__name__)
 
 
+class RouteDomainIdAllocator(object):
+    """Allocate route domain ids from a bitmap of the ids in use.
+
+    The bitmap is seeded from the route domains on the bigips before the
+    first allocation, then kept up to date as route domains are created
+    and deleted, so allocating an id costs no REST calls. Allocations are
+    serialized, so tenants created at the same time get different ids.
+    An id is only freed once no bigip holds its route domain anymore.
+    """
+
+    def __init__(self, max_id=const.MAX_ROUTE_DOMAIN_ID):
+        self.max_id = max_id
+        self.bitmap = bytearray(max_id // 8 + 1)
+        # the bigip hostnames holding a route domain, by id
+        self.holders = {}
+        # no id below this one is free
+        self.lowest_free = 1
+        self.seeded = False
+        self.lock = semaphore.Semaphore()
+        self.reserve(const.DEFAULT_ROUTE_DOMAIN_ID)
+
+    def in_use(self, rd_id):
+        return bool(self.bitmap[rd_id >> 3] & (1 << (rd_id & 7)))
+
+    def reserve(self, rd_id, holder=None):
+        if isinstance(rd_id, int) and 0 <= rd_id <= self.max_id:
+            self.bitmap[rd_id >> 3] |= 1 << (rd_id & 7)
+            if holder:
+                self.holders.setdefault(rd_id, set()).add(holder)
+
+    def release(self, rd_id, holder=None):
+        if isinstance(rd_id, int) and 0 < rd_id <= self.max_id:
+            holders = self.holders.get(rd_id)
+            if holders:
+                holders.discard(holder)
+                if holders:
+                    # another bigip still has the route domain
+                    return
+                del self.holders[rd_id]
+            self.bitmap[rd_id >> 3] &= ~(1 << (rd_id & 7)) & 0xff
+            self.lowest_free = min(self.lowest_free, rd_id)
+
+    def seed(self, bigip_rd_ids):
+        """Reserve the ids listed from the bigips, by bigip hostname."""
+        for holder, rd_ids in bigip_rd_ids.items():
+            for rd_id in rd_ids:
+                self.reserve(rd_id, holder)
+        self.seeded = True
+
+    def invalidate(self):
+        """Reload the ids from the bigips before the next allocation.
+
+        Route domains created outside of this agent, for example by
+        another agent managing the same bigips, are not in the bitmap
+        until then. Ids already reserved are kept.
+        """
+        self.seeded = False
+
+    def allocate(self, list_ids):
+        """Reserve and return the lowest free id.
+
+        list_ids returns the ids in use on the bigips by bigip hostname,
+        and is only called when the bitmap needs seeding.
+        """
+        with self.lock:
+            if not self.seeded:
+                self.seed(list_ids())
+            rd_id = self.lowest_free
+            while rd_id <= self.max_id:
+                if self.bitmap[rd_id >> 3] == 0xff:
+                    # skip the eight ids of a full byte
+                    rd_id = (rd_id | 7) + 1
+                elif self.in_use(rd_id):
+                    rd_id += 1
+                else:
+                    break
+            else:
+                raise LookupError("No route domain id is available")
+            self.reserve(rd_id)
+            self.lowest_free = rd_id + 1
+            return rd_id
+
+
+# route domain ids are global to the bigips, so every NetworkHelper
+# allocates from the same bitmap
+route_domain_ids = RouteDomainIdAllocator()
+
+
+class KeyedSemaphore(object):
+    """Semaphores by key, kept while a greenthread holds or awaits one."""
+
+    def __init__(self):
+        # key: [semaphore, number of greenthreads holding or awaiting it]
+        self.semaphores = {}
+
+    def acquire(self, key):
+        entry = self.semaphores.get(key)
+        if entry is None:
+            entry = self.semaphores[key] = [semaphore.Semaphore(), 0]
+        entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, key):
+        entry = self.semaphores[key]
+        entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del self.semaphores[key]
+
+
+# the records of a tunnel are read and written back whole, so the
+# updates of a tunnel are serialized across every NetworkHelper
+tunnel_records_locks = KeyedSemaphore()
+
+
 class NetworkHelper(object):
 
     l2gre_multipoint_profile_defaults = {
@@ -280,23 +397,13 @@ class NetworkHelper(object):
     @log_helpers.log_method_call
     def get_next_domain_id(self, bigips):
         """Get next route domain id """
-        rd_ids = []
-        for bigip in bigips:
-            rd_ids += self.get_route_domain_ids(bigip, partition='')
-        rd_ids = sorted(set(rd_ids))
-        rd_ids.remove(0)
-
-        lowest_available_index = 1
-        for i in range(len(rd_ids)):
-            if lowest_available_index < rd_ids[i]:
-                break
-            elif rd_ids[i] == lowest_available_index:
-                lowest_available_index = lowest_available_index + 1
-            else:
-                raise LookupError(
-                    "The list of route domain ids is out of order")
+        def list_ids():
+            return dict(
+                (bigip.hostname,
+                 self.get_route_domain_ids(bigip, partition=''))
+                for bigip in bigips)
 
-        return lowest_available_index
+        return route_domain_ids.allocate(list_ids)
 
     @log_helpers.log_method_call
     def create_route_domain(self, bigip, rd_id,
@@ -332,7 +439,14 @@ class NetworkHelper(object):
             payload['strict'] = 'enabled'
         else:
             payload['parent'] = '/' + const.DEFAULT_PARTITION + '/0'
-        return rd.create(**payload)
+        try:
+            obj = rd.create(**payload)
+        except HTTPError:
+            # the id may be taken by a route domain we do not know about
+            route_domain_ids.invalidate()
+            raise
+        route_domain_ids.reserve(rd_id, bigip.hostname)
+        return obj
 
     @log_helpers.log_method_call
     def delete_route_domain(self, bigip, partition=const.DEFAULT_PARTITION,
@@ -356,7 +470,10 @@ class NetworkHelper(object):
                 name = partition
         r = bigip.tm.net.route_domains.route_domain
         obj = r.load(name=name, partition=partition)
+        # a deleted resource loses its attributes
+        rd_id = obj.id
         obj.delete()
+        route_domain_ids.release(rd_id, bigip.hostname)
 
     @log_helpers.log_method_call
     def get_route_domain_ids(self, bigip, partition=const.DEFAULT_PARTITION):
@@ -730,73 +847,55 @@ class NetworkHelper(object):
 
         return node_addrs
 
-    @log_helpers.log_method_call
-    def add_fdb_entry(
-            self,
-            bigip,
-            tunnel_name,
-            mac_address=None,
-            vtep_ip_address=None,
-            arp_ip_address=None,
-            partition=const.DEFAULT_PARTITION):
-
+    def modify_fdb_records(self, bigip, tunnel_name, add=None, remove=None,
+                           remove_all=False,
+                           partition=const.DEFAULT_PARTITION):
+        """Change the records of a tunnel with one PATCH of its records.
+
+        The tunnel is loaded once and the changes are applied to its
+        current records: add maps mac addresses to their vtep endpoint,
+        remove lists mac addresses, and remove_all drops every record.
+        The records are only sent when they differ from the current ones.
+        Returns the mac addresses which were not records of the tunnel
+        before, or None if the tunnel does not exist. The changes to a
+        tunnel are serialized, so concurrent updates keep each other's
+        records.
+        """
+        key = (bigip.hostname, partition, tunnel_name)
+        tunnel_records_locks.acquire(key)
         try:
-            tunnel = bigip.tm.net.fdb.tunnels.tunnel
-            if tunnel.exists(name=tunnel_name, partition=partition):
-                obj = tunnel.load(name=tunnel_name, partition=partition)
-                if not obj.records_s.records.exists(name=mac_address):
-                    obj.records_s.records.create(
-                        name=mac_address, endpoint=vtep_ip_address)
-                    if const.FDB_POPULATE_STATIC_ARP:
-                        # arp_ip_address is typcially member address.
-                        if arp_ip_address:
-                            try:
-                                LOG.debug("Creating ARP with IP address %s and"
-                                          "MAC addess %s" % (arp_ip_address,
-                                                             mac_address))
-                                arp = bigip.tm.net.arps.arp
-                                arp.create(ipAddress=arp_ip_address,
-                                           macAddress=mac_address,
-                                           partition=partition,
-                                           name=mac_address)
-                            except Exception as e:
-                                LOG.error('add_fdb_entry',
-                                          'could not create static arp: %s'
-                                          % e.message)
-                                return False
-                return True
-            else:
-                LOG.debug("Tunnel %s does not exist." % tunnel_name)
-        except HTTPError as err:
-            LOG.error("Error checking tunnel %s. "
-                      "Repsponse status code: %s. Response "
-                      "message: %s." % (tunnel_name,
-                                        err.response.status_code,
-                                        err.message))
-        return False
-
-    @log_helpers.log_method_call
-    def delete_fdb_entry(
-            self,
-            bigip,
-            mac_address=None,
-            tunnel_name=None,
-            arp_ip_address=None,
-            partition=const.DEFAULT_PARTITION):
-
-        if const.FDB_POPULATE_STATIC_ARP and arp_ip_address:
-            self.arp_delete(bigip,
-                            ip_address=arp_ip_address,
-                            partition=partition)
+            try:
+                obj = bigip.tm.net.fdb.tunnels.tunnel.load(
+                    name=tunnel_name, partition=partition)
+            except HTTPError as err:
+                if err.response.status_code == 404:
+                    LOG.debug("Tunnel %s does not exist." % tunnel_name)
+                    return None
+                raise
+
+            current = collections.OrderedDict(
+                (record['name'], record['endpoint'])
+                for record in getattr(obj, 'records', None) or [])
+            records = collections.OrderedDict()
+            if not remove_all:
+                records.update(current)
+                for mac_address in remove or []:
+                    records.pop(mac_address, None)
+            records.update(add or {})
+
+            if records != current:
+                obj.modify(records=[
+                    {'name': mac_address, 'endpoint': endpoint}
+                    for mac_address, endpoint in records.items()])
+            return [mac_address for mac_address in records
+                    if mac_address not in current]
+        finally:
+            tunnel_records_locks.release(key)
+
+    def _update_fdb_records(self, bigip, tunnel_name, **kwargs):
+        # modify_fdb_records, logging the errors of the bigip
         try:
-            tunnel = bigip.tm.net.fdb.tunnels.tunnel
-            if tunnel.exists(name=tunnel_name, partition=partition):
-                obj = tunnel.load(name=tunnel_name, partition=partition)
-                r = obj.records_s.records
-                if r.exists(name=mac_address):
-                    r = r.load(name=mac_address)
-                    r.delete()
-
+            return self.modify_fdb_records(bigip, tunnel_name, **kwargs)
         except HTTPError as err:
             LOG.error("Error updating tunnel %s. "
                       "Repsponse status code: %s. Response "
@@ -804,36 +903,46 @@ class NetworkHelper(object):
                                         err.response.status_code,
                                         err.message))
 
+    def _create_fdb_arp(self, bigip, mac_address, ip_address, partition):
+        # the static arp entry of a mac address added to a tunnel
+        try:
+            LOG.debug("Creating ARP with IP address %s and"
+                      "MAC addess %s" % (ip_address, mac_address))
+            arp = bigip.tm.net.arps.arp
+            arp.create(ipAddress=ip_address,
+                       macAddress=mac_address,
+                       partition=partition,
+                       name=mac_address)
+        except Exception as e:
+            LOG.error('could not create static arp: %s' % e.message)
+
     @log_helpers.log_method_call
     def add_fdb_entries(self, bigip, fdb_entries=None):
         # Add vxlan fdb entries
         for tunnel_name in fdb_entries:
             folder = fdb_entries[tunnel_name]['folder']
             tunnel_records = fdb_entries[tunnel_name]['records']
-            for mac in tunnel_records:
-                record = tunnel_records[mac]
-                ip_address = record['ip_address']
-                if ip_address == '0.0.0.0':
-                    ip_address = ''
-                self.add_fdb_entry(
-                    bigip,
-                    tunnel_name,
-                    mac_address=mac,
-                    vtep_ip_address=record['endpoint'],
-                    arp_ip_address=ip_address,
-                    partition=folder)
+            added = self._update_fdb_records(
+                bigip, tunnel_name,
+                add=dict((mac, record['endpoint'])
+                         for mac, record in tunnel_records.items()),
+                partition=folder)
+            if not const.FDB_POPULATE_STATIC_ARP:
+                continue
+            for mac in added or []:
+                # the ip address is typically a member address
+                ip_address = tunnel_records[mac]['ip_address']
+                if ip_address and ip_address != '0.0.0.0':
+                    self._create_fdb_arp(bigip, mac, ip_address, folder)
 
     @log_helpers.log_method_call
     def delete_fdb_entries(self, bigip, fdb_entries=None):
         for tunnel_name in fdb_entries:
             folder = fdb_entries[tunnel_name]['folder']
             tunnel_records = fdb_entries[tunnel_name]['records']
-            for mac in tunnel_records:
-                self.delete_fdb_entry(
-                    bigip,
-                    tunnel_name=tunnel_name,
-                    mac_address=mac,
-                    partition=folder)
+            self._update_fdb_records(
+                bigip, tunnel_name, remove=list(tunnel_records),
+                partition=folder)
 
     @log_helpers.log_method_call
     def get_fdb_entry(self,
@@ -870,16 +979,8 @@ class NetworkHelper(object):
             tunnel_name,
             partition=const.DEFAULT_PARTITION):
         """Delete all fdb entries."""
-        try:
-            t = bigip.tm.net.fdb.tunnels.tunnel
-            obj = t.load(name=tunnel_name, partition=partition)
-            obj.modify(records=None)
-        except HTTPError as err:
-            LOG.error("Error deleting all fdb entries %s. "
-                      "Repsponse status code: %s. Response "
-                      "message: %s." % (tunnel_name,
-                                        err.response.status_code,
-                                        err.message))
+        self._update_fdb_records(
+            bigip, tunnel_name, remove_all=True, partition=partition)
 
     @log_helpers.log_method_call
     def delete_tunnel(
@@ -16,8 +16,10 @@
 import itertools
 import netaddr
 from requests import HTTPError
+from time import time
 
 from oslo_log import log as logging
+from oslo_service import loopingcall
 
 from f5_openstack_agent.lbaasv2.drivers.bigip import constants_v2
 from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
@@ -25,6 +27,8 @@ from f5_openstack_agent.lbaasv2.drivers.bigip.l2_service import \
     L2ServiceBuilder
 from f5_openstack_agent.lbaasv2.drivers.bigip.network_helper import \
     NetworkHelper
+from f5_openstack_agent.lbaasv2.drivers.bigip.network_helper import \
+    route_domain_ids
 from f5_openstack_agent.lbaasv2.drivers.bigip import resource_helper
 from f5_openstack_agent.lbaasv2.drivers.bigip.selfips import BigipSelfIpManager
 from f5_openstack_agent.lbaasv2.drivers.bigip.snats import BigipSnatManager
@@ -33,6 +37,131 @@ from f5_openstack_agent.lbaasv2.drivers.bigip.utils import strip_domain_address
 LOG = logging.getLogger(__name__)
 
 
+class RouteDomainCache(object):
+    """Route domain subnet cache with indexes by network and subnet.
+
+    tenants holds the nested rds_cache layout described with
+    NetworkServiceBuilder.update_rds_cache. networks maps each network
+    short name to {tenant_id: route domain id} and subnets maps each
+    subnet id to its network short name, so lookups and removals do not
+    walk every tenant and route domain.
+    """
+
+    def __init__(self, tenants=None):
+        self.tenants = {}
+        self.networks = {}
+        self.subnets = {}
+        self.stats = {'hits': 0, 'misses': 0, 'rebuilds': 0, 'warmups': 0}
+        # sets collecting the subnets removed while they are tracked
+        self.removals = []
+        self.update(tenants or {})
+
+    def update(self, tenants, removed=()):
+        """Add the entries of a nested rds_cache layout.
+
+        Subnets in removed are left out, and so are the networks and
+        route domains which had no other subnet.
+        """
+        for tenant_id, route_domains in tenants.items():
+            self.add_tenant(tenant_id)
+            for route_domain_id, networks in route_domains.items():
+                if not networks:
+                    self.add_route_domain(tenant_id, route_domain_id)
+                for net_short_name, net_entry in networks.items():
+                    subnets = net_entry.get('subnets', {})
+                    kept = [(subnet_id, subnet)
+                            for subnet_id, subnet in subnets.items()
+                            if subnet_id not in removed]
+                    if subnets and not kept:
+                        continue
+                    self.add_network(tenant_id, route_domain_id,
+                                     net_short_name)
+                    for subnet_id, subnet in kept:
+                        self.add_subnet(tenant_id, route_domain_id,
+                                        net_short_name, subnet_id,
+                                        subnet['cidr'])
+
+    def track_removals(self):
+        """Return a set which collects the subnets removed from now on."""
+        removed = set()
+        self.removals.append(removed)
+        return removed
+
+    def untrack_removals(self, removed):
+        self.removals.remove(removed)
+
+    def has_tenant(self, tenant_id):
+        return tenant_id in self.tenants
+
+    def add_tenant(self, tenant_id):
+        return self.tenants.setdefault(tenant_id, {})
+
+    def add_route_domain(self, tenant_id, route_domain_id):
+        return self.add_tenant(tenant_id).setdefault(route_domain_id, {})
+
+    def add_network(self, tenant_id, route_domain_id, net_short_name):
+        rd_entry = self.add_route_domain(tenant_id, route_domain_id)
+        self.networks.setdefault(net_short_name, {})[tenant_id] = \
+            route_domain_id
+        return rd_entry.setdefault(net_short_name, {'subnets': {}})
+
+    def add_subnet(self, tenant_id, route_domain_id, net_short_name,
+                   subnet_id, cidr):
+        net_entry = self.add_network(tenant_id, route_domain_id,
+                                     net_short_name)
+        net_entry['subnets'][subnet_id] = {'cidr': cidr}
+        self.subnets[subnet_id] = net_short_name
+
+    def get_route_domain(self, net_short_name):
+        """Return the route domain id of a network, or None."""
+        tenants = self.networks.get(net_short_name)
+        if not tenants:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return next(iter(tenants.values()))
+
+    def get_subnet_route_domain(self, tenant_id, subnet_id):
+        """Return the route domain id of a tenant's subnet, or None."""
+        net_short_name = self.subnets.get(subnet_id)
+        route_domain_id = self.networks.get(net_short_name, {}).get(
+            tenant_id)
+        if route_domain_id is None:
+            self.stats['misses'] += 1
+        else:
+            self.stats['hits'] += 1
+        return route_domain_id
+
+    def remove_subnet(self, net_short_name, subnet_id):
+        """Remove a subnet, and its network and route domain once empty."""
+        for removed in self.removals:
+            removed.add(subnet_id)
+        tenants = self.networks.get(net_short_name, {})
+        for tenant_id, route_domain_id in list(tenants.items()):
+            tenant_entry = self.tenants[tenant_id]
+            rd_entry = tenant_entry[route_domain_id]
+            net_subnets = rd_entry[net_short_name]['subnets']
+            net_subnets.pop(subnet_id, None)
+            if not net_subnets:
+                del rd_entry[net_short_name]
+                del tenants[tenant_id]
+            if not rd_entry:
+                LOG.debug("removing route domain %d from tenant %s" %
+                          (route_domain_id, tenant_id))
+                del tenant_entry[route_domain_id]
+        if not tenants:
+            self.networks.pop(net_short_name, None)
+        if self.subnets.get(subnet_id) == net_short_name:
+            del self.subnets[subnet_id]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['tenants'] = len(self.tenants)
+        stats['networks'] = len(self.networks)
+        stats['subnets'] = len(self.subnets)
+        return stats
+
+
 class NetworkServiceBuilder(object):
 
     def __init__(self, f5_global_routed_mode, conf, driver, l3_binding=None):
@@ -49,16 +178,38 @@ class NetworkServiceBuilder(object):
 
         self.vlan_manager = resource_helper.BigIPResourceHelper(
             resource_helper.ResourceType.vlan)
-        self.rds_cache = {}
+        self.tunnel_manager = resource_helper.BigIPResourceHelper(
+            resource_helper.ResourceType.tunnel)
+        self.selfip_manager = resource_helper.BigIPResourceHelper(
+            resource_helper.ResourceType.selfip)
+        self.route_domain_manager = resource_helper.BigIPResourceHelper(
+            resource_helper.ResourceType.route_domain)
+        self.rd_cache = RouteDomainCache()
+        self.rd_cache_timer = None
         self.interface_mapping = self.l2_service.interface_mapping
         self.network_helper = NetworkHelper(conf=self.conf)
         self.service_adapter = self.driver.service_adapter
 
+    @property
+    def rds_cache(self):
+        return self.rd_cache.tenants
+
+    @rds_cache.setter
+    def rds_cache(self, tenants):
+        self.rd_cache = RouteDomainCache(tenants)
+
     def post_init(self):
         # Run and Post Initialization Tasks
         # run any post initialized tasks, now that the agent
         # is fully connected
         self.l2_service.post_init()
+        self.warm_rds_cache()
+        interval = self.conf.f5_route_domain_cache_refresh_interval
+        if interval > 0 and not self.rd_cache_timer:
+            self.rd_cache_timer = loopingcall.FixedIntervalLoopingCall(
+                self.warm_rds_cache)
+            self.rd_cache_timer.start(interval=interval,
+                                      initial_delay=interval)
 
     def tunnel_sync(self, tunnel_ips):
         self.l2_service.tunnel_sync(tunnel_ips)
@@ -268,6 +419,9 @@ class NetworkServiceBuilder(object):
         return self.l2_service.is_common_network(network)
 
     def find_subnet_route_domain(self, tenant_id, subnet_id):
+        rd_id = self.rd_cache.get_subnet_route_domain(tenant_id, subnet_id)
+        if rd_id is not None:
+            return rd_id
         rd_id = 0
         bigip = self.driver.get_bigip()
         partition_id = self.service_adapter.get_folder_name(
@@ -340,20 +494,17 @@ class NetworkServiceBuilder(object):
             if (len(self.rds_cache[tenant_id]) <
                     self.conf.max_namespaces_per_tenant):
                 placed_route_domain_id = self._create_aux_rd(tenant_id)
-                self.rds_cache[tenant_id][placed_route_domain_id] = {}
+                self.rd_cache.add_route_domain(tenant_id,
+                                               placed_route_domain_id)
                 LOG.debug("Tenant %s now has %d route domains" %
                           (tenant_id, len(self.rds_cache[tenant_id])))
             else:
                 raise Exception("Cannot allocate route domain")
 
         LOG.debug("Placed in route domain %s" % placed_route_domain_id)
-        rd_entry = self.rds_cache[tenant_id][placed_route_domain_id]
-
         net_short_name = self.get_neutron_net_short_name(network)
-        if net_short_name not in rd_entry:
-            rd_entry[net_short_name] = {'subnets': {}}
-        net_subnets = rd_entry[net_short_name]['subnets']
-        net_subnets[subnet['id']] = {'cidr': check_cidr}
+        self.rd_cache.add_subnet(tenant_id, placed_route_domain_id,
+                                 net_short_name, subnet['id'], check_cidr)
         network['route_domain_id'] = placed_route_domain_id
 
     def _create_aux_rd(self, tenant_id):
@@ -399,12 +550,14 @@ class NetworkServiceBuilder(object):
     """
     def update_rds_cache(self, tenant_id):
         # Update the route domain cache from bigips
-        if tenant_id not in self.rds_cache:
+        if not self.rd_cache.has_tenant(tenant_id):
             LOG.debug("rds_cache: adding tenant %s" % tenant_id)
-            self.rds_cache[tenant_id] = {}
+            self.rd_cache.add_tenant(tenant_id)
+            self.rd_cache.stats['rebuilds'] += 1
             for bigip in self.driver.get_all_bigips():
                 self.update_rds_cache_bigip(tenant_id, bigip)
-            LOG.debug("rds_cache updated: " + str(self.rds_cache))
+            LOG.debug("rds_cache: tenant %s updated: %s"
+                      % (tenant_id, self.rds_cache[tenant_id]))
 
     def update_rds_cache_bigip(self, tenant_id, bigip):
         # Update the route domain cache for this tenant
@@ -441,9 +594,7 @@ class NetworkServiceBuilder(object):
             return
 
         # make sure this rd has a cache entry
-        tenant_entry = self.rds_cache[tenant_id]
-        if route_domain_id not in tenant_entry:
-            tenant_entry[route_domain_id] = {}
+        self.rd_cache.add_route_domain(tenant_id, route_domain_id)
 
         # for every VLAN or TUNNEL on this bigip...
         for rd_vlan in rd_vlans:
@@ -460,11 +611,7 @@ class NetworkServiceBuilder(object):
             bigip, tenant_id, rd_vlan)
 
         # make sure this net has a cache entry
-        tenant_entry = self.rds_cache[tenant_id]
-        rd_entry = tenant_entry[route_domain_id]
-        if net_short_name not in rd_entry:
-            rd_entry[net_short_name] = {'subnets': {}}
-        net_subnets = rd_entry[net_short_name]['subnets']
+        self.rd_cache.add_network(tenant_id, route_domain_id, net_short_name)
 
         partition_id = self.service_adapter.get_folder_name(tenant_id)
         LOG.debug("Calling get_selfips with: partition %s and vlan_name %s",
@@ -480,32 +627,119 @@ class NetworkServiceBuilder(object):
             LOG.debug("rds_cache: processing bigip %s rd %s vlan %s self %s" %
                       (bigip.device_name, route_domain_id, rd_vlan,
                        selfip.name))
-            if bigip.device_name not in selfip.name:
-                LOG.error("rds_cache: Found unexpected selfip %s for tenant %s"
-                          % (selfip.name, tenant_id))
-                continue
-            subnet_id = selfip.name.split(bigip.device_name + '-')[1]
-
-            # convert 10.1.1.1%1/24 to 10.1.1.1/24
-            (addr, netbits) = selfip.address.split('/')
-            addr = addr.split('%')[0]
-            selfip.address = addr + '/' + netbits
+            self._add_rds_cache_selfip(self.rd_cache, tenant_id, bigip,
+                                       route_domain_id, net_short_name,
+                                       selfip)
 
-            # selfip addresses will have slash notation: 10.1.1.1/24
-            netip = netaddr.IPNetwork(selfip.address)
-            LOG.debug("rds_cache: updating subnet %s with %s"
-                      % (subnet_id, str(netip.cidr)))
-            net_subnets[subnet_id] = {'cidr': netip.cidr}
-            LOG.debug("rds_cache: now %s" % self.rds_cache)
+    @staticmethod
+    def _add_rds_cache_selfip(rd_cache, tenant_id, bigip, route_domain_id,
+                              net_short_name, selfip):
+        # Add the subnet of a bigip selfip to the route domain cache
+        if bigip.device_name not in selfip.name:
+            LOG.error("rds_cache: Found unexpected selfip %s for tenant %s"
+                      % (selfip.name, tenant_id))
+            return
+        subnet_id = selfip.name.split(bigip.device_name + '-')[1]
+
+        # convert 10.1.1.1%1/24 to 10.1.1.1/24
+        (addr, netbits) = selfip.address.split('/')
+        addr = addr.split('%')[0]
+
+        # selfip addresses will have slash notation: 10.1.1.1/24
+        netip = netaddr.IPNetwork(addr + '/' + netbits)
+        LOG.debug("rds_cache: updating subnet %s with %s"
+                  % (subnet_id, str(netip.cidr)))
+        rd_cache.add_subnet(tenant_id, route_domain_id,
+                            net_short_name, subnet_id, netip.cidr)
+
+    def warm_rds_cache(self):
+        """Fill the route domain cache for every tenant on the bigips.
+
+        Each bigip is listed once for its route domains, vlans, tunnels
+        and selfips, and the listings are joined here, so the first
+        request of a tenant does not query each of its route domains and
+        vlans. Entries are only added: subnets leave the cache through
+        remove_from_rds_cache, and the subnets removed while the bigips
+        are listed are not added back. Nothing is added unless every bigip
+        could be listed, so that update_rds_cache still completes tenants
+        that are missing. The listed route domain ids also seed the route
+        domain id allocator.
+        """
+        start = time()
+        live_cache = self.rd_cache
+        removed = live_cache.track_removals()
+        rd_cache = RouteDomainCache()
+        rd_ids = {}
+        try:
+            for bigip in self.driver.get_all_bigips():
+                rd_ids[bigip.hostname] = \
+                    self.warm_rds_cache_bigip(rd_cache, bigip)
+        except Exception as exc:
+            LOG.error("rds_cache: unable to warm the route domain cache: %s"
+                      % exc.message)
+            return
+        finally:
+            live_cache.untrack_removals(removed)
+        live_cache.update(rd_cache.tenants, removed)
+        route_domain_ids.seed(rd_ids)
+        live_cache.stats['warmups'] += 1
+        LOG.debug("rds_cache: warmed with %d tenants in %.2f secs"
+                  % (len(rd_cache.tenants), time() - start))
+
+    def warm_rds_cache_bigip(self, rd_cache, bigip):
+        # Add the route domains of all tenants on this bigip to rd_cache,
+        # and return the ids of all route domains on the bigip
+        prefix = self.service_adapter.prefix
+        net_short_names = dict()
+        for vlan in self.vlan_manager.get_resources(bigip):
+            net_short_names['/%s/%s' % (vlan.partition, vlan.name)] = \
+                'vlan-%s' % vlan.tag
+        for tunnel in self.tunnel_manager.get_resources(bigip):
+            if 'tunnel-gre-' in tunnel.name:
+                net_type = 'gre'
+            elif 'tunnel-vxlan-' in tunnel.name:
+                net_type = 'vxlan'
+            else:
+                continue
+            net_short_names['/%s/%s' % (tunnel.partition, tunnel.name)] = \
+                '%s-%s' % (net_type, tunnel.key)
+
+        vlan_selfips = dict()
+        for selfip in self.selfip_manager.get_resources(bigip):
+            vlan_selfips.setdefault(
+                (selfip.partition, selfip.vlan), []).append(selfip)
+
+        rd_ids = []
+        for route_domain in self.route_domain_manager.get_resources(bigip):
+            rd_ids.append(route_domain.id)
+            partition = route_domain.partition
+            if not partition.startswith(prefix):
+                continue
+            tenant_id = partition[len(prefix):]
+            rd_cache.add_tenant(tenant_id)
+            for rd_vlan in getattr(route_domain, 'vlans', None) or []:
+                if not rd_vlan.startswith('/'):
+                    rd_vlan = '/%s/%s' % (partition, rd_vlan)
+                net_short_name = net_short_names.get(rd_vlan)
+                if not net_short_name:
+                    LOG.debug("rds_cache: bigip %s rd %s vlan %s is not a "
+                              "vlan or tunnel" % (bigip.device_name,
+                                                  route_domain.id, rd_vlan))
+                    continue
+                rd_cache.add_network(tenant_id, route_domain.id,
+                                     net_short_name)
+                for selfip in vlan_selfips.get((partition, rd_vlan), []):
+                    self._add_rds_cache_selfip(
+                        rd_cache, tenant_id, bigip, route_domain.id,
+                        net_short_name, selfip)
+        return rd_ids
 
     def get_route_domain_from_cache(self, network):
         # Get route domain from cache by network
         net_short_name = self.get_neutron_net_short_name(network)
-        for tenant_id in self.rds_cache:
-            tenant_cache = self.rds_cache[tenant_id]
-            for route_domain_id in tenant_cache:
-                if net_short_name in tenant_cache[route_domain_id]:
-                    return route_domain_id
+        route_domain_id = self.rd_cache.get_route_domain(net_short_name)
+        if route_domain_id is not None:
+            return route_domain_id
 
         # Not found
         raise f5_ex.RouteDomainCacheMiss(
@@ -515,25 +749,7 @@ class NetworkServiceBuilder(object):
         # Get route domain from cache by network
         LOG.debug("remove_from_rds_cache")
         net_short_name = self.get_neutron_net_short_name(network)
-        for tenant_id in self.rds_cache:
-            LOG.debug("rds_cache: processing remove for %s" % tenant_id)
-            deleted_rds = []
-            tenant_cache = self.rds_cache[tenant_id]
-            for route_domain_id in tenant_cache:
-                if net_short_name in tenant_cache[route_domain_id]:
-                    net_entry = tenant_cache[route_domain_id][net_short_name]
-                    if subnet['id'] in net_entry['subnets']:
-                        del net_entry['subnets'][subnet['id']]
-                        if len(net_entry['subnets']) == 0:
-                            del net_entry['subnets']
-                    if len(tenant_cache[route_domain_id][net_short_name]) == 0:
-                        del tenant_cache[route_domain_id][net_short_name]
-                if len(self.rds_cache[tenant_id][route_domain_id]) == 0:
-                    deleted_rds.append(route_domain_id)
-            for rd in deleted_rds:
-                LOG.debug("removing route domain %d from tenant %s" %
-                          (rd, tenant_id))
-                del self.rds_cache[tenant_id][rd]
+        self.rd_cache.remove_subnet(net_short_name, subnet['id'])
 
     def get_bigip_net_short_name(self, bigip, tenant_id, network_name):
         # Return <network_type>-<seg_id> for bigip network
@@ -14,6 +14,9 @@
 # limitations under the License.
 #
 
+import bisect
+from time import time
+
 from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
 import oslo_messaging as messaging
@@ -21,9 +24,20 @@ import oslo_messaging as messaging
 from neutron.common import rpc
 
 from f5_openstack_agent.lbaasv2.drivers.bigip import constants_v2 as constants
+from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
 
 LOG = logging.getLogger(__name__)
 
+# upper bounds in seconds of the RPC latency histogram buckets
+RPC_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+# plugin RPC methods which handle many objects per call, older plugins
+# without them are sent one RPC per object instead
+BULK_RPC_METHODS = ('get_services_by_loadbalancer_ids',
+                    'update_loadbalancers_stats',
+                    'update_members_status',
+                    'update_statuses')
+
 
 class LBaaSv2PluginRPC(object):
     """Client interface for agent to plugin RPC."""
@@ -47,6 +61,12 @@ class LBaaSv2PluginRPC(object):
         self.env = env
         self.group = group
         self.host = host
+        # cleared once the plugin turns out not to support the bulk RPC
+        self.bulk_methods = dict.fromkeys(BULK_RPC_METHODS, True)
+        # loadbalancers per get_services_by_loadbalancer_ids call
+        self.service_page_size = 100
+        # counters and latency histogram of every plugin RPC method
+        self.rpc_stats = {}
 
     def _make_msg(self, method, **kwargs):
         return {'method': method,
@@ -69,6 +89,27 @@ class LBaaSv2PluginRPC(object):
         kwargs['fanout'] = True
         self.__call_rpc_method(context, msg, rpc_method='cast', **kwargs)
 
+    def _call_bulk(self, method, fallback, **kwargs):
+        """Call a bulk RPC method, or fallback if the plugin lacks it.
+
+        Once the plugin has rejected the method, fallback is called
+        without asking the plugin again.
+        """
+        if self.bulk_methods[method]:
+            try:
+                return self._call(
+                    self.context,
+                    self._make_msg(method, **kwargs),
+                    topic=self.topic
+                )
+            except messaging.RemoteError as err:
+                if err.exc_type not in ('NoSuchMethod', 'UnsupportedVersion'):
+                    raise
+                LOG.info("Plugin does not support %s, sending one RPC per "
+                         "object instead." % method)
+                self.bulk_methods[method] = False
+        return fallback()
+
     def __call_rpc_method(self, context, msg, **kwargs):
         options = dict(
             ((opt, kwargs[opt])
@@ -84,7 +125,72 @@ class LBaaSv2PluginRPC(object):
             callee = self._client
 
         func = getattr(callee, kwargs['rpc_method'])
-        return func(context, msg['method'], **msg['args'])
+        stats = self._get_method_stats(msg['method'])
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'],
+                                     stats['in_flight'])
+        start = time()
+        try:
+            return func(context, msg['method'], **msg['args'])
+        except messaging.MessagingTimeout:
+            stats['timeouts'] += 1
+            raise
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            elapsed = time() - start
+            stats['in_flight'] -= 1
+            stats[kwargs['rpc_method'] + 's'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['latency'][
+                bisect.bisect_left(RPC_LATENCY_BUCKETS, elapsed)] += 1
+
+    def _get_method_stats(self, method):
+        if method not in self.rpc_stats:
+            self.rpc_stats[method] = {
+                'calls': 0, 'casts': 0, 'errors': 0, 'timeouts': 0,
+                'in_flight': 0, 'max_in_flight': 0, 'total_time': 0.0,
+                'max_time': 0.0,
+                'latency': [0] * (len(RPC_LATENCY_BUCKETS) + 1)}
+        return self.rpc_stats[method]
+
+    def get_rpc_stats(self):
+        """Return the counters and latencies of the plugin RPC methods.
+
+        latency is a histogram of the number of requests which took up to
+        each bucket bound in seconds.
+        """
+        bounds = [str(bound) for bound in RPC_LATENCY_BUCKETS] + ['inf']
+        rpc_stats = {}
+        for method, stats in self.rpc_stats.items():
+            requests = stats['calls'] + stats['casts']
+            method_stats = dict(stats)
+            method_stats['total_time'] = round(stats['total_time'], 3)
+            method_stats['max_time'] = round(stats['max_time'], 3)
+            method_stats['mean_time'] = \
+                round(stats['total_time'] / requests, 3) if requests else 0
+            method_stats['latency'] = dict(zip(bounds, stats['latency']))
+            rpc_stats[method] = method_stats
+        return rpc_stats
+
+    def get_rpc_summary(self, limit=10):
+        """Return a line per RPC method, the most time spent in first."""
+        lines = []
+        methods = sorted(self.rpc_stats.items(),
+                         key=lambda item: item[1]['total_time'],
+                         reverse=True)
+        for method, stats in methods[:limit]:
+            requests = stats['calls'] + stats['casts']
+            lines.append(
+                '%s: %d requests, %d in flight, %d errors, %d timeouts, '
+                '%.3f secs total, %.3f secs mean, %.3f secs max'
+                % (method, requests, stats['in_flight'], stats['errors'],
+                   stats['timeouts'], stats['total_time'],
+                   stats['total_time'] / requests if requests else 0,
+                   stats['max_time']))
+        return lines
 
     @log_helpers.log_method_call
     def update_loadbalancer_status(self,
@@ -114,6 +220,21 @@ class LBaaSv2PluginRPC(object):
             topic=self.topic
         )
 
+    @log_helpers.log_method_call
+    def update_loadbalancers_stats(self, loadbalancers_stats):
+        """Update the database with the stats of many loadbalancers.
+
+        loadbalancers_stats is a dict of loadbalancer id to its stats.
+        Plugins without the bulk RPC get one update_loadbalancer_stats
+        per loadbalancer instead.
+        """
+        def update_each():
+            for lb_id, stats in loadbalancers_stats.items():
+                self.update_loadbalancer_stats(lb_id, stats)
+
+        return self._call_bulk('update_loadbalancers_stats', update_each,
+                               loadbalancers_stats=loadbalancers_stats)
+
     @log_helpers.log_method_call
     def loadbalancer_destroyed(self, loadbalancer_id):
         """Delete the loadbalancer from the database."""
@@ -189,6 +310,24 @@ class LBaaSv2PluginRPC(object):
             topic=self.topic
         )
 
+    @log_helpers.log_method_call
+    def update_members_status(self, members):
+        """Update the database with the status of many members.
+
+        members is a list of dicts with the member id and its
+        provisioning_status and operating_status. Plugins without the
+        bulk RPC get one update_member_status per member instead.
+        """
+        def update_each():
+            for member in members:
+                self.update_member_status(
+                    member['id'],
+                    provisioning_status=member.get('provisioning_status'),
+                    operating_status=member.get('operating_status'))
+
+        return self._call_bulk('update_members_status', update_each,
+                               members=members)
+
     @log_helpers.log_method_call
     def member_destroyed(self, member_id):
         """Delete member from database."""
@@ -276,6 +415,38 @@ class LBaaSv2PluginRPC(object):
             topic=self.topic
         )
 
+    @log_helpers.log_method_call
+    def update_statuses(self, statuses):
+        """Update the database with the statuses of many objects.
+
+        statuses is a list of dicts with the resource type and id of an
+        object, and either its status arguments or destroyed set. Plugins
+        without the bulk RPC get one status or destroyed RPC per object
+        instead, and StatusUpdatesFailed lists the statuses of the RPCs
+        which failed.
+        """
+        def update_each():
+            failed = []
+            for status in statuses:
+                update = dict(status)
+                resource = update.pop('resource')
+                object_id = update.pop('id')
+                try:
+                    if update.pop('destroyed', False):
+                        getattr(self, '%s_destroyed' % resource)(object_id)
+                    else:
+                        getattr(self, 'update_%s_status' % resource)(
+                            object_id, **update)
+                except Exception as exc:
+                    LOG.error("Unable to update %s %s: %s"
+                              % (resource, object_id, exc.message))
+                    failed.append(status)
+            if failed:
+                raise f5_ex.StatusUpdatesFailed(failed)
+
+        return self._call_bulk('update_statuses', update_each,
+                               statuses=statuses)
+
     # for L3 binding
     @log_helpers.log_method_call
     def add_allowed_address(self, port_id=None, ip_address=None):
@@ -443,6 +614,41 @@ class LBaaSv2PluginRPC(object):
 
         return service
 
+    @log_helpers.log_method_call
+    def get_services_by_loadbalancer_ids(self, loadbalancer_ids):
+        """Retrieve the service definitions of many loadbalancers.
+
+        Returns a dict of loadbalancer id to service definition. The
+        plugin is asked for service_page_size loadbalancers per call.
+        Plugins without the bulk RPC are asked for one loadbalancer at
+        a time instead. Loadbalancers missing from the answer of the bulk
+        RPC are left out, so that callers get each of them with
+        get_service_by_loadbalancer_id.
+        """
+        loadbalancer_ids = list(loadbalancer_ids)
+        services = {}
+        page_size = max(self.service_page_size, 1)
+
+        def get_each(page):
+            return dict((loadbalancer_id,
+                         self.get_service_by_loadbalancer_id(loadbalancer_id))
+                        for loadbalancer_id in page)
+
+        for start in range(0, len(loadbalancer_ids), page_size):
+            page = loadbalancer_ids[start:start + page_size]
+            try:
+                services.update(self._call_bulk(
+                    'get_services_by_loadbalancer_ids',
+                    lambda: get_each(page),
+                    loadbalancer_ids=page,
+                    host=self.host
+                ) or {})
+            except messaging.MessageDeliveryFailure:
+                LOG.error("agent->plugin RPC exception caught: "
+                          "get_services_by_loadbalancer_ids")
+
+        return services
+
     @log_helpers.log_method_call
     def get_all_loadbalancers(self, env=None, group=None, host=None):
         """Retrieve a list of loadbalancers in Neutron."""
@@ -21,10 +21,18 @@ from oslo_log import log as logging
 
 from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
 from f5_openstack_agent.lbaasv2.drivers.bigip import resource_helper
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import DeviceFanOut
 
 
 LOG = logging.getLogger(__name__)
 
+# member configuration states, as the member stats report them
+MEMBER_AVAILABILITY = {'up': 'available',
+                       'down': 'offline',
+                       'user-down': 'offline',
+                       'unchecked': 'unknown',
+                       'checking': 'unknown'}
+
 
 class PoolServiceBuilder(object):
     """Create LBaaS v2 pools and related objects on BIG-IPs.
@@ -33,8 +41,9 @@ class PoolServiceBuilder(object):
     health monitors, and members on one or more BIG-IP systems.
     """
 
-    def __init__(self, service_adapter):
+    def __init__(self, service_adapter, device_fan_out=None):
         self.service_adapter = service_adapter
+        self.device_fan_out = device_fan_out or DeviceFanOut()
         self.http_mon_helper = resource_helper.BigIPResourceHelper(
             resource_helper.ResourceType.http_monitor)
         self.https_mon_helper = resource_helper.BigIPResourceHelper(
@@ -58,9 +67,9 @@ class PoolServiceBuilder(object):
         :param bigips: Array of BigIP class instances to create pool.
         """
         pool = self.service_adapter.get_pool(service)
-        error = None
 
-        for bigip in bigips:
+        def create(bigip):
+            error = None
             try:
                 self.pool_helper.create(bigip, pool)
             except HTTPError as err:
@@ -80,8 +89,9 @@ class PoolServiceBuilder(object):
                 error = f5_ex.PoolCreationException(err.message)
                 LOG.error("Failed to assure pool %s on %s: %s",
                           pool['name'], bigip, error.message)
+            return error
 
-        return error
+        return self.device_fan_out.map(create, bigips).get_error()
 
     def delete_pool(self, service, bigips):
         """Delete a pool on set of BIG-IPs.
@@ -96,8 +106,8 @@ class PoolServiceBuilder(object):
         pool = self.service_adapter.get_pool(service)
         members = service.get('members', list())
 
-        error = None
-        for bigip in bigips:
+        def delete(bigip):
+            error = None
             try:
                 self.pool_helper.delete(bigip, name=pool["name"],
                                         partition=pool["partition"])
@@ -111,10 +121,14 @@ class PoolServiceBuilder(object):
                 LOG.error("Failed to remove pool %s from %s: %s",
                           pool['name'], bigip, error.message)
 
+            # nodes are still in use until the pool delete is applied
             for member in members:
-                self._delete_member_node(loadbalancer, member, bigip)
+                resource_helper.transaction_scope.after_commit(
+                    bigip, self._delete_member_node, loadbalancer, member,
+                    bigip)
+            return error
 
-        return error
+        return self.device_fan_out.map(delete, bigips).get_error()
 
     def update_pool(self, service, bigips):
         """Update BIG-IP pool.
@@ -123,26 +137,26 @@ class PoolServiceBuilder(object):
         and load balancer definition.
         :param bigips: Array of BigIP class instances to create pool.
         """
-        error = None
-
         pool = self.service_adapter.get_pool(service)
-        for bigip in bigips:
+
+        def update(bigip):
             try:
                 self.pool_helper.update(bigip, pool)
             except Exception as err:
                 error = f5_ex.PoolUpdateException(err.message)
                 LOG.error("Failed to update pool %s from %s: %s",
                           pool['name'], bigip, error.message)
+                return error
 
-        return error
+        return self.device_fan_out.map(update, bigips).get_error()
 
     def create_healthmonitor(self, service, bigips):
         # create member
         hm = self.service_adapter.get_healthmonitor(service)
         hm_helper = self._get_monitor_helper(service)
-        error = None
 
-        for bigip in bigips:
+        def create(bigip):
+            error = None
             try:
                 hm_helper.create(bigip, hm)
             except HTTPError as err:
@@ -161,16 +175,17 @@ class PoolServiceBuilder(object):
                 error = f5_ex.MonitorCreationException(err.message)
                 LOG.error("Failed to create monitor %s on %s: %s",
                           hm['name'], bigip, error.message)
+            return error
 
-        return error
+        return self.device_fan_out.map(create, bigips).get_error()
 
     def delete_healthmonitor(self, service, bigips):
         # delete health monitor
         hm = self.service_adapter.get_healthmonitor(service)
         hm_helper = self._get_monitor_helper(service)
-        error = None
 
-        for bigip in bigips:
+        def delete(bigip):
+            error = None
             # after updating pool, delete monitor
             try:
                 hm_helper.delete(
@@ -184,8 +199,9 @@ class PoolServiceBuilder(object):
                 error = f5_ex.MonitorDeleteException(err.message)
                 LOG.error("Failed to remove monitor %s from %s: %s",
                           hm['name'], bigip, error.message)
+            return error
 
-        return error
+        return self.device_fan_out.map(delete, bigips).get_error()
 
     def _delete_member_node(self, loadbalancer, member, bigip):
         error = None
@@ -214,38 +230,89 @@ class PoolServiceBuilder(object):
         return error
 
     def assure_pool_members(self, service, bigips):
+        """Reconcile the pool members of a service against the BIG-IPs.
+
+        The deployed members are read with one collection GET per pool
+        and compared by name. Missing members are created together in
+        one REST transaction and the nodes of PENDING_DELETE members are
+        deleted in the same batch pass. Members that could not be
+        created are flagged as 'missing'.
+        """
+        if service.get('pool', dict()).get('provisioning_status') == \
+                "PENDING_DELETE":
+            # delete_pool() takes the members and their nodes with it
+            return
+
         pool = self.service_adapter.get_pool(service)
         partition = pool["partition"]
         loadbalancer = service.get('loadbalancer')
+        members = service.get('members', list())
 
-        for bigip in bigips:
-            pool_loaded = True
+        deleted = list()
+        expected = list()
+        for member in members:
+            svc = {'loadbalancer': loadbalancer,
+                   'member': member}
+            if member.get('provisioning_status') == "PENDING_DELETE":
+                deleted.append(self.service_adapter.get_member_node(svc))
+            else:
+                expected.append((member,
+                                 self.service_adapter.get_member(svc)))
+
+        # Nodes still referenced by a remaining member cannot be deleted.
+        in_use = set(bigip_member['address']
+                     for _, bigip_member in expected)
+        nodes = list()
+        for node in deleted:
+            if node['name'] not in in_use and node not in nodes:
+                nodes.append(node)
+
+        def assure_members(bigip):
             try:
                 p = self.pool_helper.load(bigip,
                                           name=pool["name"],
                                           partition=partition)
-                m = p.members_s.members
+                deployed = set(m.name for m in p.members_s.get_collection())
             except HTTPError as err:
                 LOG.error("Unabled to load pool %s: %s",
                           pool["name"], err.message)
-                pool_loaded = False
-
-            for member in service.get('members', list()):
-                svc = {'loadbalancer': loadbalancer,
-                       'member': member}
+                deployed = None
 
-                if member.get('provisioning_status') == "PENDING_DELETE":
-                    self._delete_member_node(loadbalancer, member, bigip)
-                    continue
-
-                bigip_member = self.service_adapter.get_member(svc)
-
-                member_exists = pool_loaded and m.exists(
-                    name=urllib.quote(bigip_member["name"]),
-                    partition=partition)
-
-                if not member_exists:
-                    member['missing'] = True
+            missing = list()
+            if deployed is None:
+                missing = [member for member, _ in expected]
+            else:
+                members_path = "ltm/pool/%s/members" % \
+                    resource_helper.uri_name(pool["name"], partition)
+                creates = resource_helper.RestBatch(bigip)
+                for member, bigip_member in expected:
+                    if bigip_member["name"] not in deployed:
+                        creates.add('post', members_path, json=bigip_member)
+                        missing.append(member)
+                errors = creates.submit()
+                missing = [member for member, error in zip(missing, errors)
+                           if error is not None]
+
+            # Deleting a node shared with another pool fails with a 400,
+            # so node deletes are not sent in a transaction.
+            deletes = resource_helper.RestBatch(bigip, use_transaction=False)
+            for node in nodes:
+                deletes.add('delete',
+                            "ltm/node/%s" % resource_helper.uri_name(
+                                node['name'], node['partition']),
+                            ignore=(400, 404))
+            for node, error in zip(nodes, deletes.submit()):
+                if error is not None:
+                    LOG.error("Unexpected node deletion error: %s",
+                              urllib.quote(node['name']))
+
+            return missing
+
+        result = self.device_fan_out.map(assure_members, bigips)
+        result.raise_errors()
+        for missing in result.values():
+            for member in missing:
+                member['missing'] = True
 
     def _get_monitor_helper(self, service):
         monitor_type = self.service_adapter.get_monitor_type(service)
@@ -318,3 +385,38 @@ class PoolServiceBuilder(object):
             LOG.error("Error getting member status: %s", e.message)
 
         return member_status
+
+    def get_member_states(self, bigip, partitions):
+        """Return the status of every pool member in a set of partitions.
+
+        The pools of each partition are read with their members expanded,
+        one request per partition, instead of loading every member and its
+        stats.
+
+        :param bigip: BIG-IP to get member status from.
+        :param partitions: Names of the partitions to read.
+        :return: A dict keyed by (partition, pool name, member name) with
+        the 'status.availabilityState' and 'status.enabledState' values of
+        each member.
+        """
+        states = dict()
+        for partition in partitions:
+            try:
+                pools = self.pool_helper.get_resources(
+                    bigip, partition=partition, expand_subcollections=True)
+            except HTTPError as err:
+                LOG.error("Error getting member status of partition %s: %s",
+                          partition, err.message)
+                continue
+
+            for pool in pools:
+                members = getattr(pool, 'membersReference', dict())
+                for member in members.get('items', list()):
+                    session = member.get('session', '')
+                    states[(partition, pool.name, member['name'])] = {
+                        'status.availabilityState': MEMBER_AVAILABILITY.get(
+                            member.get('state', ''), ''),
+                        'status.enabledState':
+                            'disabled' if session == 'user-disabled'
+                            else 'enabled'}
+        return states
@@ -14,9 +14,13 @@
 #   limitations under the License.
 
 from enum import Enum
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import DeviceFanOut
 from f5_openstack_agent.lbaasv2.drivers.bigip.utils import get_filter
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import RequestLocal
 
 from oslo_log import log as logging
+from requests import HTTPError
+import urllib
 
 LOG = logging.getLogger(__name__)
 
@@ -63,6 +67,150 @@ class ResourceType(Enum):
     oneconnect = 37
 
 
+class ResourceSnapshot(object):
+    u"""Per BIG-IP cache of resource collections, keyed by partition.
+
+    When f5_resource_snapshot_cache is enabled one instance is attached to
+    every BIG-IP as bigip.resource_snapshot. The first lookup of a resource
+    type in a partition loads the whole collection with a single GET.
+    BigIPResourceHelper then answers exists and load from the snapshot and
+    keeps it current on create, update and delete. Objects changed behind
+    the helper's back are picked up again when the driver flushes its
+    caches on resync.
+    """
+
+    resource_types = frozenset([
+        ResourceType.virtual,
+        ResourceType.virtual_address,
+        ResourceType.pool,
+        ResourceType.http_monitor,
+        ResourceType.https_monitor,
+        ResourceType.tcp_monitor,
+        ResourceType.ping_monitor,
+        ResourceType.l7policy,
+        ResourceType.rule
+    ])
+
+    def __init__(self):
+        self.snapshots = {}
+        self.hits = 0
+        self.fills = 0
+
+    def get(self, helper, bigip, partition):
+        u"""Return the {name: resource} snapshot, loading it if needed.
+
+        Returns None for resource types or lookups that are not cached.
+        Loading yields to other greenthreads. A snapshot which another
+        greenthread loaded meanwhile is kept, as it already holds the
+        changes made since, and the older listing is dropped.
+        """
+        if not partition or helper.resource_type not in self.resource_types:
+            return None
+        key = (helper.resource_type, partition)
+        if key in self.snapshots:
+            self.hits += 1
+        else:
+            resources = helper.get_resources(bigip, partition)
+            if key not in self.snapshots:
+                self.snapshots[key] = dict(
+                    (resource.name, resource) for resource in resources)
+                self.fills += 1
+        return self.snapshots[key]
+
+    def invalidate(self, partition=None):
+        u"""Drop the snapshots of one partition, or of all partitions."""
+        if partition is None:
+            self.snapshots = {}
+            return
+        for key in list(self.snapshots):
+            if key[1] == partition:
+                del self.snapshots[key]
+
+    def get_stats(self):
+        return {'snapshots': len(self.snapshots),
+                'hits': self.hits,
+                'fills': self.fills}
+
+
+class DeviceInventory(object):
+    u"""The LBaaS objects of all tenant partitions of a set of BIG-IPs.
+
+    Collected in one pass: the folders and one collection of every
+    resource type are read from each BIG-IP, whatever the number of
+    partitions, and indexed by BIG-IP, resource type and partition. The
+    orphan cleanup shares one inventory between all of its steps, and
+    discards the objects it purges so that later steps see them gone.
+    """
+
+    # resource type: whether its subcollections are expanded
+    resource_types = {
+        ResourceType.virtual_address: False,
+        ResourceType.virtual: True,
+        ResourceType.l7policy: False,
+        ResourceType.pool: True,
+        ResourceType.http_monitor: False,
+        ResourceType.https_monitor: False,
+        ResourceType.tcp_monitor: False,
+        ResourceType.ping_monitor: False
+    }
+
+    def __init__(self, prefix, device_fan_out=None):
+        self.prefix = prefix
+        self.device_fan_out = device_fan_out or DeviceFanOut()
+        self.folders = {}
+        self.resources = {}
+
+    def collect(self, bigips):
+        u"""Read the inventory of all bigips concurrently."""
+        result = self.device_fan_out.map(self._collect_device, bigips)
+        result.raise_errors()
+        return self
+
+    def _collect_device(self, bigip):
+        folders = [folder.name for folder in
+                   bigip.tm.sys.folders.get_collection()
+                   if folder.name.startswith(self.prefix)]
+        resources = {}
+        for resource_type, expand in self.resource_types.items():
+            index = dict((folder, []) for folder in folders)
+            for resource in BigIPResourceHelper(resource_type).get_resources(
+                    bigip, expand_subcollections=expand):
+                partition = getattr(resource, 'partition', None)
+                if partition in index:
+                    index[partition].append(resource)
+            resources[resource_type] = index
+
+        self.folders[bigip.hostname] = folders
+        self.resources[bigip.hostname] = resources
+
+    def get_folders(self, bigip):
+        u"""Return the tenant folders of a BIG-IP."""
+        return list(self.folders.get(bigip.hostname, []))
+
+    def get_resources(self, bigip, resource_type, partition):
+        u"""Return the resources of a type in a partition of a BIG-IP."""
+        return list(self.resources.get(bigip.hostname, {}).get(
+            resource_type, {}).get(partition, []))
+
+    def discard(self, resource_type, tenant_id, object_id):
+        u"""Forget a purged object on all BIG-IPs."""
+        partition = self.prefix + tenant_id
+        names = (self.prefix + object_id, object_id)
+        for resources in self.resources.values():
+            index = resources.get(resource_type, {})
+            if partition in index:
+                index[partition] = [resource for resource in index[partition]
+                                    if resource.name not in names]
+
+    def discard_folder(self, bigip, folder):
+        u"""Forget a purged folder of a BIG-IP and everything in it."""
+        folders = self.folders.get(bigip.hostname, [])
+        if folder in folders:
+            folders.remove(folder)
+        for index in self.resources.get(bigip.hostname, {}).values():
+            index.pop(folder, None)
+
+
 class BigIPResourceHelper(object):
     u"""Helper class for creating, updating and deleting BIG-IP resources.
 
@@ -92,13 +240,40 @@ class BigIPResourceHelper(object):
         include name and partition.
         :returns: created or updated resource object.
         """
+        partition = model.get("partition", None)
+        snapshot = self._snapshot(bigip, partition)
+        transaction = self._transaction(bigip)
+        if snapshot is not None and model.get("name", None) in snapshot:
+            # known to exist, update it instead of failing with a 409
+            obj = snapshot[model["name"]]
+            try:
+                obj.modify(**self._queued(transaction, model, partition))
+                return obj
+            except HTTPError as err:
+                if err.response.status_code != 404:
+                    raise
+                snapshot.pop(model["name"], None)
+
         resource = self._resource(bigip)
-        obj = resource.create(**model)
+        if transaction and snapshot is None and resource.exists(
+                name=model["name"], partition=partition):
+            # a queued create only fails on commit, taking the whole
+            # transaction with it, so existing objects are updated
+            obj = resource.load(name=model["name"], partition=partition)
+            obj.modify(**self._queued(transaction, model, partition))
+            return obj
+
+        obj = resource.create(**self._queued(transaction, model, partition))
+        if snapshot is not None and not transaction:
+            snapshot[model["name"]] = obj
 
         return obj
 
     def exists(self, bigip, name=None, partition=None):
         """Test for the existence of a resource."""
+        snapshot = self._snapshot(bigip, partition)
+        if snapshot is not None:
+            return name in snapshot
         resource = self._resource(bigip)
         return resource.exists(name=name, partition=partition)
 
@@ -112,10 +287,23 @@ class BigIPResourceHelper(object):
         :param name: Name of resource to delete.
         :param partition: Partition name for resou
         """
+        snapshot = self._snapshot(bigip, partition)
+        transaction = self._transaction(bigip)
+        if snapshot is not None:
+            obj = snapshot.pop(name, None)
+            if obj:
+                try:
+                    obj.delete(**self._queued(transaction, {}, partition))
+                except HTTPError as err:
+                    if err.response.status_code != 404:
+                        snapshot[name] = obj
+                        raise
+            return
+
         resource = self._resource(bigip)
         if resource.exists(name=name, partition=partition):
             obj = resource.load(name=name, partition=partition)
-            obj.delete()
+            obj.delete(**self._queued(transaction, {}, partition))
 
     def load(self, bigip, name=None, partition=None):
         u"""Retrieve a BIG-IP resource from a BIG-IP.
@@ -128,8 +316,14 @@ class BigIPResourceHelper(object):
         :param partition: Partition name for resource.
         :returns: created or updated resource object.
         """
+        snapshot = self._snapshot(bigip, partition)
+        if snapshot is not None and name in snapshot:
+            return snapshot[name]
         resource = self._resource(bigip)
-        return resource.load(name=name, partition=partition)
+        obj = resource.load(name=name, partition=partition)
+        if snapshot is not None:
+            snapshot[name] = obj
+        return obj
 
     def update(self, bigip, model):
         u"""Update a resource (e.g., pool) on a BIG-IP system.
@@ -144,8 +338,19 @@ class BigIPResourceHelper(object):
         partition = None
         if "partition" in model:
             partition = model["partition"]
+        snapshot = self._snapshot(bigip, partition)
+        transaction = self._transaction(bigip)
         resource = self.load(bigip, name=model["name"], partition=partition)
-        resource.modify(**model)
+        try:
+            resource.modify(**self._queued(transaction, model, partition))
+        except HTTPError as err:
+            if snapshot is None or err.response.status_code != 404:
+                raise
+            # stale snapshot entry, retry against the device
+            snapshot.pop(model["name"], None)
+            resource = self.load(bigip, name=model["name"],
+                                 partition=partition)
+            resource.modify(**self._queued(transaction, model, partition))
 
         return resource
 
@@ -178,6 +383,9 @@ class BigIPResourceHelper(object):
                 elif expand_subcollections:
                     params['params'] += '&expandSubCollections=true'
                 resources = collection.get_collection(requests_params=params)
+            elif expand_subcollections:
+                resources = collection.get_collection(
+                    requests_params={'params': 'expandSubcollections=true'})
             else:
                 resources = collection.get_collection()
 
@@ -191,6 +399,26 @@ class BigIPResourceHelper(object):
 
         return False
 
+    def _transaction(self, bigip):
+        """Return the open transaction changes are queued in, or None."""
+        if self.resource_type not in RestTransaction.resource_types:
+            return None
+        return transaction_scope.get(bigip)
+
+    @staticmethod
+    def _queued(transaction, kwargs, partition):
+        """Add the parameters queueing a request in a transaction."""
+        if transaction is None:
+            return kwargs
+        return dict(kwargs,
+                    requests_params=transaction.requests_params(partition))
+
+    def _snapshot(self, bigip, partition):
+        snapshot = getattr(bigip, 'resource_snapshot', None)
+        if isinstance(snapshot, ResourceSnapshot):
+            return snapshot.get(self, bigip, partition)
+        return None
+
     def _resource(self, bigip):
         return {
             ResourceType.nat: lambda bigip: bigip.tm.ltm.nats.nat,
@@ -384,3 +612,224 @@ class BigIPResourceHelper(object):
                         stat_entries[stat_key]['description']
 
         return collected_stats
+
+
+def uri_name(name, partition=None):
+    u"""Return the ~partition~name form of a name used in REST URIs."""
+    name = urllib.quote(name)
+    if partition:
+        return "~%s~%s" % (partition, name)
+    return name
+
+
+class RestTransaction(object):
+    u"""iControl REST transaction on one BIG-IP.
+
+    Requests sent with the parameters returned by requests_params() are
+    queued on the device and applied together, all or nothing, when the
+    transaction is committed. Reads are not part of the transaction and
+    see the configuration as it was before it.
+    """
+
+    coordination_header = 'X-F5-REST-Coordination-Id'
+
+    # LTM objects BigIPResourceHelper changes within a transaction. Other
+    # resource types, and objects changed through the SDK directly, are
+    # sent right away.
+    resource_types = frozenset([
+        ResourceType.virtual,
+        ResourceType.virtual_address,
+        ResourceType.pool,
+        ResourceType.http_monitor,
+        ResourceType.https_monitor,
+        ResourceType.tcp_monitor,
+        ResourceType.ping_monitor,
+        ResourceType.l7policy
+    ])
+
+    def __init__(self, bigip):
+        self.bigip = bigip
+        self.trans_id = None
+        self.changes = 0
+        self.partitions = set()
+        self.deferred = []
+
+    def _uri(self):
+        uri = self.bigip._meta_data['uri'] + 'transaction'
+        if self.trans_id is not None:
+            uri += '/%s' % self.trans_id
+        return uri
+
+    def begin(self):
+        response = self.bigip.icrs.post(self._uri(), json={})
+        self.trans_id = response.json()['transId']
+
+    def requests_params(self, partition=None):
+        u"""Return the kwargs which queue a request in the transaction."""
+        self.changes += 1
+        if partition:
+            self.partitions.add(partition)
+        return {'headers': {self.coordination_header: str(self.trans_id)}}
+
+    def defer(self, method, *args, **kwargs):
+        u"""Call a method once the transaction has been committed."""
+        self.deferred.append((method, args, kwargs))
+
+    def commit(self):
+        u"""Apply the queued requests, then run the deferred calls."""
+        if not self.changes:
+            self.discard()
+        else:
+            try:
+                self.bigip.icrs.patch(self._uri(),
+                                      json={'state': 'VALIDATING'})
+            except Exception:
+                self.discard()
+                raise
+            self._invalidate_snapshots()
+        deferred, self.deferred = self.deferred, []
+        for method, args, kwargs in deferred:
+            method(*args, **kwargs)
+
+    def discard(self):
+        u"""Drop the transaction and the requests queued in it."""
+        self.deferred = []
+        self._invalidate_snapshots()
+        try:
+            self.bigip.icrs.delete(self._uri())
+        except Exception as err:
+            LOG.debug("Failed to delete transaction %s on %s: %s",
+                      self.trans_id, self.bigip.hostname, err.message)
+
+    def _invalidate_snapshots(self):
+        # snapshots cannot hold objects created in a transaction
+        snapshot = getattr(self.bigip, 'resource_snapshot', None)
+        if snapshot is not None:
+            for partition in self.partitions:
+                snapshot.invalidate(partition)
+
+
+class TransactionScope(object):
+    u"""REST transactions of the request being processed, by BIG-IP.
+
+    Requests for different loadbalancers are processed concurrently, so
+    the transactions are kept per greenthread; DeviceFanOut hands them
+    on to the threads it starts. BIG-IPs on which no transaction could be
+    opened get their changes as individual requests.
+    """
+
+    transactions = RequestLocal(None)
+
+    def begin(self, bigips, device_fan_out=None):
+        u"""Open a transaction on each BIG-IP, return them by hostname."""
+        def begin(bigip):
+            transaction = RestTransaction(bigip)
+            transaction.begin()
+            return transaction
+
+        result = (device_fan_out or DeviceFanOut()).map(begin, bigips)
+        for hostname, err in result.errors.items():
+            LOG.warning("Unable to open a REST transaction on %s, changes "
+                        "are sent individually: %s", hostname, err.message)
+        transactions = dict(
+            (transaction.bigip.hostname, transaction)
+            for transaction in result.values())
+        self.transactions = transactions
+        return transactions
+
+    def get(self, bigip):
+        u"""Return the open transaction of a BIG-IP, or None."""
+        return (self.transactions or dict()).get(bigip.hostname)
+
+    def end(self):
+        self.transactions = None
+
+    def after_commit(self, bigip, method, *args, **kwargs):
+        u"""Call a method once the changes queued for a BIG-IP are applied.
+
+        Without an open transaction the method is called right away.
+        """
+        transaction = self.get(bigip)
+        if transaction is None:
+            return method(*args, **kwargs)
+        transaction.defer(method, *args, **kwargs)
+
+
+transaction_scope = TransactionScope()
+
+
+class RestBatch(object):
+    u"""Queue of raw iControl REST requests submitted together.
+
+    Requests are relative to the BIG-IP's /mgmt/tm/ URI. With
+    use_transaction set they are sent in one iControl REST transaction so
+    that they are applied all or nothing. If the transaction cannot be
+    opened or committed, the requests are replayed one at a time so a
+    single bad object does not fail the others. HTTP status codes in a
+    request's ignore list are not reported as errors in that case.
+    Example usage:
+        batch = RestBatch(bigip)
+        batch.add('post', 'ltm/pool/~Common~pool1/members',
+                  json={'name': '10.0.0.1:80', 'partition': 'Common'})
+        batch.add('delete', 'ltm/node/~Common~10.0.0.2', ignore=(404,))
+        errors = batch.submit()
+    """
+
+    coordination_header = 'X-F5-REST-Coordination-Id'
+
+    def __init__(self, bigip, use_transaction=True):
+        self.bigip = bigip
+        self.use_transaction = use_transaction
+        self.requests = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, method, path, ignore=(), **kwargs):
+        u"""Queue a request; kwargs are passed to the REST session."""
+        self.requests.append((method, path, tuple(ignore), kwargs))
+
+    def submit(self):
+        u"""Send the queued requests.
+
+        :return: list with one entry per request, in the order they were
+        added, holding None on success or the exception raised.
+        """
+        if not self.requests:
+            return []
+        if self.use_transaction and len(self.requests) > 1:
+            try:
+                self._submit_transaction()
+                return [None] * len(self.requests)
+            except Exception as err:
+                LOG.debug("REST transaction on %s failed, falling back to "
+                          "individual requests: %s", self.bigip.hostname,
+                          err.message)
+        return [self._send(request) for request in self.requests]
+
+    def _submit_transaction(self):
+        session = self.bigip.icrs
+        base_uri = self.bigip._meta_data['uri']
+        transaction = RestTransaction(self.bigip)
+        transaction.begin()
+        try:
+            for method, path, ignore, kwargs in self.requests:
+                getattr(session, method)(
+                    base_uri + path, **dict(kwargs,
+                                            **transaction.requests_params()))
+        except Exception:
+            transaction.discard()
+            raise
+        transaction.commit()
+
+    def _send(self, request):
+        method, path, ignore, kwargs = request
+        try:
+            getattr(self.bigip.icrs, method)(
+                self.bigip._meta_data['uri'] + path, **kwargs)
+        except HTTPError as err:
+            if err.response.status_code in ignore:
+                LOG.debug(str(err))
+                return None
+            return err
+        return None
@@ -0,0 +1,226 @@
+# coding=utf-8
+# Copyright (c) 2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+
+from eventlet import greenthread
+from eventlet import semaphore
+from oslo_log import log as logging
+import oslo_messaging as messaging
+from oslo_service import loopingcall
+
+from f5_openstack_agent.lbaasv2.drivers.bigip import constants_v2 as f5const
+from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
+
+LOG = logging.getLogger(__name__)
+
+
+class StatusPublisher(object):
+    """Send object statuses to the plugin in batches.
+
+    Offers the status and destroyed methods of LBaaSv2PluginRPC, but
+    queues the updates per object instead of sending them. A newer update
+    of an object replaces its queued one. The queue is sent with
+    update_statuses every interval seconds, or as soon as it holds
+    batch_size updates. Flushes are serialized, so the updates of an
+    object are sent in order. Updates which could not be sent are queued
+    again, unless a newer update of the object was queued meanwhile, up to
+    max_retries times. Updates the plugin rejected are dropped.
+
+    Updates are never compared with the ones already sent: neutron sets
+    objects back to PENDING_UPDATE on its own, so the plugin needs the
+    status again even if it is the same as the last one sent.
+    """
+
+    def __init__(self, plugin_rpc, interval=1.0, batch_size=100,
+                 max_retries=5):
+        self.plugin_rpc = plugin_rpc
+        self.interval = interval
+        self.batch_size = max(batch_size, 1)
+        self.max_retries = max_retries
+        # (resource, id): status dict, or None once destroyed
+        self.queue = collections.OrderedDict()
+        # (resource, id): times its queued update failed to be sent
+        self.retries = {}
+        self.stats = {'queued': 0, 'merged': 0, 'published': 0,
+                      'batches': 0, 'errors': 0, 'retried': 0,
+                      'dropped': 0}
+        self.lock = semaphore.Semaphore()
+        self.timer = None
+
+    def start(self):
+        if not self.timer:
+            self.timer = loopingcall.FixedIntervalLoopingCall(self.flush)
+            self.timer.start(interval=self.interval)
+
+    def stop(self):
+        if self.timer:
+            self.timer.stop()
+            self.timer = None
+        self.flush()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['pending'] = len(self.queue)
+        return stats
+
+    def _queue(self, resource, object_id, status):
+        key = (resource, object_id)
+        if key in self.queue:
+            del self.queue[key]
+            self.stats['merged'] += 1
+        self.retries.pop(key, None)
+        self.queue[key] = status
+        self.stats['queued'] += 1
+        if len(self.queue) >= self.batch_size:
+            greenthread.spawn_n(self.flush)
+
+    def flush(self):
+        """Send all queued updates."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.queue:
+            return
+        queue, self.queue = self.queue, collections.OrderedDict()
+        updates = list()
+        for (resource, object_id), status in queue.items():
+            update = {'resource': resource, 'id': object_id}
+            if status is None:
+                update['destroyed'] = True
+            else:
+                update.update(status)
+            updates.append(update)
+
+        for start in range(0, len(updates), self.batch_size):
+            batch = updates[start:start + self.batch_size]
+            failed = []
+            try:
+                self.plugin_rpc.update_statuses(batch)
+            except f5_ex.StatusUpdatesFailed as exc:
+                # sent one RPC per object, only some of which failed
+                LOG.error("Unable to publish %d statuses, they are retried"
+                          % len(exc.statuses))
+                failed = exc.statuses
+            except messaging.RemoteError as exc:
+                LOG.error("The plugin rejected %d statuses, they are "
+                          "dropped: %s" % (len(batch), exc.message))
+                self.stats['errors'] += 1
+                self.stats['dropped'] += len(batch)
+                continue
+            except Exception as exc:
+                LOG.error("Unable to publish %d statuses, they are retried: "
+                          "%s" % (len(batch), exc.message))
+                failed = batch
+            if failed:
+                self.stats['errors'] += 1
+                self._requeue(queue, failed)
+            self.stats['batches'] += 1
+            self.stats['published'] += len(batch) - len(failed)
+            for update in batch:
+                if update not in failed:
+                    self.retries.pop((update['resource'], update['id']), None)
+
+    def _requeue(self, queue, failed):
+        # Queue failed updates again ahead of the ones queued since,
+        # unless a newer update of the same object is among those
+        requeued = collections.OrderedDict()
+        for update in failed:
+            key = (update['resource'], update['id'])
+            if key in self.queue:
+                continue
+            retries = self.retries.get(key, 0) + 1
+            if retries > self.max_retries:
+                LOG.error("Dropping the status of %s %s after %d retries"
+                          % (key[0], key[1], self.max_retries))
+                self.retries.pop(key, None)
+                self.stats['dropped'] += 1
+                continue
+            self.retries[key] = retries
+            requeued[key] = queue[key]
+        self.stats['retried'] += len(requeued)
+        requeued.update(self.queue)
+        self.queue = requeued
+
+    def update_loadbalancer_status(self, lb_id, provisioning_status=None,
+                                   operating_status=None):
+        self._queue('loadbalancer', lb_id,
+                    {'provisioning_status': provisioning_status,
+                     'operating_status': operating_status})
+
+    def loadbalancer_destroyed(self, loadbalancer_id):
+        self._queue('loadbalancer', loadbalancer_id, None)
+
+    def update_listener_status(self, listener_id,
+                               provisioning_status=f5const.F5_ERROR,
+                               operating_status=f5const.F5_OFFLINE):
+        self._queue('listener', listener_id,
+                    {'provisioning_status': provisioning_status,
+                     'operating_status': operating_status})
+
+    def listener_destroyed(self, listener_id):
+        self._queue('listener', listener_id, None)
+
+    def update_pool_status(self, pool_id,
+                           provisioning_status=f5const.F5_ERROR,
+                           operating_status=f5const.F5_OFFLINE):
+        self._queue('pool', pool_id,
+                    {'provisioning_status': provisioning_status,
+                     'operating_status': operating_status})
+
+    def pool_destroyed(self, pool_id):
+        self._queue('pool', pool_id, None)
+
+    def update_member_status(self, member_id, provisioning_status=None,
+                             operating_status=None):
+        self._queue('member', member_id,
+                    {'provisioning_status': provisioning_status,
+                     'operating_status': operating_status})
+
+    def member_destroyed(self, member_id):
+        self._queue('member', member_id, None)
+
+    def update_health_monitor_status(self, health_monitor_id,
+                                     provisioning_status=f5const.F5_ERROR,
+                                     operating_status=f5const.F5_OFFLINE):
+        self._queue('health_monitor', health_monitor_id,
+                    {'provisioning_status': provisioning_status,
+                     'operating_status': operating_status})
+
+    def health_monitor_destroyed(self, healthmonitor_id):
+        self._queue('health_monitor', healthmonitor_id, None)
+
+    def update_l7rule_status(self, l7rule_id, l7policy_id,
+                             provisioning_status=f5const.F5_ERROR,
+                             operating_status=f5const.F5_OFFLINE):
+        self._queue('l7rule', l7rule_id,
+                    {'l7policy_id': l7policy_id,
+                     'provisioning_status': provisioning_status,
+                     'operating_status': operating_status})
+
+    def l7rule_destroyed(self, l7rule_id):
+        self._queue('l7rule', l7rule_id, None)
+
+    def update_l7policy_status(self, l7policy_id,
+                               provisioning_status=f5const.F5_ERROR,
+                               operating_status=f5const.F5_OFFLINE):
+        self._queue('l7policy', l7policy_id,
+                    {'provisioning_status': provisioning_status,
+                     'operating_status': operating_status})
+
+    def l7policy_destroyed(self, l7policy_id):
+        self._queue('l7policy', l7policy_id, None)
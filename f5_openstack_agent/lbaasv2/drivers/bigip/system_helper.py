@@ -19,6 +19,8 @@ from f5_openstack_agent.lbaasv2.drivers.bigip.network_helper import \
     NetworkHelper
 from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper \
     import BigIPResourceHelper
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper \
+    import ResourceSnapshot
 from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper \
     import ResourceType
 
@@ -39,6 +41,12 @@ class SystemHelper(object):
         if f.exists(name=folder_name):
             obj = f.load(name=folder_name)
             obj.delete()
+        self.invalidate_snapshot(bigip, folder_name)
+
+    def invalidate_snapshot(self, bigip, folder):
+        snapshot = getattr(bigip, 'resource_snapshot', None)
+        if isinstance(snapshot, ResourceSnapshot):
+            snapshot.invalidate(folder)
 
     def folder_exists(self, bigip, folder):
         if folder == 'Common':
@@ -156,6 +164,7 @@ class SystemHelper(object):
             for ltm_type in ltm_types:
                 resource = BigIPResourceHelper(ltm_type)
                 [r.delete() for r in resource.get_resources(bigip, folder)]
+            self.invalidate_snapshot(bigip, folder)
 
             # Remove all net resources
             net_types = [
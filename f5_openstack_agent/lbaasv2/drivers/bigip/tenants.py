@@ -73,21 +73,24 @@ class BigipTenantManager(object):
         # create tenant route domain
         if self.conf.use_namespaces:
             bigips = self.driver.get_all_bigips()
-            rd_id = self.network_helper.get_next_domain_id(bigips)
-            for bigip in bigips:
-                if not self.network_helper.route_domain_exists(bigip,
-                                                               folder_name):
-                    try:
-                        self.network_helper.create_route_domain(
-                            bigip,
-                            rd_id,
-                            folder_name,
-                            self.conf.f5_route_domain_strictness)
-                    except Exception as err:
-                        LOG.exception(err.message)
-                        raise f5ex.RouteDomainCreationException(
-                            "Failed to create route domain for "
-                            "tenant in %s" % (folder_name))
+            missing = [bigip for bigip in bigips
+                       if not self.network_helper.route_domain_exists(
+                           bigip, folder_name)]
+            if missing:
+                # only allocate an id for a route domain to be created
+                rd_id = self.network_helper.get_next_domain_id(bigips)
+            for bigip in missing:
+                try:
+                    self.network_helper.create_route_domain(
+                        bigip,
+                        rd_id,
+                        folder_name,
+                        self.conf.f5_route_domain_strictness)
+                except Exception as err:
+                    LOG.exception(err.message)
+                    raise f5ex.RouteDomainCreationException(
+                        "Failed to create route domain for "
+                        "tenant in %s" % (folder_name))
 
     def assure_tenant_cleanup(self, service, all_subnet_hints):
         """Delete tenant partition."""
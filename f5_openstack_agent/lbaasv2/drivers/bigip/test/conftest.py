@@ -21,6 +21,11 @@ import uuid
 
 from f5_openstack_agent.lbaasv2.drivers.bigip import constants_v2
 
+# benchmarks build large fixtures, so they only run when asked for
+benchmark = pytest.mark.skipif(
+    not os.environ.get('F5_AGENT_BENCHMARK'),
+    reason='set F5_AGENT_BENCHMARK to run the benchmarks')
+
 
 class TestingWithServiceConstructor(object):
     """An object class meant for the use of constructing service objects
@@ -147,6 +147,7 @@ class TestLbaasAgentManagerMockBuilder(mock_builder_base_class.MockBuilderBase,
         if not target:
             target = self.new_fully_mocked_target()
         listing = [
+            'get_device_inventory',
             'get_all_deployed_loadbalancers', 'get_all_deployed_listeners',
             'get_all_deployed_l7_policys',
             'get_all_deployed_health_monitors', 'get_all_deployed_pools']
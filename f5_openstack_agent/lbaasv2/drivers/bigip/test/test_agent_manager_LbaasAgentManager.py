@@ -16,6 +16,7 @@
 
 import datetime
 import pytest
+import sys
 
 from mock import Mock
 from mock import patch
@@ -165,6 +166,44 @@ class TestLbaasAgentManager(TestLbaasAgentManagerBuilder):
 
         all_paths(fully_mocked_target)
 
+    def test_pending_queue(self, fully_mocked_target):
+        target = fully_mocked_target
+        target.conf = Mock(f5_pending_services_timeout=100)
+        target.cache = Mock()
+        target.agent_host = 'host'
+        target.needs_resync = False
+        target.pending_services = {}
+        target.lbdriver = Mock()
+        target.lbdriver.create_listener.return_value = True
+        target.lbdriver.create_pool.return_value = True
+        target.plugin_rpc = Mock()
+        target.plugin_rpc.get_services_by_loadbalancer_ids.return_value = {}
+
+        # pending requests queue their loadbalancer instead of a resync
+        target.create_listener(None, {}, {'loadbalancer': {'id': 'lb1'}})
+        target.create_pool(None, {}, {'loadbalancer': {'id': 'lb2'}})
+        target.pending_services['lb2'] -= datetime.timedelta(seconds=200)
+        assert sorted(target.pending_services) == ['lb1', 'lb2']
+        assert not target.needs_resync
+
+        # the oldest is refreshed first, and times out
+        refreshed = []
+        target.refresh_service = Mock(
+            side_effect=lambda lb_id, service: refreshed.append(lb_id) or
+            lb_id == 'lb2')
+        target.service_timeout = Mock()
+        target.refresh_pending_services(None)
+        assert refreshed == ['lb2', 'lb1']
+        target.service_timeout.assert_called_once_with('lb2')
+        assert target.pending_services == {}
+        target.plugin_rpc.get_pending_loadbalancers.assert_not_called()
+
+        # a completed request dequeues its loadbalancer
+        target.create_pool(None, {}, {'loadbalancer': {'id': 'lb3'}})
+        target.lbdriver.create_pool.return_value = False
+        target.create_pool(None, {}, {'loadbalancer': {'id': 'lb3'}})
+        assert target.pending_services == {}
+
     def test_get_remote_loadbalancers(self, fully_mocked_target):
 
         def setup_target(target):
@@ -190,7 +229,7 @@ class TestLbaasAgentManager(TestLbaasAgentManagerBuilder):
             target.has_provisioning_status_of_error = Mock(return_value=True)
             target.lbdriver.service_exists.return_value = True
             target.lbdriver.service_rename_required.return_value = False
-            target.cache = Mock()
+            target.cache = Mock(path=None)
             target.agent_host = 'host'
 
         def reset_target(target):
@@ -223,12 +262,164 @@ class TestLbaasAgentManager(TestLbaasAgentManagerBuilder):
         fully_mocked_target.cache.get_by_loadbalancer_id.side_effect = \
             [True, False]
         fully_mocked_target.validate_service = Mock()
+        fully_mocked_target.conf = Mock(f5_validation_workers=2)
+        fully_mocked_target.plugin_rpc = Mock()
+        get_services = \
+            fully_mocked_target.plugin_rpc.get_services_by_loadbalancer_ids
+        service = {'loadbalancer': {'id': 2}}
+        get_services.return_value = {2: service}
         fully_mocked_target._validate_services(lb_ids)
-        fully_mocked_target.validate_service.assert_called_once_with(2)
+        # only loadbalancers missing from the cache are fetched, in bulk
+        get_services.assert_called_once_with([2])
+        fully_mocked_target.validate_service.assert_called_once_with(
+            2, service)
         fully_mocked_target.cache.get_by_loadbalancer_id.assert_any_call(1)
         fully_mocked_target.cache.get_by_loadbalancer_id.assert_called_with(2)
         assert fully_mocked_target.cache.get_by_loadbalancer_id.call_count == 2
 
+        # a loadbalancer missing from the bulk answer fetches its own
+        fully_mocked_target.cache.get_by_loadbalancer_id.side_effect = None
+        fully_mocked_target.cache.get_by_loadbalancer_id.return_value = None
+        get_services.return_value = {}
+        fully_mocked_target._validate_services([3])
+        fully_mocked_target.validate_service.assert_called_with(3, None)
+
+    def test_run_validations(self, fully_mocked_target):
+        target = fully_mocked_target
+        target.conf = Mock(f5_validation_workers=2)
+        target.cache = Mock()
+        target.validation_failures = {}
+        services = {}
+        for lb_id, tenant_id in [('a1', 'a'), ('a2', 'a'), ('a3', 'a'),
+                                 ('b1', 'b'), ('c1', 'c')]:
+            services[lb_id] = {'loadbalancer': {'tenant_id': tenant_id}}
+        validated = []
+
+        def validate_service(lb_id, service):
+            validated.append(lb_id)
+            return lb_id != 'b1'
+
+        target.validate_service = Mock(side_effect=validate_service)
+
+        failed = target._run_validations(sorted(services), services)
+
+        # the tenants take turns
+        assert validated == ['a1', 'b1', 'c1', 'a2', 'a3']
+        assert failed == set(['b1'])
+        assert list(target.validation_failures) == ['b1']
+        assert target.get_validation_progress() == \
+            {'validated': 4, 'failed': 1, 'total': 5, 'eta': 0}
+
+        # a successful validation clears the failure
+        target.validate_service = Mock(return_value=True)
+        target._run_validations(['b1'], services)
+        assert target.validation_failures == {}
+
+    def test_rolling_resync(self, fully_mocked_target):
+        target = fully_mocked_target
+        target.conf = Mock(f5_validation_workers=1)
+        target.conf.service_resync_slice = 2
+        target.conf.periodic_interval = 10
+        target.service_resync_interval = 30
+        target.lbdriver = Mock()
+        target.cache = agent_manager.LogicalServiceCache()
+        for lb_id in ['lb1', 'lb2', 'lb3', 'lb4', 'lb5']:
+            target.cache.services[lb_id] = Mock(agent_host='host')
+        target.validate_service = Mock()
+        target.plugin_rpc = Mock()
+        target.plugin_rpc.get_services_by_loadbalancer_ids.side_effect = \
+            lambda lb_ids: dict((lb_id, {}) for lb_id in lb_ids)
+        start = datetime.datetime.now()
+        target.resync_cursor = None
+        target.resync_cycle_start = start
+        target.last_validated = {}
+        target.validation_failures = {}
+        target.resync_stats = {'cycles': 0, 'validated': 0, 'failed': 0,
+                               'last_cycle_seconds': 0}
+
+        target.rolling_resync(start)
+        assert target.validate_service.call_count == 2
+        stats = target.get_resync_stats()
+        assert stats['coverage'] == 0.4
+        assert stats['loadbalancers'] == 5
+
+        # the cache is never emptied and a cycle covers every loadbalancer
+        del target.cache.services['lb3']
+        target.rolling_resync(start + datetime.timedelta(seconds=10))
+        assert target.validate_service.call_args_list[2:] == [
+            (('lb4', {}),), (('lb5', {}),)]
+        assert target.resync_stats['cycles'] == 1
+        assert target.resync_cursor is None
+        target.lbdriver.flush_cache.assert_called_once_with()
+        assert len(target.cache.services) == 4
+
+        # a failed validation is retried first and is not covered until
+        # it succeeds
+        target.validate_service.side_effect = \
+            lambda lb_id, service: lb_id != 'lb1'
+        target.rolling_resync(start + datetime.timedelta(seconds=20))
+        assert target.validate_service.call_args_list[4:] == [
+            (('lb1', {}),), (('lb2', {}),)]
+        assert target.resync_stats['failed'] == 1
+        assert target.last_validated['lb1'] == start
+        assert target.get_resync_stats()['coverage'] == 0.75
+        target.validate_service.side_effect = None
+        target.rolling_resync(start + datetime.timedelta(seconds=30))
+        assert target.validate_service.call_args_list[6:] == [
+            (('lb1', {}),), (('lb4', {}),), (('lb5', {}),)]
+        assert target.validation_failures == {}
+
+    def test_service_cache_file(self, fully_mocked_target, tmpdir):
+        target = fully_mocked_target
+        path = str(tmpdir.join('services.json'))
+        target.conf = Mock(f5_validation_workers=1)
+        target.service_resync_interval = 300
+        target.agent_host = 'host'
+        target.plugin_rpc = Mock()
+        target.lbdriver = Mock()
+        target.lbdriver.service_exists.return_value = True
+        target.has_provisioning_status_of_error = Mock(return_value=False)
+        target.validation_failures = {}
+        service = {'loadbalancer': {'id': 'lb1', 'tenant_id': 'tenant',
+                                    'provisioning_status': 'ACTIVE'}}
+
+        target.cache = agent_manager.LogicalServiceCache()
+        target.cache.load(path)
+        target._run_validations(['lb1'], {'lb1': service})
+        assert target.lbdriver.service_exists.call_count == 1
+
+        # a restarted agent skips the unchanged loadbalancer
+        target.cache = agent_manager.LogicalServiceCache()
+        target.cache.load(path)
+        target.validate_service('lb1', service)
+        assert target.lbdriver.service_exists.call_count == 1
+        assert target.cache.get_by_loadbalancer_id('lb1')
+
+        # but not once its definition changed
+        service['loadbalancer']['description'] = 'changed'
+        target.validate_service('lb1', service)
+        assert target.lbdriver.service_exists.call_count == 2
+
+        # nor while an object of the service is in error
+        target.has_provisioning_status_of_error.return_value = True
+        target.validate_service('lb1', service)
+        assert target.lbdriver.sync.call_count == 1
+        target.has_provisioning_status_of_error.return_value = False
+
+        # nor once the cache was cleared, e.g. after a device outage
+        target.cache.clear()
+        assert target.cache.dirty
+        target.validate_service('lb1', service)
+        assert target.lbdriver.service_exists.call_count == 3
+
+        # a corrupt file is discarded
+        with open(path, 'w') as cache_file:
+            cache_file.write('{"checksum": "0", "records": {}}')
+        target.cache = agent_manager.LogicalServiceCache()
+        target.cache.load(path)
+        assert target.cache.records == {}
+        assert not tmpdir.join('services.json').check()
+
     @pytest.mark.skip(reason="TypeError from mock redirecting rpc_calls.")
     def test_lbb_sync_state(self, fully_mocked_target,
                             fully_mocked_plugin_rpc, mock_logger):
@@ -341,3 +532,76 @@ class TestLbaasAgentManager(TestLbaasAgentManagerBuilder):
         negative_list_scenario(target_class, svc)
         negative_dict_scenario(target_class, svc)
         awkward_network_nest(target_class, svc)
+
+
+def lb_service(lb_id, tenant_id, port_id=None):
+    return {'loadbalancer': {'id': lb_id, 'tenant_id': tenant_id,
+                             'vip_port_id': port_id}}
+
+
+class TestLogicalServiceCache(object):
+    def test_indexes(self):
+        cache = agent_manager.LogicalServiceCache()
+        cache.put(lb_service('lb1', 'tenant1', 'port1'), 'host1')
+        cache.put(lb_service('lb2', 'tenant1', 'port2'), 'host2')
+        cache.put(lb_service('lb3', 'tenant2', 'port3'), 'host2')
+
+        assert sorted(cache.get_tenant_ids()) == ['tenant1', 'tenant2']
+        assert sorted(cache.get_agent_hosts()) == ['host1', 'host2']
+        assert sorted(s.loadbalancer_id for s in
+                      cache.get_by_tenant_id('tenant1')) == ['lb1', 'lb2']
+        assert cache.get_by_port_id('port3').loadbalancer_id == 'lb3'
+
+        # rebinding to another host moves the service between the indexes
+        cache.put(lb_service('lb1', 'tenant1', 'port1'), 'host2')
+        assert cache.get_agent_hosts() == ['host2']
+        assert len(cache.get_by_agent_host('host2')) == 3
+
+        cache.remove_by_loadbalancer_id('lb3')
+        assert cache.get_tenant_ids() == ['tenant1']
+        assert cache.get_by_port_id('port3') is None
+        cache.remove(lb_service('lb2', 'tenant1'))
+        assert cache.get_by_tenant_id('tenant1') == \
+            [cache.get_by_loadbalancer_id('lb1')]
+
+        cache.clear()
+        assert cache.size == 0
+        assert cache.get_tenant_ids() == []
+        assert cache.get_by_port_id('port1') is None
+
+    def test_many_services(self):
+        """Indexed lookups in a cache of many services."""
+        count = 300
+        cache = agent_manager.LogicalServiceCache()
+        for i in range(count):
+            cache.put(lb_service('lb-%d' % i, 'tenant-%d' % (i % 100),
+                                 'port-%d' % i), 'host-%d' % (i % 3))
+
+        for i in range(100):
+            assert len(cache.get_by_tenant_id('tenant-%d' % i)) == \
+                count // 100
+            assert cache.get_by_port_id('port-%d' % i)
+        # services are __slots__ records
+        services = cache.services.values()
+        assert not hasattr(services[0], '__dict__')
+        assert len(cache.get_agent_hosts()) == 3
+
+    @ct.benchmark
+    @pytest.mark.parametrize('count', [10000, 100000])
+    def test_memory_benchmark(self, count):
+        """Memory of a cache of count services, with its indexes."""
+        cache = agent_manager.LogicalServiceCache()
+        for i in range(count):
+            cache.put(lb_service('lb-%d' % i, 'tenant-%d' % (i % 1000),
+                                 'port-%d' % i), 'host-%d' % (i % 3))
+
+        services = cache.services.values()
+        assert not any(hasattr(s, '__dict__') for s in services)
+        size = sum(sys.getsizeof(s) for s in services)
+        size += sum(sys.getsizeof(index) for index in
+                    (cache.services, cache.tenant_index, cache.host_index,
+                     cache.port_index))
+        size += sum(sys.getsizeof(lb_ids) for index in
+                    (cache.tenant_index, cache.host_index)
+                    for lb_ids in index.values())
+        assert size < 500 * count
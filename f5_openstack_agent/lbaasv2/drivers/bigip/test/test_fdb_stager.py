@@ -0,0 +1,154 @@
+# coding=utf-8
+# Copyright (c) 2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from mock import Mock
+
+from f5_openstack_agent.lbaasv2.drivers.bigip.fdb_stager import FdbStager
+
+
+def make_fdb(vtep, entries, network_id='net1'):
+    return {network_id: {'segment_id': 1008, 'network_type': 'vxlan',
+                         'ports': {vtep: entries}}}
+
+
+class TestFdbStager(object):
+    def test_flush(self):
+        add_fdb = Mock()
+        remove_fdb = Mock()
+        stager = FdbStager(add_fdb, remove_fdb)
+
+        stager.add(make_fdb('10.30.30.2', [
+            ['00:00:00:00:00:00', '0.0.0.0'],
+            ['fa:16:3e:00:00:01', '10.10.1.4'],
+            ['fa:16:3e:00:00:02', '10.10.1.5']]))
+        # an instance migrated to another vtep
+        stager.remove(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        stager.add(make_fdb('10.30.30.3', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        # the same update twice
+        stager.remove(make_fdb('10.30.30.4', [
+            ['fa:16:3e:00:00:03', '10.10.1.6']]))
+        stager.remove(make_fdb('10.30.30.4', [
+            ['fa:16:3e:00:00:03', '10.10.1.6']]))
+        assert not add_fdb.called and not remove_fdb.called
+
+        stager.flush()
+        # the remove on the former vtep is kept for the BIG-IP of the new
+        # vtep, which skips the add
+        remove_fdb.assert_called_once_with({'net1': {
+            'segment_id': 1008, 'network_type': 'vxlan',
+            'ports': {'10.30.30.2': [['fa:16:3e:00:00:01', '10.10.1.4']],
+                      '10.30.30.4': [['fa:16:3e:00:00:03', '10.10.1.6']]}}})
+        add_fdb.assert_called_once_with({'net1': {
+            'segment_id': 1008, 'network_type': 'vxlan',
+            'ports': {'10.30.30.2': [['fa:16:3e:00:00:02', '10.10.1.5']],
+                      '10.30.30.3': [['fa:16:3e:00:00:01', '10.10.1.4']]}}})
+
+        stats = stager.get_stats()
+        assert stats['staged'] == 6
+        assert stats['merged'] == 1
+        assert stats['cancelled'] == 1
+        assert stats['applied'] == 4
+        assert stats['pending'] == 0
+
+        # nothing staged, nothing applied
+        stager.flush()
+        assert add_fdb.call_count == 1
+        assert stager.get_stats()['flushes'] == 1
+
+    def test_merge_same_vtep(self):
+        add_fdb = Mock()
+        remove_fdb = Mock()
+        stager = FdbStager(add_fdb, remove_fdb)
+
+        # an add on the vtep of a staged remove cancels it
+        stager.remove(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        stager.add(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        stager.flush()
+        assert not remove_fdb.called
+        assert add_fdb.called
+        assert stager.get_stats()['cancelled'] == 1
+
+    def test_flush_error(self):
+        add_fdb = Mock(side_effect=Exception('down'))
+        remove_fdb = Mock()
+        stager = FdbStager(add_fdb, remove_fdb)
+
+        stager.add(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:01', '10.10.1.4'],
+            ['fa:16:3e:00:00:02', '10.10.1.5']]))
+        stager.remove(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:03', '10.10.1.6']]))
+        stager.flush()
+
+        # the removal is applied although the addition failed
+        assert remove_fdb.called
+        stats = stager.get_stats()
+        assert stats['errors'] == 1
+        assert stats['applied'] == 1
+        assert stats['pending'] == 2
+
+        # failed entries are retried, unless a newer one was staged
+        add_fdb.side_effect = None
+        stager.remove(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:02', '10.10.1.5']]))
+        stager.flush()
+        add_fdb.assert_called_with(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        remove_fdb.assert_called_with(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:02', '10.10.1.5']]))
+        stats = stager.get_stats()
+        assert stats['retried'] == 2
+        assert stats['pending'] == 0
+        assert not stager.retries
+
+    def test_remove_error(self):
+        add_fdb = Mock()
+        remove_fdb = Mock(side_effect=Exception('down'))
+        stager = FdbStager(add_fdb, remove_fdb)
+
+        stager.remove(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        stager.add(make_fdb('10.30.30.3', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        stager.flush()
+
+        # the add waits for the remove, which would otherwise undo it
+        assert not add_fdb.called
+        assert stager.get_stats()['pending'] == 2
+        remove_fdb.side_effect = None
+        stager.flush()
+        assert remove_fdb.call_count == 2
+        assert add_fdb.call_count == 1
+
+    def test_max_retries(self):
+        add_fdb = Mock(side_effect=Exception('down'))
+        remove_fdb = Mock()
+        stager = FdbStager(add_fdb, remove_fdb, max_retries=2)
+
+        stager.add(make_fdb('10.30.30.2', [
+            ['fa:16:3e:00:00:01', '10.10.1.4']]))
+        for _ in range(3):
+            stager.flush()
+        assert add_fdb.call_count == 3
+        stats = stager.get_stats()
+        assert stats['retried'] == 2
+        assert stats['dropped'] == 1
+        assert stats['pending'] == 0
+        assert not stager.retries
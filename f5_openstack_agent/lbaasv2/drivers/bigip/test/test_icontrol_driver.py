@@ -14,9 +14,11 @@
 # limitations under the License.
 #
 
+import copy
 import pytest
 import uuid
 
+from eventlet import greenthread
 from mock import Mock
 from mock import patch
 from requests import HTTPError
@@ -26,6 +28,8 @@ from f5_openstack_agent.lbaasv2.drivers.bigip import constants_v2
 import f5_openstack_agent.lbaasv2.drivers.bigip.icontrol_driver as target_mod
 import f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper
 import f5_openstack_agent.lbaasv2.drivers.bigip.utils
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import DeviceFanOut
+from f5_openstack_agent.lbaasv2.drivers.bigip.utils import ServiceQueue
 
 import class_tester_base_class
 import conftest as ct
@@ -62,7 +66,8 @@ class TestiControlDriverMockBuilder(mock_builder_base_class.MockBuilderBase,
         self._construct_others()
         # continue to fill in other_builders as needed...
         mocked_target.operational = True
-        mocked_target.service_queue = []
+        mocked_target.service_queue = ServiceQueue()
+        mocked_target.device_fan_out = DeviceFanOut()
         mocked_target.hostnames = []
         mocked_target.conf = Mock()  # may need to be a shared one...
         mocked_target.hostnames = None
@@ -197,6 +202,16 @@ class TestiControlDriverMockBuilder(mock_builder_base_class.MockBuilderBase,
                           expected_args, kwargs)
         return target
 
+    def mock_get_device_inventory(
+            self, target=None, call_cnt=1, static=None, expected_args=None,
+            **kwargs):
+        """Mocks iControlDriver.get_device_inventory"""
+        if not target:
+            target = self.new_fully_mocked_target()
+        self._mockfactory(target, 'get_device_inventory', static,
+                          call_cnt, expected_args, kwargs)
+        return target
+
     def mock_get_all_deployed_loadbalancers(
             self, target=None, call_cnt=1, static=None, expected_args=None,
             **kwargs):
@@ -500,10 +515,14 @@ class TestiControlDriver(TestiControlDriverMocker,
             builder.mock_get_all_bigips(target, return_value=[bigip])
             li_id = svc['listeners'][0]['id']
             t_id = svc['listeners'][0]['tenant_id']
+            target.system_helper = Mock()
             target.purge_orphaned_listener(t_id, li_id, hostnames)
             builder.check_mocks(target)
             assert resource_helper.return_value.load.call_count
             assert resource_helper.call_count
+            # the deleted listener leaves the resource snapshot
+            target.system_helper.invalidate_snapshot.assert_called_once_with(
+                bigip, target.service_adapter.prefix + t_id)
 
         def error(target, svc, builder, resource_helper, logger, error):
             bigip = Mock()
@@ -645,7 +664,7 @@ class TestiControlDriver(TestiControlDriverMocker,
                   mock_log_utils):
 
         def setup_target(target, svc):
-            target.service_queue = list()
+            target.service_queue = ServiceQueue()
             target._common_service_handler = Mock(return_value='pass')
 
         def setup_plugin_rpc(target, svc):
@@ -681,3 +700,78 @@ class TestiControlDriver(TestiControlDriverMocker,
         without_lb(
             self.mocked_target_with_connection(self.fully_mocked_target()),
             service_with_loadbalancer)
+
+    def test_coalesced_member_updates(self, mocked_target_with_connection,
+                                      service_with_pool, mock_log_utils):
+        target = mocked_target_with_connection
+        target.service_queue = ServiceQueue(4, 'loadbalancer', True)
+        device_passes = []
+
+        def common_service_handler(service):
+            device_passes.append(service)
+            greenthread.sleep(.01)
+
+        target._common_service_handler = \
+            Mock(side_effect=common_service_handler)
+        target._update_target = Mock(return_value=False)
+        service_with_pool.setdefault('members', [])
+        updates = [copy.deepcopy(service_with_pool) for i in range(6)]
+
+        threads = [greenthread.spawn(target.update_member, {}, {}, update)
+                   for update in updates]
+        assert [thread.wait() for thread in threads] == [False] * 6
+
+        # one pass for the request already running, one for the five
+        # updates queued behind it, provisioned with the newest service
+        assert len(device_passes) == 2
+        assert device_passes[0] is updates[0]
+        assert device_passes[1] is updates[-1]
+        assert target.service_queue.get_summary()['merged'] == 4
+
+    def test_orphaned_folder_grace_period(self, mocked_target_with_connection,
+                                          mock_resource_helper,
+                                          mock_log_utils):
+        target = mocked_target_with_connection
+        target.conf.f5_orphaned_folder_age = 300
+        target.empty_folders = {}
+        bigip = Mock(hostname='bigip1')
+        target.get_all_bigips = Mock(return_value=[bigip])
+        target.system_helper.get_folders.return_value = ['UNIT_TESTt1']
+        mock_resource_helper.return_value.get_resources.return_value = []
+
+        with patch.object(target_mod, 'time', return_value=1000):
+            assert target.get_all_deployed_loadbalancers(
+                purge_orphaned_folders=True) == {}
+        # the folder is only purged once it stayed empty long enough
+        assert not target.system_helper.purge_folder.called
+        assert target.empty_folders == {('bigip1', 'UNIT_TESTt1'): 1000}
+
+        with patch.object(target_mod, 'time', return_value=1300):
+            target.get_all_deployed_loadbalancers(purge_orphaned_folders=True)
+        target.system_helper.purge_folder.assert_called_once_with(
+            bigip, 'UNIT_TESTt1')
+        assert target.empty_folders == {}
+
+        # folders which got a virtual address start over
+        target.empty_folders = {('bigip1', 'UNIT_TESTt1'): 1000,
+                                ('bigip1', 'UNIT_TESTgone'): 1000}
+        va = Mock()
+        va.name = 'UNIT_TESTlb1'
+        mock_resource_helper.return_value.get_resources.return_value = [va]
+        assert target.get_all_deployed_loadbalancers() == {'lb1': {
+            'id': 'lb1', 'tenant_id': 't1', 'hostnames': ['bigip1']}}
+        assert target.empty_folders == {}
+
+        # an inventory which predates a new loadbalancer is not trusted
+        # to purge its folder
+        target.empty_folders = {('bigip1', 'UNIT_TESTt1'): 1000}
+        target.system_helper.reset_mock()
+        inventory = Mock()
+        inventory.get_resources.return_value = []
+        inventory.get_folders.return_value = ['UNIT_TESTt1']
+        with patch.object(target_mod, 'time', return_value=1300):
+            assert target.get_all_deployed_loadbalancers(
+                purge_orphaned_folders=True, inventory=inventory) == {}
+        assert not target.system_helper.purge_folder_contents.called
+        assert not target.system_helper.purge_folder.called
+        assert target.empty_folders == {}
@@ -20,6 +20,7 @@ import pytest
 
 from mock import Mock
 from mock import patch
+from requests.exceptions import HTTPError
 
 from f5_openstack_agent.lbaasv2.drivers.bigip.l2_service import \
     _get_tunnel_name
@@ -399,7 +400,7 @@ class Test_L2ServiceBuilder(object):
 
         network_helper = NetworkHelper()
         tunnel = mock.MagicMock()
-        tunnel.records_s.records.exists = mock.MagicMock(return_value=False)
+        tunnel.records = []
 
         bigip = bigips[0]
         bigip.tm.net.fdb.tunnels.tunnel.load = mock.MagicMock(
@@ -407,8 +408,9 @@ class Test_L2ServiceBuilder(object):
         network_helper.add_fdb_entries(bigip, fdb_entries=tunnel_records)
 
         # expect to modify with first member's VTEP and MAC addr
-        tunnel.records_s.records.create.assert_called_with(
-            name='fa:16:3e:0d:fa:c8', endpoint='192.168.130.59')
+        tunnel.modify.assert_called_once_with(records=[
+            {'name': 'fa:16:3e:0d:fa:c8', 'endpoint': '192.168.130.59'}])
+        tunnel.records = tunnel.modify.call_args[1]['records']
 
         # add second member fdb entry
         members = list()
@@ -421,8 +423,25 @@ class Test_L2ServiceBuilder(object):
         network_helper.add_fdb_entries(bigip, fdb_entries=tunnel_records)
 
         # expect to modify with second member's VTEP and MAC addr
-        tunnel.records_s.records.create.assert_called_with(
-            name='fa:16:3e:0d:fa:c6', endpoint='192.168.130.60')
+        tunnel.modify.assert_called_with(records=[
+            {'name': 'fa:16:3e:0d:fa:c8', 'endpoint': '192.168.130.59'},
+            {'name': 'fa:16:3e:0d:fa:c6', 'endpoint': '192.168.130.60'}])
+
+        # records the tunnel already has are not sent again
+        tunnel.records = tunnel.modify.call_args[1]['records']
+        network_helper.add_fdb_entries(bigip, fdb_entries=tunnel_records)
+        assert tunnel.modify.call_count == 2
+
+        # static arps are only created for the new records
+        arp = bigip.tm.net.arps.arp
+        assert arp.create.call_count == 2
+        assert arp.create.call_args[1]['name'] == 'fa:16:3e:0d:fa:c6'
+
+        # an error of the bigip is logged, not raised
+        tunnel.modify.side_effect = HTTPError(response=Mock(status_code=500))
+        tunnel.records = []
+        network_helper.add_fdb_entries(bigip, fdb_entries=tunnel_records)
+        assert arp.create.call_count == 2
 
     def test_network_helper_delete_fdb_entries(
             self, l2_service, service, bigips):
@@ -438,12 +457,9 @@ class Test_L2ServiceBuilder(object):
 
         network_helper = NetworkHelper()
         tunnel = mock.MagicMock()
-        tunnel.exists = mock.MagicMock(return_value=True)
-
-        tunnel_record = mock.MagicMock()
-        tunnel.records_s.records.load = mock.MagicMock(
-            return_value=tunnel_record)
-        tunnel.records_s.records.exist = mock.MagicMock(return_value=True)
+        tunnel.records = [
+            {'name': 'fa:16:3e:0d:fa:c8', 'endpoint': '192.168.130.59'},
+            {'name': 'fa:16:3e:0d:fa:c6', 'endpoint': '192.168.130.60'}]
 
         bigip = bigips[0]
         bigip.tm.net.fdb.tunnels.tunnel.load = mock.MagicMock(
@@ -451,4 +467,13 @@ class Test_L2ServiceBuilder(object):
         network_helper.delete_fdb_entries(bigip, fdb_entries=tunnel_records)
 
         # expect to delete
-        tunnel_record.delete.assert_called()
+        tunnel.modify.assert_called_once_with(records=[
+            {'name': 'fa:16:3e:0d:fa:c8', 'endpoint': '192.168.130.59'}])
+
+        # delete all records
+        tunnel.records = tunnel.modify.call_args[1]['records']
+        network_helper.delete_all_fdb_entries(bigip, 'tunnel')
+        tunnel.modify.assert_called_with(records=[])
+        tunnel.records = []
+        network_helper.delete_all_fdb_entries(bigip, 'tunnel')
+        assert tunnel.modify.call_count == 2
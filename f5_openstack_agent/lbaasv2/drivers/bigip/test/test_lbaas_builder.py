@@ -2116,3 +2116,266 @@ class TestLbaasBuilder(TestLBaaSBuilderConstructor):
             builder._assure_loadbalancer_deleted(svc)
             assert not mock_vaddr.assure.called
             assert loadbalancer['provisioning_status'] == 'ERROR'
+
+
+@pytest.fixture
+def pending_service(service):
+    svc = copy.deepcopy(service)
+    svc['members'][1]['id'] = u'2a9e1b4c-36f0-4d6c-9a48-5b7f0e1f2c3d'
+    svc['healthmonitors'][0]['id'] = svc['pools'][0]['healthmonitor_id']
+    svc['listeners'][0]['loadbalancer_id'] = svc['loadbalancer']['id']
+    for kind in ['listeners', 'healthmonitors', 'members', 'pools']:
+        for obj in svc[kind]:
+            obj['provisioning_status'] = constants_v2.F5_PENDING_UPDATE
+    svc['loadbalancer']['provisioning_status'] = \
+        constants_v2.F5_PENDING_UPDATE
+    return svc
+
+
+@pytest.fixture
+def vip_address():
+    virtual_address = str(
+        'f5_openstack_agent.lbaasv2.drivers.bigip.virtual_address.'
+        'VirtualAddress')
+    with patch(virtual_address) as mock_vaddr:
+        yield mock_vaddr.return_value
+
+
+class TestServiceDiff(object):
+
+    @staticmethod
+    @pytest.fixture
+    def builder():
+        builder = LBaaSBuilder(mock.MagicMock(), mock.MagicMock())
+        builder.conf.f5_incremental_assure = True
+        builder.conf.f5_rest_transactions = False
+        builder.driver.get_config_bigips.return_value = [Mock()]
+        builder.driver.l3_binding = None
+        builder.esd = Mock()
+        builder.esd.is_esd.return_value = False
+        builder._update_subnet_hints = Mock()
+        builder.pool_builder = Mock()
+        builder.pool_builder.create_pool.return_value = None
+        builder.pool_builder.create_healthmonitor.return_value = None
+        builder.listener_builder = Mock()
+        builder.listener_builder.create_listener.return_value = None
+        return builder
+
+    @staticmethod
+    def assure(builder, service):
+        builder.assure_service(copy.deepcopy(service), None, dict())
+
+    def test_unchanged_service_is_skipped(
+            self, builder, vip_address, pending_service):
+        self.assure(builder, pending_service)
+        self.assure(builder, pending_service)
+
+        assert vip_address.assure.call_count == 1
+        assert builder.pool_builder.create_healthmonitor.call_count == 1
+        assert builder.pool_builder.create_pool.call_count == 1
+        assert builder.pool_builder.assure_pool_members.call_count == 1
+        assert builder.listener_builder.create_listener.call_count == 1
+        # loadbalancer, monitor, pool, two members and listener
+        assert builder.get_stats() == {'full': 1, 'incremental': 1,
+                                       'skipped': 6, 'loadbalancers': 1,
+                                       'transactions': 0,
+                                       'transaction_fallbacks': 0}
+
+    def test_changed_member(self, builder, vip_address, pending_service):
+        self.assure(builder, pending_service)
+        pending_service['members'][1]['weight'] = 5
+        self.assure(builder, pending_service)
+
+        assert vip_address.assure.call_count == 1
+        assert builder.pool_builder.create_pool.call_count == 2
+        assert builder.listener_builder.create_listener.call_count == 1
+        svc = builder.pool_builder.assure_pool_members.call_args[0][0]
+        assert [m['id'] for m in svc['members']] == \
+            [pending_service['members'][1]['id']]
+
+    def test_not_pending_objects_are_not_recorded(
+            self, builder, vip_address, pending_service):
+        # an ACTIVE listener is left alone, and asserted once it is pending
+        listener = pending_service['listeners'][0]
+        listener['provisioning_status'] = constants_v2.F5_ACTIVE
+        self.assure(builder, pending_service)
+        listener['provisioning_status'] = constants_v2.F5_PENDING_UPDATE
+        self.assure(builder, pending_service)
+
+        assert builder.listener_builder.create_listener.call_count == 1
+
+    def test_failed_objects_are_retried(
+            self, builder, vip_address, pending_service):
+        builder.pool_builder.create_pool.return_value = 'error'
+        self.assure(builder, pending_service)
+        builder.pool_builder.create_pool.return_value = None
+        self.assure(builder, pending_service)
+        self.assure(builder, pending_service)
+
+        assert builder.pool_builder.create_pool.call_count == 2
+
+    def test_full_assure(self, builder, vip_address, pending_service):
+        self.assure(builder, pending_service)
+        builder.to_sync = True
+        self.assure(builder, pending_service)
+        builder.to_sync = False
+        builder.flush_fingerprints()
+        self.assure(builder, pending_service)
+        builder.conf.f5_incremental_assure = False
+        self.assure(builder, pending_service)
+
+        assert builder.pool_builder.create_pool.call_count == 4
+        assert builder.get_stats()['full'] == 4
+
+    def test_deleted_loadbalancer(
+            self, builder, vip_address, pending_service):
+        self.assure(builder, pending_service)
+        assert builder.fingerprints
+
+        pending_service['loadbalancer']['provisioning_status'] = \
+            constants_v2.F5_PENDING_DELETE
+        self.assure(builder, pending_service)
+        assert not builder.fingerprints
+
+    def test_exception_drops_fingerprint(
+            self, builder, vip_address, pending_service):
+        self.assure(builder, pending_service)
+        builder.listener_builder.create_listener.side_effect = IOError
+        pending_service['listeners'][0]['connection_limit'] = 100
+        with pytest.raises(IOError):
+            self.assure(builder, pending_service)
+        assert not builder.fingerprints
+
+
+class TestServiceTransactions(object):
+
+    @staticmethod
+    @pytest.fixture
+    def transaction():
+        transaction = Mock()
+        scope = str('f5_openstack_agent.lbaasv2.drivers.bigip.lbaas_builder.'
+                    'transaction_scope')
+        with patch(scope) as mock_scope:
+            mock_scope.begin.return_value = {'bigip1': transaction}
+            yield transaction
+
+    @staticmethod
+    @pytest.fixture
+    def builder(transaction):
+        builder = LBaaSBuilder(mock.MagicMock(), mock.MagicMock())
+        builder.conf.f5_incremental_assure = True
+        builder.conf.f5_rest_transactions = True
+        bigip = Mock()
+        bigip.hostname = 'bigip1'
+        builder.driver.get_config_bigips.return_value = [bigip]
+        builder.driver.l3_binding = None
+        builder.esd = Mock()
+        builder.esd.is_esd.return_value = False
+        builder._update_subnet_hints = Mock()
+        builder.pool_builder = Mock()
+        builder.pool_builder.create_pool.return_value = None
+        builder.pool_builder.create_healthmonitor.return_value = None
+        builder.listener_builder = Mock()
+        builder.listener_builder.create_listener.return_value = None
+        return builder
+
+    def test_committed(self, builder, transaction, vip_address,
+                       pending_service):
+        def commit():
+            # members are reconciled once the pools are on the devices
+            assert not builder.pool_builder.assure_pool_members.called
+
+        transaction.commit.side_effect = commit
+        builder.assure_service(pending_service, None, dict())
+
+        assert transaction.commit.call_count == 1
+        assert builder.pool_builder.create_pool.call_count == 1
+        assert builder.pool_builder.assure_pool_members.call_count == 1
+        assert builder.fingerprints
+        stats = builder.get_stats()
+        assert stats['transactions'] == 1
+        assert stats['transaction_fallbacks'] == 0
+
+    def test_commit_failure_falls_back(self, builder, transaction,
+                                       vip_address, pending_service):
+        transaction.commit.side_effect = HTTPError('commit failed')
+        listener = pending_service['listeners'][0]
+        builder.listener_builder.create_listener.side_effect = [
+            'error', None]
+        builder.assure_service(pending_service, None, dict())
+
+        # the failed attempt must not leave the listener in ERROR, or the
+        # individual requests would skip it
+        assert builder.listener_builder.create_listener.call_count == 2
+        assert builder.pool_builder.create_pool.call_count == 2
+        assert builder.pool_builder.assure_pool_members.call_count == 1
+        assert listener['provisioning_status'] == \
+            constants_v2.F5_PENDING_UPDATE
+        assert builder.get_stats()['transaction_fallbacks'] == 1
+        assert builder.get_stats()['skipped'] == 0
+
+    def test_exception_discards(self, builder, transaction, vip_address,
+                                pending_service):
+        builder.pool_builder.create_pool.side_effect = IOError
+        with pytest.raises(IOError):
+            builder.assure_service(pending_service, None, dict())
+
+        assert transaction.discard.called
+        assert not transaction.commit.called
+
+
+def test_update_operating_statuses(service):
+    builder = LBaaSBuilder(mock.MagicMock(), mock.MagicMock())
+    adapter = builder.service_adapter
+    adapter.get_folder_name.side_effect = lambda tenant_id: 'Project_' + \
+        tenant_id
+    adapter.init_pool_name.side_effect = lambda lb, pool: dict(
+        name='pool_' + pool['id'], partition='Project_' + lb['tenant_id'])
+    adapter.get_member.side_effect = lambda svc: dict(
+        name='%s:%s' % (svc['member']['address'],
+                        svc['member']['protocol_port']))
+    services = [copy.deepcopy(service), copy.deepcopy(service)]
+    services[1]['loadbalancer']['tenant_id'] = 'other'
+    for svc in services:
+        for member in svc['members']:
+            member['provisioning_status'] = constants_v2.F5_ACTIVE
+            member['operating_status'] = 'ONLINE'
+
+    lb = services[0]['loadbalancer']
+    pool_id = services[0]['members'][0]['pool_id']
+    member = services[0]['members'][0]
+    states = {('Project_' + lb['tenant_id'], 'pool_' + pool_id,
+               '%s:%s' % (member['address'], member['protocol_port'])):
+              {'status.availabilityState': 'offline'}}
+    builder.pool_builder = Mock()
+    builder.pool_builder.get_member_states.return_value = states
+
+    builder.update_operating_statuses(services)
+
+    # one read for both tenants of both loadbalancers
+    builder.pool_builder.get_member_states.assert_called_once_with(
+        builder.driver.get_active_bigip.return_value,
+        set(['Project_' + lb['tenant_id'], 'Project_other']))
+    assert member['operating_status'] == constants_v2.F5_OFFLINE
+    # members not found on the device keep their status
+    assert services[0]['members'][1]['operating_status'] == 'ONLINE'
+    assert services[1]['members'][0]['operating_status'] == 'ONLINE'
+
+
+def test_get_loadbalancer_stats():
+    builder = LBaaSBuilder(mock.MagicMock(), mock.MagicMock())
+    bigip1, bigip2 = Mock(hostname='bigip1'), Mock(hostname='bigip2')
+    builder.driver.get_config_bigips.return_value = [bigip1, bigip2]
+    builder.listener_builder = Mock()
+    builder.listener_builder.get_loadbalancer_stats.side_effect = [
+        {'lb1': {'clientside.bitsIn': 8}, 'other': {'clientside.bitsIn': 1}},
+        {'lb1': {'clientside.bitsIn': 16}}]
+
+    stats = builder.get_loadbalancer_stats(
+        ['lb1', 'lb2'], ['clientside.bitsIn'])
+
+    # summed for both devices, unknown loadbalancers are left out
+    assert stats == {'lb1': {'clientside.bitsIn': 24},
+                     'lb2': {'clientside.bitsIn': 0}}
+    builder.listener_builder.get_loadbalancer_stats.assert_any_call(
+        bigip1, ['clientside.bitsIn'])
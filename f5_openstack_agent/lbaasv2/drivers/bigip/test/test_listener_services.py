@@ -126,8 +126,8 @@ class TestListenerServiceBuilder(TestListenerServiceBuilderBuilder):
         assert isinstance(target.cert_manager, Mock)
         assert isinstance(target.parent_ssl_profile, Mock)
         assert isinstance(target.parent_ssl_profile, Mock)
-        self.resource_bigip.assert_called_once_with(
-            self.resource_type.virtual)
+        self.resource_bigip.assert_any_call(self.resource_type.virtual)
+        self.resource_bigip.assert_any_call(self.resource_type.rule)
 
     def test_create_listener(self, target, service_with_loadbalancer,
                              service_with_listener):
@@ -621,3 +621,77 @@ class TestListenerServiceBuilder(TestListenerServiceBuilderBuilder):
 
         self.creation_mode_listener(svc, svc['listeners'][0])
         negative_full_path(target, svc, esd)
+
+
+def virtual_stats(name, destination, bits_in, conns):
+    link = 'https://localhost/mgmt/tm/ltm/virtual/%s/stats' % \
+        name.replace('/', '~')
+    return {link: {'nestedStats': {'entries': {
+        'tmName': {'description': name},
+        'destination': {'description': destination},
+        'clientside.bitsIn': {'value': bits_in},
+        'clientside.curConns': {'value': conns}}}}}
+
+
+def test_get_loadbalancer_stats():
+    adapter = Mock()
+    adapter.prefix = 'Project_'
+    builder = listener_service.ListenerServiceBuilder(adapter, Mock())
+    bigip = Mock()
+    bigip._meta_data = {'uri': 'https://bigip/mgmt/tm/'}
+    entries = {}
+    entries.update(virtual_stats('/Project_t1/Project_l1',
+                                 '/Project_t1/10.0.0.5%2:80', 8, 1))
+    entries.update(virtual_stats('/Project_t1/Project_l2',
+                                 '/Project_t1/Project_lb1:443', 16, 2))
+    entries.update(virtual_stats('/Project_t2/Project_l3',
+                                 '/Project_t2/2001:db8::5%3.80', 32, 3))
+    entries.update(virtual_stats('/Common/vs', '/Common/10.0.0.5%2:80',
+                                 64, 4))
+    addresses = {'items': [
+        dict(name='Project_lb1', partition='Project_t1',
+             address='10.0.0.5%2'),
+        dict(name='Project_lb2', partition='Project_t2',
+             address='2001:db8::5%3'),
+        dict(name='10.0.0.5%2', partition='Common', address='10.0.0.5%2')]}
+
+    def get(uri):
+        response = Mock()
+        response.json.return_value = addresses if \
+            uri.endswith('virtual-address') else {'entries': entries}
+        return response
+    bigip.icrs.get.side_effect = get
+
+    stats = builder.get_loadbalancer_stats(
+        bigip, ['clientside.bitsIn', 'clientside.curConns',
+                'clientside.totConns'])
+
+    assert bigip.icrs.get.call_count == 2
+    assert stats == {
+        'lb1': {'clientside.bitsIn': 24, 'clientside.curConns': 3,
+                'clientside.totConns': 0},
+        'lb2': {'clientside.bitsIn': 32, 'clientside.curConns': 3,
+                'clientside.totConns': 0}}
+
+
+def test_cookie_persist_rule_snapshot():
+    resource_helper = f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper
+    builder = listener_service.ListenerServiceBuilder(Mock(), Mock())
+    bigip = Mock()
+    bigip.tmos_version = '12.1.0'
+    bigip.resource_snapshot = resource_helper.ResourceSnapshot()
+    bigip.tm.ltm.rules.get_collection.return_value = []
+    rule = Mock()
+    rule.name = 'app_cookie_vs1'
+    bigip.tm.ltm.rules.rule.create.return_value = rule
+    vip = {'name': 'vs1', 'partition': 'Project_1'}
+
+    # the rule is created and deleted through the snapshot
+    builder._add_cookie_persist_rule(
+        vip, {'cookie_name': 'session'}, bigip)
+    assert bigip.resource_snapshot.get(
+        builder.rule_helper, bigip, 'Project_1') == {'app_cookie_vs1': rule}
+    builder._remove_cookie_persist_rule(vip, bigip)
+    rule.delete.assert_called_once_with()
+    assert bigip.resource_snapshot.get(
+        builder.rule_helper, bigip, 'Project_1') == {}
@@ -459,5 +459,129 @@ class TestNetworkHelper(TestNetworkHelperBuilder):
             assert target.get_virtual_service_insertion(
                 bigip, partition=bigip.partition) == expected
 
-        valid_virtual_address(fully_mocked_target)
-        invalid_virtual_address(fully_mocked_target)
+        freeze_get_resources = BigIPResourceHelper.get_resources
+        freeze_load = BigIPResourceHelper.load
+        try:
+            valid_virtual_address(fully_mocked_target)
+            invalid_virtual_address(fully_mocked_target)
+        finally:
+            BigIPResourceHelper.get_resources = freeze_get_resources
+            BigIPResourceHelper.load = freeze_load
+
+    def test_concurrent_modify_fdb_records(self, conf_less_target):
+        from eventlet import greenpool
+        from eventlet import greenthread
+
+        tunnel_records = []
+
+        class Tunnel(object):
+            def __init__(self):
+                self.records = list(tunnel_records)
+
+            def modify(self, records):
+                greenthread.sleep(0)
+                tunnel_records[:] = records
+
+        def load(name, partition):
+            # loading yields to the other update, as a REST call does
+            greenthread.sleep(0)
+            return Tunnel()
+
+        bigip = Mock(hostname='bigip1')
+        bigip.tm.net.fdb.tunnels.tunnel.load.side_effect = load
+        pool = greenpool.GreenPool()
+        for mac in ('fa:16:3e:00:00:01', 'fa:16:3e:00:00:02'):
+            pool.spawn_n(conf_less_target.modify_fdb_records, bigip,
+                         'tunnel-vxlan-1', add={mac: '10.30.30.2'},
+                         partition='Project_1')
+        pool.waitall()
+
+        # neither update lost the record of the other
+        assert sorted(record['name'] for record in tunnel_records) == \
+            ['fa:16:3e:00:00:01', 'fa:16:3e:00:00:02']
+        assert not f5_openstack_agent.lbaasv2.drivers.bigip.network_helper.\
+            tunnel_records_locks.semaphores
+
+
+class TestRouteDomainIdAllocator(object):
+    @staticmethod
+    @pytest.fixture
+    def allocator():
+        return f5_openstack_agent.lbaasv2.drivers.bigip.network_helper.\
+            RouteDomainIdAllocator(max_id=20)
+
+    def test_allocate(self, allocator):
+        list_ids = Mock(return_value={
+            'bigip1': [0, 1, 2, 4, 8, 9, 10, 11, 12, 13, 14, 15]})
+        assert allocator.allocate(list_ids) == 3
+        assert allocator.allocate(list_ids) == 5
+        assert allocator.allocate(list_ids) == 6
+        assert allocator.allocate(list_ids) == 7
+        # a full byte of the bitmap is skipped
+        assert allocator.allocate(list_ids) == 16
+        assert list_ids.call_count == 1
+
+        allocator.release(4, 'bigip1')
+        assert not allocator.in_use(4)
+        assert allocator.allocate(list_ids) == 4
+        # the Common route domain is never handed out
+        allocator.release(0)
+        assert allocator.in_use(0)
+
+        # ids created elsewhere are reloaded once invalidated
+        allocator.invalidate()
+        list_ids.return_value = {'bigip1': [17], 'bigip2': [18]}
+        assert allocator.allocate(list_ids) == 19
+        assert allocator.allocate(list_ids) == 20
+        assert list_ids.call_count == 2
+        with pytest.raises(LookupError):
+            allocator.allocate(list_ids)
+
+    def test_concurrent_allocate(self, allocator):
+        from eventlet import greenpool
+        from eventlet import greenthread
+
+        def list_ids():
+            # seeding yields to the other allocations, as a REST call does
+            greenthread.sleep(0)
+            return {'bigip1': [0, 1]}
+
+        pool = greenpool.GreenPool()
+        rd_ids = list(pool.imap(lambda i: allocator.allocate(list_ids),
+                                range(10)))
+        assert sorted(rd_ids) == list(range(2, 12))
+
+    def test_create_delete_route_domain(self, allocator):
+        network_helper = \
+            f5_openstack_agent.lbaasv2.drivers.bigip.network_helper
+        target = network_helper.NetworkHelper()
+        bigips = [Mock(hostname='bigip1'), Mock(hostname='bigip2')]
+
+        class RouteDomain(object):
+            def __init__(self, rd_id):
+                self.id = rd_id
+
+            def delete(self):
+                # f5-sdk drops the attributes of a deleted resource
+                self.__dict__ = {'deleted': True}
+
+        with patch.object(network_helper, 'route_domain_ids', allocator):
+            for bigip in bigips:
+                target.create_route_domain(bigip, 7, partition='Project_1')
+                bigip.tm.net.route_domains.route_domain.load.return_value = \
+                    RouteDomain(7)
+            assert allocator.in_use(7)
+
+            # the id is freed once no bigip has the route domain
+            target.delete_route_domain(bigips[0], partition='Project_1')
+            assert allocator.in_use(7)
+            target.delete_route_domain(bigips[1], partition='Project_1')
+            assert not allocator.in_use(7)
+
+            bigip = bigips[0]
+            allocator.seed({})
+            bigip.tm.net.route_domains.route_domain.create.side_effect = \
+                HTTPError('exists')
+            with pytest.raises(HTTPError):
+                target.create_route_domain(bigip, 7, partition='Project_1')
+            assert not allocator.seeded
@@ -18,12 +18,16 @@ from collections import namedtuple
 from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
 from f5_openstack_agent.lbaasv2.drivers.bigip.network_service import \
     NetworkServiceBuilder
+from f5_openstack_agent.lbaasv2.drivers.bigip.network_service import \
+    RouteDomainCache
 from f5_openstack_agent.lbaasv2.drivers.bigip.service_adapter import \
     ServiceModelAdapter
+import f5_openstack_agent.lbaasv2.drivers.bigip.test.conftest as ct
 
 import mock
 import netaddr
 import pytest
+import time
 
 
 @pytest.fixture
@@ -445,6 +449,72 @@ class TestNetworkServiceBuilder(object):
             network['provider:network_type'] = ''
             network_service.assign_route_domain(tenant_id, network, subnet)
 
+    def test_warm_rds_cache(self, network_service):
+        RouteDomain = namedtuple('RouteDomain', 'id partition vlans')
+        Vlan = namedtuple('Vlan', 'name partition tag')
+        Tunnel = namedtuple('Tunnel', 'name partition key')
+        SelfIp = namedtuple('SelfIp', 'name partition vlan address')
+        network_service.conf.f5_route_domain_cache_refresh_interval = 0
+        network_service.service_adapter.prefix = 'Project_'
+        partition = 'Project_tenant1'
+        bigip = mock.Mock(device_name='bigip1')
+        network_service.driver.get_all_bigips.return_value = [bigip]
+        network_service.route_domain_manager = mock.Mock()
+        network_service.route_domain_manager.get_resources.return_value = [
+            RouteDomain(0, 'Common', ['/Common/http-tunnel']),
+            RouteDomain(2, partition, ['/%s/vlan-1' % partition,
+                                       'tunnel-vxlan-2']),
+            RouteDomain(3, partition, [])]
+        network_service.vlan_manager = mock.Mock()
+        network_service.vlan_manager.get_resources.return_value = [
+            Vlan('vlan-1', partition, 101)]
+        network_service.tunnel_manager = mock.Mock()
+        network_service.tunnel_manager.get_resources.return_value = [
+            Tunnel('http-tunnel', 'Common', 0),
+            Tunnel('tunnel-vxlan-2', partition, 52)]
+        network_service.selfip_manager = mock.Mock()
+        network_service.selfip_manager.get_resources.return_value = [
+            SelfIp('local-bigip1-subnet1', partition,
+                   '/%s/vlan-1' % partition, '10.1.0.2%2/24'),
+            SelfIp('local-bigip1-subnet2', partition,
+                   '/%s/tunnel-vxlan-2' % partition, '10.2.0.2%2/24'),
+            SelfIp('local-bigip1-subnet3', 'Common',
+                   '/%s/vlan-1' % partition, '10.3.0.2/24')]
+
+        network_service.post_init()
+        network_service.update_rds_cache('tenant1')
+        assert not network_service.network_helper.get_route_domain_ids.called
+        assert network_service.rds_cache['tenant1'] == {2: {
+            'vlan-101': {'subnets': {
+                'subnet1': {'cidr': netaddr.IPNetwork('10.1.0.0/24')}}},
+            'vxlan-52': {'subnets': {
+                'subnet2': {'cidr': netaddr.IPNetwork('10.2.0.0/24')}}}}}
+        # one listing of each kind per bigip
+        assert network_service.selfip_manager.get_resources.call_count == 1
+
+        # a bigip which cannot be listed leaves the cache as it was
+        network_service.rds_cache = {}
+        network_service.selfip_manager.get_resources.side_effect = \
+            Exception('down')
+        network_service.warm_rds_cache()
+        assert network_service.rds_cache == {}
+
+        # a subnet removed while the bigips are listed is not added back
+        def remove_subnet1(bigip):
+            network_service.rd_cache.remove_subnet('vlan-101', 'subnet1')
+            return selfips
+
+        selfips = network_service.selfip_manager.get_resources.return_value
+        network_service.selfip_manager.get_resources.side_effect = \
+            remove_subnet1
+        network_service.warm_rds_cache()
+        assert network_service.rds_cache['tenant1'] == {2: {
+            'vxlan-52': {'subnets': {
+                'subnet2': {'cidr': netaddr.IPNetwork('10.2.0.0/24')}}}}}
+        assert 'subnet1' not in network_service.rd_cache.subnets
+        assert 'vlan-101' not in network_service.rd_cache.networks
+        assert not network_service.rd_cache.removals
+
     def test_get_subnets_to_assure(self, network_service, service):
         net_id = '8f398b94-635e-4a58-9f70-bf4d93f206a6'
 
@@ -496,3 +566,76 @@ class TestNetworkServiceBuilder(object):
                 item for item in items if item['subnet']['name'] == name)
         except StopIteration:
             return None
+
+
+class TestRouteDomainCache(object):
+    def test_indexes(self, rds_cache):
+        cache = RouteDomainCache(rds_cache)
+        tenant_id = 'f2a944c28b5d43ad808cc28ba1f03cce'
+        assert cache.get_route_domain('vlan-608') == 2
+        assert cache.get_route_domain('vlan-600') is None
+        assert cache.get_subnet_route_domain(
+            tenant_id, '1189a88f-0fe7-4d0e-8549-b557d7f7e98b') == 1
+
+        cache.add_subnet(tenant_id, 3, 'vxlan-10', 'subnet1',
+                         netaddr.IPNetwork('10.0.0.0/24'))
+        assert cache.get_route_domain('vxlan-10') == 3
+        assert cache.get_subnet_route_domain(tenant_id, 'subnet1') == 3
+
+        # the network and route domain go with their last subnet
+        cache.remove_subnet('vxlan-10', 'subnet1')
+        assert cache.get_route_domain('vxlan-10') is None
+        assert 3 not in cache.tenants[tenant_id]
+        cache.remove_subnet('vlan-606', '1189a88f-0fe7-4d0e-8549-b557d7f7e98b')
+        assert cache.get_route_domain('vlan-606') == 1
+
+        stats = cache.get_stats()
+        assert stats['hits'] == 5
+        assert stats['misses'] == 2
+        assert stats['tenants'] == 3
+
+    @staticmethod
+    def fill_cache(tenants):
+        cache = RouteDomainCache()
+        for i in range(tenants):
+            for rd_id in (1, 2):
+                net = 'vlan-%d' % (i * 2 + rd_id)
+                cache.add_subnet('tenant-%d' % i, rd_id, net,
+                                 'subnet-%d-%d' % (i, rd_id),
+                                 netaddr.IPNetwork('10.%d.%d.0/24'
+                                                   % (rd_id, i % 250)))
+        return cache
+
+    @staticmethod
+    def lookup(cache, tenants):
+        for i in range(tenants):
+            assert cache.get_route_domain('vlan-%d' % (i * 2 + 2)) == 2
+            assert cache.get_subnet_route_domain(
+                'tenant-%d' % i, 'subnet-%d-1' % i) == 1
+
+    @staticmethod
+    def remove(cache, tenants):
+        for i in range(tenants):
+            cache.remove_subnet('vlan-%d' % (i * 2 + 1), 'subnet-%d-1' % i)
+        assert cache.get_stats()['networks'] == tenants
+
+    def test_many_tenants(self):
+        """Lookups and removals in the cache of many tenants."""
+        cache = self.fill_cache(100)
+        self.lookup(cache, 100)
+        self.remove(cache, 100)
+
+    @ct.benchmark
+    def test_benchmark(self):
+        """Lookups and removals in the cache of 5,000 tenants."""
+        tenants = 5000
+        cache = self.fill_cache(tenants)
+
+        start = time.time()
+        self.lookup(cache, tenants)
+        lookups = time.time() - start
+
+        start = time.time()
+        self.remove(cache, tenants)
+        removals = time.time() - start
+        assert lookups < 1.0 and removals < 1.0
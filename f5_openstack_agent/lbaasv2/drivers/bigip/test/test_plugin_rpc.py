@@ -23,6 +23,7 @@ from mock import patch
 import oslo_messaging as messaging
 
 import f5_openstack_agent.lbaasv2.drivers.bigip.constants_v2 as constants
+import f5_openstack_agent.lbaasv2.drivers.bigip.exceptions as f5_ex
 import f5_openstack_agent.lbaasv2.drivers.bigip.plugin_rpc as target_mod
 
 import class_tester_base_class
@@ -75,6 +76,7 @@ class TestPluginRpcMockBuilder(mock_builder_base_class.MockBuilderBase):
         mocked_target.env = 'env'
         mocked_target.group = 'group'
         mocked_target.host = 'host'
+        mocked_target.rpc_stats = {}
         return mocked_target
 
     def mock_get_clusterwide_agent(self, target=None, call_cnt=1,
@@ -259,3 +261,80 @@ class TestPluginRpc(TestPluginRpcConstructor,
         positive_case_no_loadbalancers(target, get_uuid, populated_payload)
         positive_case_loadbalancers(target, get_uuid, empty_payload)
         negative_case(target, get_uuid, self.m_logger)
+
+    def test_get_services_by_loadbalancer_ids(self, target):
+        target._call = Mock(side_effect=lambda context, msg, topic: dict(
+            (lb_id, {'id': lb_id})
+            for lb_id in msg['args']['loadbalancer_ids'] if lb_id != 'lb3'))
+        target.get_service_by_loadbalancer_id = Mock(return_value='single')
+        target.service_page_size = 2
+
+        services = target.get_services_by_loadbalancer_ids(
+            ['lb1', 'lb2', 'lb3'])
+
+        # one call per page, loadbalancers missing from the answer are
+        # left out
+        assert target._call.call_count == 2
+        assert services == {'lb1': {'id': 'lb1'}, 'lb2': {'id': 'lb2'}}
+        assert not target.get_service_by_loadbalancer_id.called
+
+        target._call.side_effect = messaging.RemoteError('NoSuchMethod')
+        services = target.get_services_by_loadbalancer_ids(['lb1', 'lb2'])
+        assert services == {'lb1': 'single', 'lb2': 'single'}
+        assert not target.bulk_methods['get_services_by_loadbalancer_ids']
+        assert target._call.call_count == 3
+
+    def test_update_statuses(self, target):
+        target._call = Mock(side_effect=messaging.RemoteError('NoSuchMethod'))
+        target.update_l7rule_status = Mock()
+        target.member_destroyed = Mock()
+        statuses = [{'resource': 'l7rule', 'id': 'rule1',
+                     'l7policy_id': 'policy1',
+                     'provisioning_status': 'ACTIVE',
+                     'operating_status': 'ONLINE'},
+                    {'resource': 'member', 'id': 'member1',
+                     'destroyed': True}]
+
+        # plugins without the bulk RPC get one RPC per object
+        target.update_statuses(statuses)
+        target.update_l7rule_status.assert_called_once_with(
+            'rule1', l7policy_id='policy1', provisioning_status='ACTIVE',
+            operating_status='ONLINE')
+        target.member_destroyed.assert_called_once_with('member1')
+        assert not target.bulk_methods['update_statuses']
+
+        target.update_statuses(statuses)
+        assert target._call.call_count == 1
+        assert target.member_destroyed.call_count == 2
+
+        # only the statuses which could not be sent are reported
+        target.update_l7rule_status.side_effect = Exception('down')
+        with pytest.raises(f5_ex.StatusUpdatesFailed) as err:
+            target.update_statuses(statuses)
+        assert err.value.statuses == statuses[:1]
+        assert target.member_destroyed.call_count == 3
+
+    def test_rpc_stats(self, target):
+        callee = target._client.prepare.return_value
+        target._call(target.context, target._make_msg('get_foo'),
+                     topic=target.topic)
+        target._cast(target.context, target._make_msg('update_foo'),
+                     topic=target.topic)
+        callee.call.side_effect = messaging.MessagingTimeout
+        with pytest.raises(messaging.MessagingTimeout):
+            target._call(target.context, target._make_msg('get_foo'),
+                         topic=target.topic)
+        callee.cast.side_effect = ValueError
+        with pytest.raises(ValueError):
+            target._cast(target.context, target._make_msg('update_foo'),
+                         topic=target.topic)
+
+        stats = target.get_rpc_stats()
+        assert stats['get_foo']['calls'] == 2
+        assert stats['get_foo']['timeouts'] == 1
+        assert stats['get_foo']['in_flight'] == 0
+        assert stats['get_foo']['latency']['0.01'] == 2
+        assert stats['update_foo']['casts'] == 2
+        assert stats['update_foo']['errors'] == 1
+        assert sum(stats['update_foo']['latency'].values()) == 2
+        assert len(target.get_rpc_summary()) == 2
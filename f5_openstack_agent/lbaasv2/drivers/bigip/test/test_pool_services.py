@@ -81,6 +81,11 @@ class TestPoolServiceBuilderBuilder(TestPoolServiceBuilderConstructor):
 
     def cleanup(self):
         pool_service.LOG = self.freeze_log
+        if hasattr(self, 'freeze_resource_bigip'):
+            f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper.\
+                BigIPResourceHelper = self.freeze_resource_bigip
+            f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper.\
+                ResourceType = self.freeze_resource_type
 
     def clean_svc_with_pool(self):
         svc = self.service_with_network(self.new_id())
@@ -543,20 +548,61 @@ class TestPoolServiceBuilder(TestPoolServiceBuilderBuilder):
             bigip, urllib.quote(node['name']), node['partition'])
         assert error
 
+    @staticmethod
+    def rest_bigip():
+        bigip = Mock()
+        bigip.hostname = 'bigip1'
+        bigip._meta_data = {'uri': 'https://bigip1/mgmt/tm/'}
+        return bigip
+
+    @staticmethod
+    def deployed_members(p_obj, *names):
+        members = list()
+        for name in names:
+            member = Mock()
+            member.name = name
+            members.append(member)
+        p_obj.members_s.get_collection.return_value = members
+
     def test_assure_pool_members_exists(self, target, pool_member_service):
         service = pool_member_service
         pool = dict(name='name', partition='partition')
         target.service_adapter.get_pool.return_value = pool
         target.service_adapter.get_member.return_value = \
-            dict(name='member_name', partition='partition')
+            dict(name='member_name', partition='partition', address='addr')
         p_obj = Mock()
         target.pool_helper.load.return_value = p_obj
-        p_obj.members_s.members.exists.return_value = True
-        bigips = [Mock()]
+        self.deployed_members(p_obj, 'member_name')
+        bigip = self.rest_bigip()
 
-        target.assure_pool_members(service, bigips)
+        target.assure_pool_members(service, [bigip])
 
         assert target.service_adapter.get_member.call_count == 2
+        assert p_obj.members_s.get_collection.call_count == 1
+        assert not p_obj.members_s.members.exists.called
+        assert not bigip.icrs.post.called
+        for member in service['members']:
+            assert 'missing' not in member
+
+    def test_assure_pool_members_1_created(self, target,
+                                           pool_member_service):
+        service = pool_member_service
+        pool = dict(name='name', partition='partition')
+        target.service_adapter.get_pool.return_value = pool
+        bigip_members = [
+            dict(name='member1', partition='partition', address='addr1'),
+            dict(name='member2', partition='partition', address='addr2')]
+        target.service_adapter.get_member.side_effect = bigip_members
+        p_obj = Mock()
+        target.pool_helper.load.return_value = p_obj
+        self.deployed_members(p_obj, 'member2')
+        bigip = self.rest_bigip()
+
+        target.assure_pool_members(service, [bigip])
+
+        bigip.icrs.post.assert_called_once_with(
+            'https://bigip1/mgmt/tm/ltm/pool/~partition~name/members',
+            json=bigip_members[0])
         for member in service['members']:
             assert 'missing' not in member
 
@@ -564,14 +610,17 @@ class TestPoolServiceBuilder(TestPoolServiceBuilderBuilder):
         service = pool_member_service
         pool = dict(name='name', partition='partition')
         target.service_adapter.get_pool.return_value = pool
-        target.service_adapter.get_member.return_value = \
-            dict(name='member_name', partition='partition')
+        target.service_adapter.get_member.side_effect = [
+            dict(name='member1', partition='partition', address='addr1'),
+            dict(name='member2', partition='partition', address='addr2')]
         p_obj = Mock()
         target.pool_helper.load.return_value = p_obj
-        p_obj.members_s.members.exists.side_effect = [False, True]
-        bigips = [Mock()]
+        self.deployed_members(p_obj, 'member2')
+        bigip = self.rest_bigip()
+        bigip.icrs.post.side_effect = MockHTTPError(
+            MockHTTPErrorResponse400())
 
-        target.assure_pool_members(service, bigips)
+        target.assure_pool_members(service, [bigip])
 
         assert target.service_adapter.get_member.call_count == 2
         assert 'missing' in service['members'][0]
@@ -581,15 +630,20 @@ class TestPoolServiceBuilder(TestPoolServiceBuilderBuilder):
         service = pool_member_service
         pool = dict(name='name', partition='partition')
         target.service_adapter.get_pool.return_value = pool
-        target.service_adapter.get_member.return_value = \
-            dict(name='member_name', partition='partition')
+        target.service_adapter.get_member.side_effect = [
+            dict(name='member1', partition='partition', address='addr1'),
+            dict(name='member2', partition='partition', address='addr2')]
         p_obj = Mock()
         target.pool_helper.load.return_value = p_obj
-        p_obj.members_s.members.exists.return_value = False
-        bigips = [Mock()]
+        self.deployed_members(p_obj)
+        bigip = self.rest_bigip()
+        bigip.icrs.post.side_effect = MockHTTPError(
+            MockHTTPErrorResponse400())
 
-        target.assure_pool_members(service, bigips)
+        target.assure_pool_members(service, [bigip])
 
+        # the transaction could not be opened, then both creates failed
+        assert bigip.icrs.post.call_count == 3
         assert target.service_adapter.get_member.call_count == 2
         for member in service['members']:
             assert 'missing' in member
@@ -599,17 +653,17 @@ class TestPoolServiceBuilder(TestPoolServiceBuilderBuilder):
         pool = dict(name='name', partition='partition')
         target.service_adapter.get_pool.return_value = pool
         target.service_adapter.get_member.return_value = \
-            dict(name='member_name', partition='partition')
+            dict(name='member_name', partition='partition', address='addr')
         p_obj = Mock()
         target.pool_helper.load.side_effect = \
             MockHTTPError(MockHTTPErrorResponse400())
-        p_obj.members_s.members.exists.return_value = False
-        bigips = [Mock()]
+        bigip = self.rest_bigip()
 
-        target.assure_pool_members(service, bigips)
+        target.assure_pool_members(service, [bigip])
 
         assert target.service_adapter.get_member.call_count == 2
-        assert not p_obj.members_s.members.exists.called
+        assert not p_obj.members_s.get_collection.called
+        assert not bigip.icrs.post.called
         for member in service['members']:
             assert 'missing' in member
 
@@ -619,20 +673,179 @@ class TestPoolServiceBuilder(TestPoolServiceBuilderBuilder):
         pool = dict(name='name', partition='partition')
         target.service_adapter.get_pool.return_value = pool
         target.service_adapter.get_member.return_value = \
-            dict(name='member_name', partition='partition')
+            dict(name='member_name', partition='partition', address='addr')
+        target.service_adapter.get_member_node.return_value = \
+            dict(name='10.2.2.1%2', partition='partition')
         p_obj = Mock()
         target.pool_helper.load.side_effect = \
             MockHTTPError(MockHTTPErrorResponse400())
-        p_obj.members_s.members.exists.return_value = False
-        target._delete_member_node = Mock()
-        bigips = [Mock()]
+        bigip = self.rest_bigip()
+        bigip.icrs.delete.side_effect = MockHTTPError(
+            MockHTTPErrorResponse400())
         service['members'][0]['provisioning_status'] = \
             "PENDING_DELETE"
-        target.assure_pool_members(service, bigips)
+        target.assure_pool_members(service, [bigip])
 
         assert target.service_adapter.get_member.call_count == 1
-        assert target._delete_member_node.call_count == 1
-        assert not p_obj.members_s.members.exists.called
+        bigip.icrs.delete.assert_called_once_with(
+            'https://bigip1/mgmt/tm/ltm/node/~partition~10.2.2.1%252')
+        assert not target.node_helper.delete.called
+        assert not p_obj.members_s.get_collection.called
 
         assert 'missing' not in service['members'][0]
         assert 'missing' in service['members'][1]
+
+    def test_assure_pool_members_shared_node(
+            self, target, pool_member_service):
+        service = pool_member_service
+        pool = dict(name='name', partition='partition')
+        target.service_adapter.get_pool.return_value = pool
+        target.service_adapter.get_member.return_value = \
+            dict(name='addr:8080', partition='partition', address='addr')
+        target.service_adapter.get_member_node.return_value = \
+            dict(name='addr', partition='partition')
+        p_obj = Mock()
+        target.pool_helper.load.return_value = p_obj
+        self.deployed_members(p_obj, 'addr:8080')
+        bigip = self.rest_bigip()
+        service['members'][0]['provisioning_status'] = \
+            "PENDING_DELETE"
+        target.assure_pool_members(service, [bigip])
+
+        assert not bigip.icrs.delete.called
+        for member in service['members']:
+            assert 'missing' not in member
+
+    def test_get_member_states(self, target):
+        pool = Mock()
+        pool.name = 'pool1'
+        pool.membersReference = {'items': [
+            dict(name='10.0.0.1%2:80', state='up', session='monitor-enabled'),
+            dict(name='10.0.0.2%2:80', state='up', session='user-disabled'),
+            dict(name='10.0.0.3%2:80', state='down', session='user-enabled'),
+            dict(name='10.0.0.4%2:80', state='unchecked',
+                 session='user-enabled')]}
+        target.pool_helper.get_resources.side_effect = [
+            [pool], MockHTTPError(MockHTTPErrorResponse500())]
+        bigip = Mock()
+
+        states = target.get_member_states(bigip, ['Project_1', 'Project_2'])
+
+        assert target.pool_helper.get_resources.call_count == 2
+        target.pool_helper.get_resources.assert_any_call(
+            bigip, partition='Project_1', expand_subcollections=True)
+        assert states == {
+            ('Project_1', 'pool1', '10.0.0.1%2:80'): {
+                'status.availabilityState': 'available',
+                'status.enabledState': 'enabled'},
+            ('Project_1', 'pool1', '10.0.0.2%2:80'): {
+                'status.availabilityState': 'available',
+                'status.enabledState': 'disabled'},
+            ('Project_1', 'pool1', '10.0.0.3%2:80'): {
+                'status.availabilityState': 'offline',
+                'status.enabledState': 'enabled'},
+            ('Project_1', 'pool1', '10.0.0.4%2:80'): {
+                'status.availabilityState': 'unknown',
+                'status.enabledState': 'enabled'}}
+
+
+class FakeRestBigIP(object):
+    """BIG-IP double that counts the REST calls made against it."""
+
+    def __init__(self, deployed):
+        self.hostname = 'bigip1'
+        self._meta_data = {'uri': 'https://bigip1/mgmt/tm/'}
+        self.calls = []
+        self.deployed = deployed
+        self.icrs = Mock()
+        for method in ('get', 'post', 'patch', 'delete'):
+            getattr(self.icrs, method).side_effect = \
+                self._recorder(method.upper())
+        self.icrs.post.return_value.json.return_value = {'transId': 1}
+
+    def _recorder(self, method):
+        def record(uri, **kwargs):
+            self.calls.append((method, uri))
+            return getattr(self.icrs, method.lower()).return_value
+        return record
+
+    def load_pool(self, bigip, name=None, partition=None):
+        self.calls.append(('GET', 'ltm/pool/~%s~%s' % (partition, name)))
+        pool = Mock()
+        pool.members_s.get_collection.side_effect = self._get_members
+        return pool
+
+    def _get_members(self):
+        self.calls.append(('GET', 'members'))
+        members = list()
+        for name in self.deployed:
+            member = Mock()
+            member.name = name
+            members.append(member)
+        return members
+
+
+class TestAssurePoolMembersRestCalls(object):
+    """Count REST calls made by assure_pool_members for large pools."""
+
+    @staticmethod
+    def service(count, deleted):
+        members = list()
+        for i in range(count):
+            status = 'PENDING_DELETE' if i < deleted else 'ACTIVE'
+            members.append({'address': '10.0.%d.%d' % (i / 250, i % 250),
+                            'protocol_port': 80,
+                            'provisioning_status': status})
+        return {'loadbalancer': {'tenant_id': 'tenant'},
+                'pool': {'id': 'pool'},
+                'members': members}
+
+    @staticmethod
+    def builder(bigip):
+        adapter = Mock()
+        adapter.get_pool.return_value = dict(name='pool',
+                                             partition='Project_tenant')
+        adapter.get_member.side_effect = lambda svc: dict(
+            name='%s:80' % svc['member']['address'],
+            address=svc['member']['address'],
+            partition='Project_tenant')
+        adapter.get_member_node.side_effect = lambda svc: dict(
+            name=svc['member']['address'], partition='Project_tenant')
+        builder = pool_service.PoolServiceBuilder(adapter)
+        builder.pool_helper = Mock()
+        builder.pool_helper.load.side_effect = bigip.load_pool
+        return builder
+
+    @pytest.mark.parametrize('count', [10, 100, 1000])
+    def test_in_sync(self, count):
+        service = self.service(count, 0)
+        bigip = FakeRestBigIP(['%s:80' % m['address']
+                               for m in service['members']])
+
+        self.builder(bigip).assure_pool_members(service, [bigip])
+
+        # pool load and member collection, independent of pool size
+        assert len(bigip.calls) == 2
+
+    @pytest.mark.parametrize('count', [10, 100, 1000])
+    def test_changes(self, count):
+        # 10% of the members are deleted and 10% are missing
+        changes = count / 10
+        service = self.service(count, changes)
+        deployed = ['%s:80' % m['address']
+                    for m in service['members'][2 * changes:]]
+        bigip = FakeRestBigIP(deployed)
+
+        self.builder(bigip).assure_pool_members(service, [bigip])
+
+        methods = [method for method, _ in bigip.calls]
+        # 2 reads, the creates in one transaction (opened and committed
+        # when there is more than one) and one DELETE per orphaned node
+        transaction = 1 if changes > 1 else 0
+        assert methods.count('GET') == 2
+        assert methods.count('POST') == changes + transaction
+        assert methods.count('PATCH') == transaction
+        assert methods.count('DELETE') == changes
+        assert len(bigip.calls) == 2 + 2 * changes + 2 * transaction
+        for member in service['members']:
+            assert 'missing' not in member
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# Copyright (c) 2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+
+from mock import call
+from mock import Mock
+from requests import HTTPError
+
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    BigIPResourceHelper
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    DeviceInventory
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    ResourceSnapshot
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    ResourceType
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    RestBatch
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    transaction_scope
+from f5_openstack_agent.lbaasv2.drivers.bigip.resource_helper import \
+    uri_name
+
+
+def http_error(status_code):
+    response = Mock()
+    response.status_code = status_code
+    error = HTTPError("error")
+    error.response = response
+    return error
+
+
+def resource(name):
+    obj = Mock()
+    obj.name = name
+    return obj
+
+
+def partition_resource(name, partition):
+    obj = resource(name)
+    obj.partition = partition
+    return obj
+
+
+class TestResourceSnapshot(object):
+
+    @staticmethod
+    @pytest.fixture
+    def bigip():
+        bigip = Mock()
+        bigip.tmos_version = '12.1.0'
+        bigip.resource_snapshot = ResourceSnapshot()
+        pools = bigip.tm.ltm.pools
+        pools.get_collection.return_value = [resource('pool1'),
+                                             resource('pool2')]
+        pools.pool.create.side_effect = lambda **model: resource(
+            model['name'])
+        return bigip
+
+    @staticmethod
+    @pytest.fixture
+    def helper():
+        return BigIPResourceHelper(ResourceType.pool)
+
+    def test_exists_and_load_from_snapshot(self, bigip, helper):
+        pools = bigip.tm.ltm.pools
+        assert helper.exists(bigip, name='pool1', partition='Project_1')
+        assert not helper.exists(bigip, name='pool3', partition='Project_1')
+        pool = helper.load(bigip, name='pool2', partition='Project_1')
+
+        assert pool.name == 'pool2'
+        assert pools.get_collection.call_count == 1
+        assert not pools.pool.exists.called
+        assert not pools.pool.load.called
+        assert bigip.resource_snapshot.get_stats() == \
+            {'snapshots': 1, 'hits': 2, 'fills': 1}
+
+    def test_create_existing_updates(self, bigip, helper):
+        model = dict(name='pool1', partition='Project_1')
+        pool = helper.create(bigip, model)
+
+        pool.modify.assert_called_once_with(**model)
+        assert not bigip.tm.ltm.pools.pool.create.called
+
+    def test_create_new_is_added(self, bigip, helper):
+        model = dict(name='pool3', partition='Project_1')
+        pool = helper.create(bigip, model)
+
+        bigip.tm.ltm.pools.pool.create.assert_called_once_with(**model)
+        assert helper.load(bigip, name='pool3', partition='Project_1') is \
+            pool
+
+    def test_create_stale_entry(self, bigip, helper):
+        snapshot = helper._snapshot(bigip, 'Project_1')
+        snapshot['pool1'].modify.side_effect = http_error(404)
+        model = dict(name='pool1', partition='Project_1')
+        pool = helper.create(bigip, model)
+
+        bigip.tm.ltm.pools.pool.create.assert_called_once_with(**model)
+        assert snapshot['pool1'] is pool
+
+    def test_update(self, bigip, helper):
+        model = dict(name='pool2', partition='Project_1', description='x')
+        pool = helper.update(bigip, model)
+
+        pool.modify.assert_called_once_with(**model)
+        assert not bigip.tm.ltm.pools.pool.load.called
+
+    def test_delete(self, bigip, helper):
+        pool = helper.load(bigip, name='pool1', partition='Project_1')
+        helper.delete(bigip, name='pool1', partition='Project_1')
+        helper.delete(bigip, name='pool3', partition='Project_1')
+
+        pool.delete.assert_called_once_with()
+        assert not helper.exists(bigip, name='pool1', partition='Project_1')
+        assert not bigip.tm.ltm.pools.pool.exists.called
+
+    def test_delete_stale_entry(self, bigip, helper):
+        pool = helper.load(bigip, name='pool1', partition='Project_1')
+        pool.delete.side_effect = http_error(404)
+        helper.delete(bigip, name='pool1', partition='Project_1')
+        assert not helper.exists(bigip, name='pool1', partition='Project_1')
+
+        pool = helper.load(bigip, name='pool2', partition='Project_1')
+        pool.delete.side_effect = http_error(400)
+        with pytest.raises(HTTPError):
+            helper.delete(bigip, name='pool2', partition='Project_1')
+        assert helper.exists(bigip, name='pool2', partition='Project_1')
+
+    def test_concurrent_fill(self, bigip, helper):
+        from eventlet import greenthread
+        pools = bigip.tm.ltm.pools
+        listings = []
+
+        def get_collection(**kwargs):
+            # the first listing returns last, after pool3 was created
+            listings.append(kwargs)
+            for _ in range(3 - len(listings)):
+                greenthread.sleep(0)
+            return [resource('pool1'), resource('pool2')]
+
+        pools.get_collection.side_effect = get_collection
+        lookup = greenthread.spawn(helper.exists, bigip, name='pool3',
+                                   partition='Project_1')
+        greenthread.sleep(0)
+        helper.create(bigip, dict(name='pool3', partition='Project_1'))
+        lookup.wait()
+
+        # the older listing does not drop the created pool
+        assert len(listings) == 2
+        assert helper.exists(bigip, name='pool3', partition='Project_1')
+        assert bigip.resource_snapshot.get_stats()['fills'] == 1
+
+    def test_invalidate(self, bigip, helper):
+        helper.exists(bigip, name='pool1', partition='Project_1')
+        helper.exists(bigip, name='pool1', partition='Project_2')
+        bigip.resource_snapshot.invalidate('Project_1')
+        assert bigip.resource_snapshot.snapshots.keys() == \
+            [(ResourceType.pool, 'Project_2')]
+
+        helper.exists(bigip, name='pool1', partition='Project_1')
+        assert bigip.tm.ltm.pools.get_collection.call_count == 3
+        bigip.resource_snapshot.invalidate()
+        assert bigip.resource_snapshot.snapshots == {}
+
+    def test_uncached_lookups(self, bigip):
+        # members are not cached, neither are lookups without a partition
+        helper = BigIPResourceHelper(ResourceType.member)
+        helper.exists(bigip, name='member1', partition='Project_1')
+        assert bigip.tm.ltm.pools.pool.member.exists.called
+
+        helper = BigIPResourceHelper(ResourceType.pool)
+        helper.exists(bigip, name='pool1')
+        assert bigip.tm.ltm.pools.pool.exists.called
+
+        # BIG-IPs without a snapshot behave as before
+        bigip = Mock()
+        helper.exists(bigip, name='pool1', partition='Project_1')
+        assert bigip.tm.ltm.pools.pool.exists.called
+        assert not bigip.tm.ltm.pools.get_collection.called
+
+
+class TestRestBatch(object):
+
+    @staticmethod
+    @pytest.fixture
+    def bigip():
+        bigip = Mock()
+        bigip._meta_data = {'uri': 'https://bigip/mgmt/tm/'}
+        bigip.icrs.post.return_value.json.return_value = {'transId': 42}
+        return bigip
+
+    def test_transaction(self, bigip):
+        batch = RestBatch(bigip)
+        batch.add('post', 'ltm/pool/~Common~pool1/members', json={'a': 1})
+        batch.add('post', 'ltm/pool/~Common~pool1/members', json={'b': 2})
+
+        assert batch.submit() == [None, None]
+        headers = {'X-F5-REST-Coordination-Id': '42'}
+        assert bigip.icrs.post.call_args_list[0] == \
+            call('https://bigip/mgmt/tm/transaction', json={})
+        assert bigip.icrs.post.call_args_list[2] == \
+            call('https://bigip/mgmt/tm/ltm/pool/~Common~pool1/members',
+                 headers=headers, json={'b': 2})
+        bigip.icrs.patch.assert_called_once_with(
+            'https://bigip/mgmt/tm/transaction/42',
+            json={'state': 'VALIDATING'})
+
+    def test_transaction_fallback(self, bigip):
+        def delete(uri, headers=None):
+            # queued requests succeed, the commit then fails
+            if headers or uri.endswith('node1') or uri.endswith('/42'):
+                return None
+            raise http_error(404 if uri.endswith('node2') else 500)
+
+        bigip.icrs.patch.side_effect = http_error(400)
+        bigip.icrs.delete.side_effect = delete
+        batch = RestBatch(bigip)
+        batch.add('delete', 'ltm/node/~Common~node1')
+        batch.add('delete', 'ltm/node/~Common~node2', ignore=(404,))
+        batch.add('delete', 'ltm/node/~Common~node3', ignore=(404,))
+
+        errors = batch.submit()
+
+        assert errors[:2] == [None, None]
+        assert errors[2].response.status_code == 500
+        # the failed transaction was discarded before the replay
+        assert bigip.icrs.delete.call_args_list[3] == \
+            call('https://bigip/mgmt/tm/transaction/42')
+        assert bigip.icrs.delete.call_count == 7
+
+    def test_no_transaction(self, bigip):
+        batch = RestBatch(bigip, use_transaction=False)
+        batch.add('delete', 'ltm/node/%s' % uri_name('10.0.0.1%2', 'Common'))
+
+        assert batch.submit() == [None]
+        assert not bigip.icrs.post.called
+        bigip.icrs.delete.assert_called_once_with(
+            'https://bigip/mgmt/tm/ltm/node/~Common~10.0.0.1%252')
+        assert RestBatch(bigip).submit() == []
+
+
+class TestRestTransaction(object):
+
+    headers = {'headers': {'X-F5-REST-Coordination-Id': '42'}}
+
+    @staticmethod
+    @pytest.fixture
+    def bigip():
+        bigip = Mock()
+        bigip.hostname = 'bigip1'
+        bigip.resource_snapshot = None
+        bigip._meta_data = {'uri': 'https://bigip/mgmt/tm/'}
+        bigip.icrs.post.return_value.json.return_value = {'transId': 42}
+        yield bigip
+        transaction_scope.end()
+
+    def test_changes_are_queued(self, bigip):
+        pools = bigip.tm.ltm.pools.pool
+        pools.exists.side_effect = [False, True, True]
+        helper = BigIPResourceHelper(ResourceType.pool)
+        transaction = transaction_scope.begin([bigip])['bigip1']
+
+        helper.create(bigip, dict(name='pool1', partition='Project_1'))
+        helper.create(bigip, dict(name='pool2', partition='Project_1'))
+        helper.delete(bigip, name='pool3', partition='Project_1')
+
+        pools.create.assert_called_once_with(
+            name='pool1', partition='Project_1',
+            requests_params=self.headers)
+        # existing pools are updated instead of failing the commit
+        pools.load.return_value.modify.assert_called_once_with(
+            name='pool2', partition='Project_1',
+            requests_params=self.headers)
+        pools.load.return_value.delete.assert_called_once_with(
+            requests_params=self.headers)
+        assert transaction.changes == 3
+
+        # nodes are not changed in transactions
+        BigIPResourceHelper(ResourceType.node).delete(
+            bigip, name='node1', partition='Project_1')
+        bigip.tm.ltm.nodes.node.load.return_value.delete.\
+            assert_called_once_with()
+
+    def test_commit(self, bigip):
+        bigip.resource_snapshot = Mock()
+        deferred = Mock()
+        transaction = transaction_scope.begin([bigip])['bigip1']
+        transaction_scope.after_commit(bigip, deferred, 'node1')
+        transaction.requests_params('Project_1')
+        assert not deferred.called
+
+        transaction.commit()
+
+        bigip.icrs.patch.assert_called_once_with(
+            'https://bigip/mgmt/tm/transaction/42',
+            json={'state': 'VALIDATING'})
+        deferred.assert_called_once_with('node1')
+        bigip.resource_snapshot.invalidate.assert_called_once_with(
+            'Project_1')
+
+    def test_commit_failure(self, bigip):
+        bigip.icrs.patch.side_effect = http_error(400)
+        deferred = Mock()
+        transaction = transaction_scope.begin([bigip])['bigip1']
+        transaction.defer(deferred)
+        transaction.requests_params()
+
+        with pytest.raises(HTTPError):
+            transaction.commit()
+        bigip.icrs.delete.assert_called_once_with(
+            'https://bigip/mgmt/tm/transaction/42')
+        assert not deferred.called
+
+    def test_empty_transaction(self, bigip):
+        transaction = transaction_scope.begin([bigip])['bigip1']
+        transaction.commit()
+
+        assert not bigip.icrs.patch.called
+        assert bigip.icrs.delete.called
+
+    def test_unsupported_device(self, bigip):
+        bigip.icrs.post.side_effect = http_error(404)
+        deferred = Mock()
+        assert transaction_scope.begin([bigip]) == {}
+
+        BigIPResourceHelper(ResourceType.pool).create(
+            bigip, dict(name='pool1', partition='Project_1'))
+        transaction_scope.after_commit(bigip, deferred)
+
+        bigip.tm.ltm.pools.pool.create.assert_called_once_with(
+            name='pool1', partition='Project_1')
+        assert deferred.called
+
+
+class TestDeviceInventory(object):
+
+    @staticmethod
+    @pytest.fixture
+    def bigip():
+        bigip = Mock()
+        bigip.hostname = 'bigip1'
+        bigip.tm.sys.folders.get_collection.return_value = [
+            resource('Common'), resource('Project_t1'), resource('Project_t2')]
+        for resource_type in DeviceInventory.resource_types:
+            collection = BigIPResourceHelper(resource_type)._collection(bigip)
+            collection.get_collection.return_value = []
+        bigip.tm.ltm.pools.get_collection.return_value = [
+            partition_resource('Project_p1', 'Project_t1'),
+            partition_resource('Project_p2', 'Project_t2'),
+            partition_resource('pool', 'Common')]
+        bigip.tm.ltm.virtuals.get_collection.return_value = [
+            partition_resource('Project_l1', 'Project_t1')]
+        return bigip
+
+    def test_collect(self, bigip):
+        inventory = DeviceInventory('Project_').collect([bigip])
+
+        assert inventory.get_folders(bigip) == ['Project_t1', 'Project_t2']
+        assert [pool.name for pool in inventory.get_resources(
+            bigip, ResourceType.pool, 'Project_t1')] == ['Project_p1']
+        assert inventory.get_resources(
+            bigip, ResourceType.virtual, 'Project_t2') == []
+        # one collection per resource type for all partitions
+        bigip.tm.ltm.pools.get_collection.assert_called_once_with(
+            requests_params={'params': 'expandSubcollections=true'})
+        bigip.tm.ltm.virtual_address_s.get_collection.\
+            assert_called_once_with()
+
+    def test_discard(self, bigip):
+        inventory = DeviceInventory('Project_').collect([bigip])
+
+        inventory.discard(ResourceType.pool, 't1', 'p1')
+        assert inventory.get_resources(
+            bigip, ResourceType.pool, 'Project_t1') == []
+        inventory.discard_folder(bigip, 'Project_t2')
+        assert inventory.get_folders(bigip) == ['Project_t1']
+        assert inventory.get_resources(
+            bigip, ResourceType.pool, 'Project_t2') == []
@@ -0,0 +1,177 @@
+# coding=utf-8
+# Copyright (c) 2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from eventlet import greenthread
+from mock import Mock
+import oslo_messaging as messaging
+
+from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
+from f5_openstack_agent.lbaasv2.drivers.bigip.status_publisher import \
+    StatusPublisher
+
+
+class TestStatusPublisher(object):
+    def test_flush(self):
+        plugin_rpc = Mock()
+        publisher = StatusPublisher(plugin_rpc)
+
+        publisher.update_member_status('member1', 'PENDING_UPDATE', 'ONLINE')
+        publisher.update_member_status('member1', 'ACTIVE', 'ONLINE')
+        publisher.update_l7rule_status('rule1', 'policy1', 'ACTIVE', 'ONLINE')
+        publisher.pool_destroyed('pool1')
+        publisher.update_loadbalancer_status('lb1', 'ACTIVE', 'ONLINE')
+        assert not plugin_rpc.update_statuses.called
+
+        # the newest update of each object, in one batch
+        publisher.flush()
+        plugin_rpc.update_statuses.assert_called_once_with([
+            {'resource': 'member', 'id': 'member1',
+             'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'},
+            {'resource': 'l7rule', 'id': 'rule1', 'l7policy_id': 'policy1',
+             'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'},
+            {'resource': 'pool', 'id': 'pool1', 'destroyed': True},
+            {'resource': 'loadbalancer', 'id': 'lb1',
+             'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'}])
+
+        # a status equal to the one sent is sent again, as neutron may
+        # have set the object back to PENDING_UPDATE meanwhile
+        publisher.update_loadbalancer_status('lb1', 'ACTIVE', 'OFFLINE')
+        publisher.update_loadbalancer_status('lb1', 'ACTIVE', 'ONLINE')
+        publisher.flush()
+        plugin_rpc.update_statuses.assert_called_with([
+            {'resource': 'loadbalancer', 'id': 'lb1',
+             'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'}])
+        stats = publisher.get_stats()
+        assert stats['published'] == 5
+        assert stats['merged'] == 2
+        assert stats['pending'] == 0
+
+    def test_batch_size(self):
+        plugin_rpc = Mock()
+        publisher = StatusPublisher(plugin_rpc, batch_size=2)
+
+        publisher.update_pool_status('pool1', 'ACTIVE', 'ONLINE')
+        greenthread.sleep(0)
+        assert not plugin_rpc.update_statuses.called
+        publisher.update_pool_status('pool2', 'ACTIVE', 'ONLINE')
+        greenthread.sleep(0)
+        assert plugin_rpc.update_statuses.call_count == 1
+
+    def test_flush_error(self):
+        plugin_rpc = Mock()
+        plugin_rpc.update_statuses.side_effect = Exception('down')
+        publisher = StatusPublisher(plugin_rpc)
+
+        publisher.update_listener_status('listener1', 'ACTIVE', 'ONLINE')
+        publisher.update_pool_status('pool1', 'ACTIVE', 'ONLINE')
+        publisher.flush()
+        stats = publisher.get_stats()
+        assert stats['errors'] == 1
+        assert stats['pending'] == 2
+
+        # failed statuses are retried, unless a newer one was queued
+        plugin_rpc.update_statuses.side_effect = None
+        publisher.update_pool_status('pool1', 'ERROR', 'OFFLINE')
+        publisher.flush()
+        plugin_rpc.update_statuses.assert_called_with([
+            {'resource': 'listener', 'id': 'listener1',
+             'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'},
+            {'resource': 'pool', 'id': 'pool1',
+             'provisioning_status': 'ERROR', 'operating_status': 'OFFLINE'}])
+        assert publisher.get_stats()['pending'] == 0
+
+    def test_concurrent_flush(self):
+        sent = []
+
+        def update_statuses(batch):
+            # the first batch fails once the RPC has yielded
+            greenthread.sleep(0)
+            if not sent:
+                sent.append(None)
+                raise Exception('down')
+            sent.append(batch)
+
+        plugin_rpc = Mock()
+        plugin_rpc.update_statuses.side_effect = update_statuses
+        publisher = StatusPublisher(plugin_rpc)
+
+        # the newer status waits for the flush of the older one, so it
+        # replaces the older status rather than being sent before it
+        publisher.update_pool_status('pool1', 'PENDING_UPDATE', 'ONLINE')
+        flush = greenthread.spawn(publisher.flush)
+        greenthread.sleep(0)
+        publisher.update_pool_status('pool1', 'ACTIVE', 'ONLINE')
+        publisher.flush()
+        flush.wait()
+        publisher.flush()
+        assert sent[1:] == [[
+            {'resource': 'pool', 'id': 'pool1',
+             'provisioning_status': 'ACTIVE', 'operating_status': 'ONLINE'}]]
+        assert publisher.get_stats()['pending'] == 0
+
+    def test_max_retries(self):
+        plugin_rpc = Mock()
+        plugin_rpc.update_statuses.side_effect = Exception('down')
+        publisher = StatusPublisher(plugin_rpc, max_retries=2)
+
+        publisher.update_pool_status('pool1', 'ACTIVE', 'ONLINE')
+        for _ in range(3):
+            publisher.flush()
+        assert plugin_rpc.update_statuses.call_count == 3
+        stats = publisher.get_stats()
+        assert stats['retried'] == 2
+        assert stats['dropped'] == 1
+        assert stats['pending'] == 0
+
+        # a newer status starts over
+        publisher.update_pool_status('pool1', 'ACTIVE', 'ONLINE')
+        publisher.flush()
+        publisher.update_pool_status('pool1', 'ERROR', 'OFFLINE')
+        publisher.flush()
+        publisher.flush()
+        assert publisher.get_stats()['pending'] == 1
+
+    def test_flush_rejected(self):
+        plugin_rpc = Mock()
+        plugin_rpc.update_statuses.side_effect = \
+            messaging.RemoteError('ValueError')
+        publisher = StatusPublisher(plugin_rpc)
+
+        publisher.update_pool_status('pool1', 'ACTIVE', 'ONLINE')
+        publisher.flush()
+        stats = publisher.get_stats()
+        assert stats['dropped'] == 1
+        assert stats['pending'] == 0
+
+    def test_flush_partial_error(self):
+        listener = {'resource': 'listener', 'id': 'listener1',
+                    'provisioning_status': 'ACTIVE',
+                    'operating_status': 'ONLINE'}
+        plugin_rpc = Mock()
+        plugin_rpc.update_statuses.side_effect = \
+            f5_ex.StatusUpdatesFailed([listener])
+        publisher = StatusPublisher(plugin_rpc)
+
+        # only the statuses which failed are sent again
+        publisher.update_listener_status('listener1', 'ACTIVE', 'ONLINE')
+        publisher.update_pool_status('pool1', 'ACTIVE', 'ONLINE')
+        publisher.flush()
+        plugin_rpc.update_statuses.side_effect = None
+        publisher.flush()
+        plugin_rpc.update_statuses.assert_called_with([listener])
+        stats = publisher.get_stats()
+        assert stats['published'] == 2
+        assert stats['pending'] == 0
@@ -14,11 +14,61 @@
 # limitations under the License.
 #
 
+from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
+import f5_openstack_agent.lbaasv2.drivers.bigip.test.conftest as ct
 import f5_openstack_agent.lbaasv2.drivers.bigip.utils as utils
 from f5_openstack_agent.lbaasv2.drivers.bigip.utils import IpNotInCidrNotation
 
+from eventlet import greenthread
 import mock
 import pytest
+import time
+
+
+def lb_service(lb_id, tenant_id='tenant-1'):
+    return {'loadbalancer': {'id': lb_id, 'tenant_id': tenant_id}}
+
+
+class FakeDriver(object):
+    def __init__(self, service_queue):
+        self.service_queue = service_queue
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+        self.services = []
+
+    @utils.serialized('update_member')
+    def update_member(self, member, service):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        greenthread.sleep(.05)
+        self.calls.append(service['loadbalancer']['id'])
+        self.services.append(service)
+        self.active -= 1
+        if service.get('fail', False):
+            raise IOError('device unreachable')
+        return service['loadbalancer']['id']
+
+    @utils.serialized('backup_configuration')
+    def backup_configuration(self):
+        raise IOError('device unreachable')
+
+
+class FakeBigIP(object):
+    def __init__(self, hostname, delay=0, error=None):
+        self.hostname = hostname
+        self.delay = delay
+        self.error = error
+
+
+class FakeBuilder(object):
+    flag = utils.RequestLocal('default')
+
+    def assure(self, bigip, suffix=''):
+        greenthread.sleep(bigip.delay)
+        if bigip.error:
+            raise bigip.error
+        return bigip.hostname + suffix + ':' + self.flag
 
 
 class TestUtils(object):
@@ -30,33 +80,6 @@ class TestUtils(object):
         domain = utils.strip_domain_address('192.168.1.1%20/24')
         assert domain == "192.168.1.1/24"
 
-    def test_request_index_0(self):
-        request_q = [
-            [1, 2, 3],
-            [2, 4, 6],
-            [3, 6, 9]
-        ]
-        index = utils.request_index(request_q, 1)
-        assert index == 0
-
-    def test_request_index_1(self):
-        request_q = [
-            [1, 2, 3],
-            [2, 4, 6],
-            [3, 6, 9]
-        ]
-        index = utils.request_index(request_q, 2)
-        assert index == 1
-
-    def test_request_index_none(self):
-        request_q = [
-            [1, 2, 3],
-            [2, 4, 6],
-            [3, 6, 9]
-        ]
-        index = utils.request_index(request_q, 99)
-        assert index == len(request_q)
-
     def test_get_filter_v11_5(self):
         bigip = mock.MagicMock()
         bigip.tmos_version = "11.5"
@@ -99,3 +122,267 @@ class TestUtils(object):
         bigip.tm.cm.devices.get_collection.return_value = [device]
         ret = utils.get_device_info(bigip)
         assert ret is device
+
+    def test_service_queue_keys(self):
+        queue = utils.ServiceQueue(4, 'loadbalancer')
+        keys = queue.get_keys('update_member', lb_service('lb-1'))
+        assert keys == {'global': False,
+                        'tenant:tenant-1': False,
+                        'loadbalancer:lb-1': True}
+        keys = queue.get_keys('delete_loadbalancer', lb_service('lb-1'))
+        assert keys['tenant:tenant-1'] is True
+        assert queue.get_keys('backup_configuration', None) == \
+            {'global': True}
+
+        queue = utils.ServiceQueue(4, 'tenant')
+        keys = queue.get_keys('update_member', lb_service('lb-1'))
+        assert keys['tenant:tenant-1'] is True
+
+        queue = utils.ServiceQueue(4, 'global')
+        keys = queue.get_keys('update_member', lb_service('lb-1'))
+        assert keys == {'global': True}
+
+        with pytest.raises(ValueError):
+            utils.ServiceQueue(4, 'device')
+
+    def test_service_queue_concurrent_loadbalancers(self):
+        driver = FakeDriver(utils.ServiceQueue(4, 'loadbalancer'))
+        threads = [greenthread.spawn(driver.update_member, {},
+                                     lb_service('lb-%d' % i))
+                   for i in range(3)]
+        assert sorted(t.wait() for t in threads) == ['lb-0', 'lb-1', 'lb-2']
+        assert driver.max_active == 3
+        assert len(driver.service_queue) == 0
+        assert driver.service_queue.queues == {}
+
+    def test_service_queue_serializes_loadbalancer(self):
+        driver = FakeDriver(utils.ServiceQueue(4, 'loadbalancer'))
+        threads = [greenthread.spawn(driver.update_member, {},
+                                     lb_service('lb-1'))
+                   for i in range(3)]
+        [t.wait() for t in threads]
+        assert driver.max_active == 1
+        assert driver.calls == ['lb-1', 'lb-1', 'lb-1']
+
+    def test_service_queue_bounded_workers(self):
+        driver = FakeDriver(utils.ServiceQueue(2, 'loadbalancer'))
+        threads = [greenthread.spawn(driver.update_member, {},
+                                     lb_service('lb-%d' % i, 'tenant-%d' % i))
+                   for i in range(5)]
+        [t.wait() for t in threads]
+        assert driver.max_active == 2
+
+    def test_service_queue_stats(self):
+        driver = FakeDriver(utils.ServiceQueue(4, 'loadbalancer'))
+        threads = [greenthread.spawn(driver.update_member, {},
+                                     lb_service('lb-1'))
+                   for i in range(2)]
+        [t.wait() for t in threads]
+        with pytest.raises(IOError):
+            driver.backup_configuration()
+
+        stats = driver.service_queue.get_stats('loadbalancer:lb-1')
+        lb_stats = stats['loadbalancer:lb-1']
+        assert lb_stats['requests'] == 2
+        assert lb_stats['max_depth'] == 2
+        assert lb_stats['depth'] == 0
+        assert lb_stats['run_time'] >= .1
+        assert lb_stats['max_wait_time'] >= .05
+        assert driver.service_queue.get_stats()['global']['requests'] == 3
+
+        summary = driver.service_queue.get_summary()
+        assert summary['depth'] == 0
+        assert summary['running'] == 0
+        assert summary['workers'] == 4
+
+    def test_service_queue_stats_keys(self):
+        queue = utils.ServiceQueue(4, 'loadbalancer')
+        queue.MAX_STATS_KEYS = 4
+        waiting = queue.enqueue('update_member', lb_service('lb-0'))
+        for i in range(1, 4):
+            queue.dequeue(queue.enqueue('update_member',
+                                        lb_service('lb-%d' % i)))
+        queue.dequeue(queue.enqueue('update_member', lb_service('lb-1')))
+
+        # only the stats of the least recently used idle keys are dropped
+        assert sorted(queue.get_stats()) == [
+            'global', 'loadbalancer:lb-0', 'loadbalancer:lb-1',
+            'tenant:tenant-1']
+        queue.dequeue(waiting)
+        assert len(queue.get_stats()) == 4
+
+    def test_service_queue_interrupted_waiter(self):
+        queue = utils.ServiceQueue(4, 'loadbalancer')
+        first = queue.enqueue('update_member', lb_service('lb-1'))
+        second = queue.enqueue('update_member', lb_service('lb-1'))
+        third = queue.enqueue('update_member', lb_service('lb-1'))
+        assert first.pending == 0
+        assert second.pending == 1
+
+        # a waiter giving up must not block the requests behind it
+        queue.dequeue(second)
+        queue.dequeue(first)
+        assert third.pending == 0
+        assert third.ready.ready()
+        queue.dequeue(third)
+        assert queue.queues == {}
+
+    def test_service_queue_barrier(self):
+        queue = utils.ServiceQueue(4, 'loadbalancer')
+        first = queue.enqueue('update_member', lb_service('lb-1'))
+        barrier = queue.enqueue('backup_configuration', None)
+        behind = queue.enqueue('update_member', lb_service('lb-2'))
+        assert barrier.pending == 1
+        assert behind.pending == 1
+
+        queue.dequeue(first)
+        assert barrier.pending == 0
+        assert behind.pending == 1
+        queue.dequeue(barrier)
+        assert behind.pending == 0
+
+    def test_service_queue_coalesce(self):
+        driver = FakeDriver(utils.ServiceQueue(4, 'loadbalancer', True))
+        services = [dict(lb_service('lb-1'), version=i) for i in range(6)]
+        threads = [greenthread.spawn(driver.update_member, {}, service)
+                   for service in services]
+        assert [t.wait() for t in threads] == ['lb-1'] * 6
+
+        # the first request ran right away, the five queued behind it
+        # were merged into one run with the newest service
+        assert [s['version'] for s in driver.services] == [0, 5]
+        stats = driver.service_queue.get_stats('loadbalancer:lb-1')
+        assert stats['loadbalancer:lb-1']['merged'] == 4
+        assert stats['loadbalancer:lb-1']['requests'] == 2
+        assert driver.service_queue.get_summary()['merged'] == 4
+        assert driver.service_queue.tails == {}
+
+    def test_service_queue_coalesce_disabled(self):
+        driver = FakeDriver(utils.ServiceQueue(4, 'loadbalancer'))
+        threads = [greenthread.spawn(driver.update_member, {},
+                                     lb_service('lb-1'))
+                   for i in range(4)]
+        [t.wait() for t in threads]
+        assert len(driver.services) == 4
+        assert driver.service_queue.get_summary()['merged'] == 0
+
+    def test_service_queue_coalesce_other_method(self):
+        queue = utils.ServiceQueue(4, 'loadbalancer', True)
+        running = queue.enqueue('update_member', lb_service('lb-1'))
+        running.started = time.time()
+        assert not queue.merge('update_member', lb_service('lb-1'))
+
+        pending = queue.enqueue('update_member', lb_service('lb-1'))
+        assert not queue.merge('update_pool', lb_service('lb-1'))
+        assert not queue.merge('update_member', lb_service('lb-2'))
+        assert not queue.merge('backup_configuration', None)
+        assert queue.merge('update_member', lb_service('lb-1')) is pending
+        assert pending.merged == 1
+
+    def test_service_queue_coalesce_failure(self):
+        driver = FakeDriver(utils.ServiceQueue(4, 'loadbalancer', True))
+        services = [lb_service('lb-1'), lb_service('lb-1'),
+                    dict(lb_service('lb-1'), fail=True)]
+        threads = [greenthread.spawn(driver.update_member, {}, service)
+                   for service in services]
+        assert threads[0].wait() == 'lb-1'
+        for thread in threads[1:]:
+            with pytest.raises(IOError):
+                thread.wait()
+        assert len(driver.services) == 2
+
+    @staticmethod
+    def queue_requests(depth):
+        # time depth requests queued at once behind one loadbalancer
+        driver = FakeDriver(utils.ServiceQueue(8, 'loadbalancer'))
+
+        @utils.serialized('update_member')
+        def noop(driver, member, service):
+            greenthread.sleep(0)
+
+        start = time.time()
+        threads = [greenthread.spawn(noop, driver, {}, lb_service('lb-1'))
+                   for i in range(depth)]
+        [t.wait() for t in threads]
+        elapsed = time.time() - start
+
+        stats = driver.service_queue.get_stats('loadbalancer:lb-1')
+        lb_stats = stats['loadbalancer:lb-1']
+        assert lb_stats['requests'] == depth
+        assert lb_stats['max_depth'] == depth
+        return elapsed, lb_stats
+
+    def test_service_queue_latency(self):
+        """End-to-end latency of requests queued behind one loadbalancer.
+
+        With the former polling queue a request at position n slept n * .5
+        seconds between scans, so the tail of a 20 deep queue waited for
+        more than a minute. Waiters are now woken as soon as their turn
+        comes.
+        """
+        elapsed, _ = self.queue_requests(20)
+        assert elapsed < 5.0
+
+    @ct.benchmark
+    @pytest.mark.parametrize('depth', [10, 100, 1000])
+    def test_service_queue_latency_benchmark(self, depth):
+        """Latency of the tail of a queue of depth requests."""
+        elapsed, lb_stats = self.queue_requests(depth)
+        # each request waits for the ones ahead of it, not for a poll
+        assert lb_stats['max_wait_time'] < .001 * depth + .1
+        assert elapsed < .001 * depth + .5
+
+    def test_device_fan_out(self):
+        bigips = [FakeBigIP('bigip-%d' % i, delay=.1) for i in range(4)]
+        builder = FakeBuilder()
+        builder.flag = 'request'
+
+        start = time.time()
+        result = utils.DeviceFanOut().map(builder.assure, bigips, '-ok')
+        elapsed = time.time() - start
+
+        # devices run concurrently, with the flags of the calling request
+        assert elapsed < .3
+        assert result.values() == ['bigip-%d-ok:request' % i
+                                   for i in range(4)]
+        assert result.get_error() is None
+        result.raise_errors()
+
+    def test_device_fan_out_errors(self):
+        bigips = [FakeBigIP('bigip-1'),
+                  FakeBigIP('bigip-2', error=IOError('unreachable')),
+                  FakeBigIP('bigip-3', delay=1)]
+        result = utils.DeviceFanOut(timeout=.1).map(
+            FakeBuilder().assure, bigips)
+
+        assert result.values() == ['bigip-1:default']
+        assert list(result.errors) == ['bigip-2', 'bigip-3']
+        assert isinstance(result.errors['bigip-3'], f5_ex.BigIPDeviceTimeout)
+        assert result.get_error() is result.errors['bigip-2']
+        with pytest.raises(IOError):
+            result.raise_errors()
+
+    def test_device_fan_out_timeout_handled(self):
+        calls = []
+
+        def assure(bigip):
+            # operations go on with their next request after most errors
+            try:
+                greenthread.sleep(1)
+            except Exception:
+                pass
+            calls.append(bigip.hostname)
+
+        result = utils.DeviceFanOut(timeout=.1).map(
+            assure, [FakeBigIP('bigip-1'), FakeBigIP('bigip-2')])
+        assert not calls
+        assert isinstance(result.get_error(), f5_ex.BigIPDeviceTimeout)
+
+    def test_device_fan_out_returned_errors(self):
+        error = f5_ex.PoolCreationException('conflict')
+        result = utils.DeviceFanOut().map(
+            lambda bigip: error if bigip.hostname == 'bigip-2' else None,
+            [FakeBigIP('bigip-1'), FakeBigIP('bigip-2')])
+
+        assert result.get_error() is error
+        result.raise_errors()
@@ -13,12 +13,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
+import sys
+import threading
 from time import time
 import uuid
 
 from distutils.version import LooseVersion
+import eventlet
+from eventlet import event
 from eventlet import greenthread
+from eventlet import semaphore
 from oslo_log import log as logging
+import six
+
+from f5_openstack_agent.lbaasv2.drivers.bigip import exceptions as f5_ex
 
 LOG = logging.getLogger(__name__)
 OBJ_PREFIX = 'uuid_'
@@ -54,7 +63,6 @@ def serialized(method_name):
             """Necessary wrapper."""
             # args[0] must be an instance of iControlDriver
             service_queue = args[0].service_queue
-            my_request_id = uuid.uuid4()
 
             service = None
             if len(args) > 0:
@@ -64,61 +72,466 @@ def serialized(method_name):
             if 'service' in kwargs:
                 service = kwargs['service']
 
-            # Consolidate create_member requests for the same pool.
-            #
-            # NOTE: The following block of code alters the state of
-            # a queue that other greenthreads are waiting behind.
-            # This code assumes it will not be preempted by another
-            # greenthread while running. It does not do I/O or call any
-            # other monkey-patched code which might cause a context switch.
-            # To avoid race conditions, DO NOT add logging to this code
-            # block.
-
-            req = (my_request_id, method_name, service)
-            service_queue.append(req)
-            reqs_ahead_of_us = request_index(service_queue, my_request_id)
-            while reqs_ahead_of_us != 0:
-                if reqs_ahead_of_us == 1:
-                    # it is almost our turn. get ready
-                    waitsecs = .01
-                else:
-                    waitsecs = reqs_ahead_of_us * .5
-                if waitsecs > .01:
-                    LOG.debug('%s request %s is blocking'
-                              ' for %.2f secs - queue depth: %d'
-                              % (str(method_name), my_request_id,
-                                 waitsecs, len(service_queue)))
-                greenthread.sleep(waitsecs)
-                reqs_ahead_of_us = request_index(service_queue, my_request_id)
-            try:
-                LOG.debug('%s request %s is running with queue depth: %d'
-                          % (str(method_name), my_request_id,
-                             len(service_queue)))
-                start_time = time()
-                result = method(*args, **kwargs)
-                LOG.debug('%s request %s took %.5f secs'
-                          % (str(method_name), my_request_id,
-                             time() - start_time))
-            except Exception:
-                LOG.error('%s request %s FAILED'
-                          % (str(method_name), my_request_id))
-                raise
-            finally:
-                service_queue.pop(0)
-            return result
+            return service_queue.run(method_name, service, method,
+                                     *args, **kwargs)
         return wrapper
     return real_serialized
 
 
-def request_index(request_queue, request_id):
-    """Get index of request in request queue.
+class ServiceRequest(object):
+    """A driver request waiting on, or running in, a ServiceQueue."""
+
+    __slots__ = ('request_id', 'method_name', 'service', 'keys',
+                 'method', 'args', 'kwargs', 'pending', 'ready', 'done',
+                 'merged', 'enqueued', 'started')
+
+    def __init__(self, method_name, service, keys,
+                 method=None, args=(), kwargs=None):
+        self.request_id = uuid.uuid4()
+        self.method_name = method_name
+        self.service = service
+        # maps queue key -> True when the key is held exclusively
+        self.keys = keys
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs or {}
+        # number of keys not granted yet, ready fires when it drops to 0
+        self.pending = len(keys)
+        self.ready = event.Event()
+        # carries the result to the callers merged into this request
+        self.done = event.Event()
+        self.merged = 0
+        self.enqueued = time()
+        self.started = None
+
+    @property
+    def loadbalancer_id(self):
+        if not self.service:
+            return None
+        return (self.service.get('loadbalancer') or {}).get('id', None)
+
+
+class KeyQueue(object):
+    """Requests holding, or waiting in FIFO order for, one queue key."""
+
+    __slots__ = ('key', 'granted', 'exclusive', 'waiting')
+
+    def __init__(self, key):
+        self.key = key
+        self.granted = set()
+        self.exclusive = False
+        self.waiting = collections.deque()
+
+    def __len__(self):
+        return len(self.granted) + len(self.waiting)
+
+    def append(self, request):
+        """Queue a request, returning the requests which became ready."""
+        self.waiting.append(request)
+        return self.grant()
+
+    def remove(self, request):
+        """Release a request, returning the requests which became ready."""
+        if request in self.granted:
+            self.granted.remove(request)
+            if not self.granted:
+                self.exclusive = False
+        else:
+            self.waiting.remove(request)
+        return self.grant()
+
+    def grant(self):
+        """Grant the key to waiting requests while they are compatible."""
+        ready = []
+        while self.waiting and not self.exclusive:
+            request = self.waiting[0]
+            exclusive = request.keys[self.key]
+            if exclusive and self.granted:
+                break
+            self.waiting.popleft()
+            self.granted.add(request)
+            self.exclusive = exclusive
+            request.pending -= 1
+            if not request.pending:
+                ready.append(request)
+        return ready
+
+
+class ServiceQueue(object):
+    """Serialize driver requests per loadbalancer instead of globally.
+
+    Every request is appended to the FIFO queue of each key it needs:
 
-    If we are not in the queue return the length of the list.
+      * 'loadbalancer:<id>' exclusively, so requests for one
+        loadbalancer still run one at a time and in arrival order.
+      * 'tenant:<id>' shared, or exclusively for requests which create
+        or remove objects every loadbalancer of the tenant depends on
+        (the tenant folder and route domain).
+      * 'global' shared, or exclusively for requests without a service
+        (orphan scans, purges, config saves) which act as barriers.
+
+    Keys are granted in FIFO order, shared holders together and exclusive
+    holders alone. A request runs once it holds all of its keys and a
+    worker slot is free, so requests for independent loadbalancers run
+    concurrently on at most 'workers' greenthreads. Waiting requests
+    block on an event that is fired by the request releasing the last key
+    they need, so nothing polls the queues.
+
+    When coalescing is enabled a request is merged into the newest queued
+    request of the same loadbalancer if that request is for the same
+    method and has not started yet. Every service carries the complete
+    loadbalancer tree, so the merged request runs once with the newest
+    arguments and all merged callers receive its result.
     """
-    for request in request_queue:
-        if request[0] == request_id:
-            return request_queue.index(request)
-    return len(request_queue)
+
+    GLOBAL_KEY = 'global'
+    SCOPES = ('loadbalancer', 'tenant', 'global')
+    TENANT_METHODS = ('create_loadbalancer', 'delete_loadbalancer')
+    # statistics are kept for the most recently used keys only
+    MAX_STATS_KEYS = 1000
+
+    def __init__(self, workers=1, scope='global', coalesce=False):
+        if scope not in self.SCOPES:
+            raise ValueError('Invalid service queue scope %s' % scope)
+        self.workers = max(int(workers), 1)
+        self.scope = scope
+        self.coalesce = coalesce
+        self.queues = {}
+        # newest queued request per loadbalancer id
+        self.tails = {}
+        # key statistics, least recently used first
+        self.stats = collections.OrderedDict()
+        self.depth = 0
+        self.running = 0
+        self.merged = 0
+        self._slots = semaphore.Semaphore(self.workers)
+
+    def __len__(self):
+        return self.depth
+
+    def get_keys(self, method_name, service):
+        """Return the queue keys, and their exclusivity, for a request."""
+        if not service or self.scope == 'global':
+            return {self.GLOBAL_KEY: True}
+
+        loadbalancer = service.get('loadbalancer') or {}
+        lb_id = loadbalancer.get('id', None)
+        tenant_id = loadbalancer.get('tenant_id', None)
+
+        keys = {self.GLOBAL_KEY: False}
+        if tenant_id:
+            keys['tenant:%s' % tenant_id] = (
+                self.scope == 'tenant' or not lb_id or
+                method_name in self.TENANT_METHODS)
+        if lb_id:
+            keys['loadbalancer:%s' % lb_id] = True
+        if len(keys) == 1:
+            keys[self.GLOBAL_KEY] = True
+        return keys
+
+    def merge(self, method_name, service, args=(), kwargs=None):
+        """Merge a request into a pending one for the same loadbalancer.
+
+        Returns the pending request or None if nothing can be merged.
+        """
+        # Consolidate requests for the same loadbalancer and method,
+        # generalizing the former create_member consolidation.
+        #
+        # NOTE: The following block of code alters the state of
+        # a request that another greenthread is waiting behind.
+        # This code assumes it will not be preempted by another
+        # greenthread while running. It does not do I/O or call any
+        # other monkey-patched code which might cause a context switch.
+        # To avoid race conditions, DO NOT add logging to this code
+        # block.
+        if not self.coalesce or not service:
+            return None
+        lb_id = (service.get('loadbalancer') or {}).get('id', None)
+        tail = self.tails.get(lb_id, None)
+        if not tail or tail.started or tail.method_name != method_name:
+            return None
+        tail.service = service
+        tail.args = args
+        tail.kwargs = kwargs or {}
+        tail.merged += 1
+        self.merged += 1
+        for key in tail.keys:
+            self._key_stats(key)['merged'] += 1
+        return tail
+
+    def enqueue(self, method_name, service, method=None, args=(),
+                kwargs=None):
+        """Place a new request at the tail of all its queues."""
+        # NOTE: The following block of code alters the state of
+        # queues that other greenthreads are waiting behind.
+        # This code assumes it will not be preempted by another
+        # greenthread while running. It does not do I/O or call any
+        # other monkey-patched code which might cause a context switch.
+        # To avoid race conditions, DO NOT add logging to this code
+        # block.
+        request = ServiceRequest(
+            method_name, service, self.get_keys(method_name, service),
+            method, args, kwargs)
+        if request.loadbalancer_id:
+            self.tails[request.loadbalancer_id] = request
+        self.depth += 1
+        for key in request.keys:
+            if key not in self.queues:
+                self.queues[key] = KeyQueue(key)
+            self.queues[key].append(request)
+            if key in self.stats:
+                # the key becomes the most recently used one
+                self.stats[key] = self.stats.pop(key)
+            key_stats = self._key_stats(key)
+            key_stats['requests'] += 1
+            key_stats['max_depth'] = max(key_stats['max_depth'],
+                                         len(self.queues[key]))
+        return request
+
+    def wait(self, request):
+        """Block the calling greenthread until the request may run."""
+        if request.pending:
+            LOG.debug('%s request %s is waiting - queue depth: %d'
+                      % (str(request.method_name), request.request_id,
+                         len(self)))
+            request.ready.wait()
+
+    def dequeue(self, request):
+        """Remove a request from all of its queues and wake the next."""
+        if self.tails.get(request.loadbalancer_id, None) is request:
+            del self.tails[request.loadbalancer_id]
+        self.depth -= 1
+        ready = []
+        for key in request.keys:
+            queue = self.queues[key]
+            ready.extend(queue.remove(request))
+            if not len(queue):
+                del self.queues[key]
+        for next_request in ready:
+            next_request.ready.send()
+
+    def run(self, method_name, service, method, *args, **kwargs):
+        """Run method once the request reaches the head of its queues."""
+        request = self.merge(method_name, service, args, kwargs)
+        if request:
+            LOG.debug('%s request merged into pending request %s'
+                      ' - %d merged' % (str(method_name), request.request_id,
+                                        request.merged))
+            return request.done.wait()
+
+        request = self.enqueue(method_name, service, method, args, kwargs)
+        try:
+            self.wait(request)
+            with self._slots:
+                self.running += 1
+                request.started = time()
+                self._record('wait', request, request.started)
+                try:
+                    LOG.debug('%s request %s is running with queue depth: %d'
+                              % (str(method_name), request.request_id,
+                                 len(self)))
+                    result = request.method(*request.args, **request.kwargs)
+                    LOG.debug('%s request %s took %.5f secs'
+                              ' - %d requests merged'
+                              % (str(method_name), request.request_id,
+                                 time() - request.started, request.merged))
+                except Exception:
+                    LOG.error('%s request %s FAILED'
+                              % (str(method_name), request.request_id))
+                    raise
+                finally:
+                    self.running -= 1
+                    self._record('run', request, time())
+        except BaseException:
+            request.done.send_exception(*sys.exc_info())
+            raise
+        finally:
+            self.dequeue(request)
+        request.done.send(result)
+        return result
+
+    def get_stats(self, key=None):
+        """Return depth, wait and run time statistics per queue key."""
+        keys = [key] if key else self.stats.keys()
+        stats = {}
+        for stats_key in keys:
+            if stats_key not in self.stats:
+                continue
+            key_stats = dict(self.stats[stats_key])
+            key_stats['depth'] = len(self.queues.get(stats_key, []))
+            stats[stats_key] = key_stats
+        return stats
+
+    def get_summary(self):
+        """Return a compact summary suitable for agent state reports."""
+        return {'scope': self.scope,
+                'workers': self.workers,
+                'running': self.running,
+                'depth': self.depth,
+                'merged': self.merged,
+                'active_keys': len(self.queues)}
+
+    def _key_stats(self, key):
+        if key not in self.stats:
+            self._prune_stats()
+            self.stats[key] = {'requests': 0, 'merged': 0, 'max_depth': 0,
+                               'wait_time': 0.0, 'max_wait_time': 0.0,
+                               'run_time': 0.0, 'max_run_time': 0.0}
+        return self.stats[key]
+
+    def _prune_stats(self):
+        # Drop the statistics of the least recently used idle keys, as
+        # every loadbalancer and tenant ever served would add one
+        for key in list(self.stats):
+            if len(self.stats) < self.MAX_STATS_KEYS:
+                break
+            if key not in self.queues:
+                del self.stats[key]
+
+    def _record(self, phase, request, now):
+        if phase == 'wait':
+            elapsed = now - request.enqueued
+        else:
+            elapsed = now - request.started
+        for key in request.keys:
+            key_stats = self._key_stats(key)
+            key_stats['%s_time' % phase] += elapsed
+            key_stats['max_%s_time' % phase] = max(
+                key_stats['max_%s_time' % phase], elapsed)
+
+
+class RequestLocal(object):
+    """Descriptor keeping an instance attribute per greenthread.
+
+    Driver requests for different loadbalancers run concurrently through
+    the same driver and builder objects, so flags describing the request
+    being processed must not leak between them.
+    """
+
+    descriptors = []
+
+    def __init__(self, default=None):
+        self.default = default
+        self.local = threading.local()
+        RequestLocal.descriptors.append(self)
+
+    @classmethod
+    def get_context(cls):
+        """Return the values of the current greenthread."""
+        return [(descriptor, dict(descriptor._values()))
+                for descriptor in cls.descriptors]
+
+    @classmethod
+    def set_context(cls, context):
+        """Take over values returned by get_context() in another thread."""
+        for descriptor, values in context:
+            descriptor.local.values = dict(values)
+
+    def _values(self):
+        if not hasattr(self.local, 'values'):
+            self.local.values = {}
+        return self.local.values
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self._values().get(id(instance), self.default)
+
+    def __set__(self, instance, value):
+        self._values()[id(instance)] = value
+
+
+class FanOutResult(object):
+    """Return values and errors of a DeviceFanOut run by BIG-IP hostname."""
+
+    def __init__(self):
+        self.results = collections.OrderedDict()
+        self.errors = collections.OrderedDict()
+        self._exc_info = dict()
+
+    def add(self, bigip, value=None, exc_info=None):
+        if exc_info:
+            self.errors[bigip.hostname] = exc_info[1]
+            self._exc_info[bigip.hostname] = exc_info
+        else:
+            self.results[bigip.hostname] = value
+
+    def values(self):
+        return list(self.results.values())
+
+    def get_error(self):
+        """Return the first error raised or returned by a device."""
+        errors = list(self.errors.values())
+        errors.extend(value for value in self.results.values()
+                      if isinstance(value, Exception))
+        return errors[0] if errors else None
+
+    def raise_errors(self):
+        """Re-raise the first exception raised by a device.
+
+        The exceptions of the other devices are logged.
+        """
+        if not self.errors:
+            return
+        hostnames = list(self.errors)
+        for hostname in hostnames[1:]:
+            LOG.error("error on BIG-IP %s: %s"
+                      % (hostname, self.errors[hostname]))
+        six.reraise(*self._exc_info[hostnames[0]])
+
+
+class DeviceFanOut(object):
+    """Run an operation on every BIG-IP of a cluster concurrently.
+
+    Every device runs in its own greenthread, which carries over the
+    RequestLocal values of the caller, and has timeout seconds to finish.
+    The eventlet.Timeout raised in it then is not an Exception, so it goes
+    through the error handling of the operation and is reported as a
+    BigIPDeviceTimeout. A timeout of None or 0 waits for ever.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def map(self, method, bigips, *args, **kwargs):
+        """Call method(bigip, *args, **kwargs) for every BIG-IP.
+
+        Exceptions are collected in the FanOutResult, not raised.
+        """
+        result = FanOutResult()
+        bigips = list(bigips)
+        if len(bigips) == 1:
+            result.add(bigips[0],
+                       *self._call(None, method, bigips[0], args, kwargs))
+            return result
+
+        context = RequestLocal.get_context()
+        threads = [(bigip, greenthread.spawn(self._call, context, method,
+                                             bigip, args, kwargs))
+                   for bigip in bigips]
+        for bigip, thread in threads:
+            result.add(bigip, *thread.wait())
+        return result
+
+    def _call(self, context, method, bigip, args, kwargs):
+        if context:
+            RequestLocal.set_context(context)
+        timeout = eventlet.Timeout(self.timeout or None)
+        try:
+            return method(bigip, *args, **kwargs), None
+        except eventlet.Timeout as exc:
+            if exc is not timeout:
+                raise
+            try:
+                raise f5_ex.BigIPDeviceTimeout(
+                    "BIG-IP %s did not respond within %s seconds"
+                    % (bigip.hostname, self.timeout))
+            except f5_ex.BigIPDeviceTimeout:
+                return None, sys.exc_info()
+        except Exception:
+            return None, sys.exc_info()
+        finally:
+            timeout.cancel()
 
 
 def get_filter(bigip, key, op, value):